@@ -0,0 +1,640 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+ALGORITHMS = (
+    "token bucket",
+    "leaky bucket",
+    "sliding window log",
+    "sliding window counter",
+)
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+_CLOCK_TICKS_PER_SECOND = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+logger = logging.getLogger("benchmark")
+
+
+class StubUpstream:
+    def __init__(self, listen_port: int, response_body_size: int) -> None:
+        self._listen_port = listen_port
+        body = b"x" * response_body_size
+        self._response = (
+            b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+        )
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        server = await asyncio.start_server(
+            self._handle, "127.0.0.1", self._listen_port, backlog=socket.SOMAXCONN
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                content_length = 0
+                for line in head.split(b"\r\n"):
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        content_length = int(value)
+                if content_length:
+                    await reader.readexactly(content_length)
+                writer.write(self._response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        port: int,
+        rate: float,
+        duration_second: float,
+        client_ips: List[str],
+        body_size: int,
+        timeout_second: float,
+    ) -> None:
+        self._port = port
+        self._rate = rate
+        self._duration_second = duration_second
+        self._client_ips = client_ips
+        self._timeout_second = timeout_second
+        method = b"POST" if body_size else b"GET"
+        self._request = (
+            b"%s / HTTP/1.1\r\nHost: benchmark\r\nConnection: close\r\n"
+            b"Content-Length: %d\r\n\r\n" % (method, body_size)
+        ) + b"x" * body_size
+
+    def run(self) -> Dict[str, list]:
+        return asyncio.run(self._generate())
+
+    async def _generate(self) -> Dict[str, list]:
+        loop = asyncio.get_running_loop()
+        n_requests = int(self._rate * self._duration_second)
+        started = loop.time() + 0.1
+        tasks = []
+        send_lags = []
+        # Requests are sent on schedule whether or not earlier ones have completed,
+        # and latency is measured from the scheduled time, not the actual send time.
+        for i in range(n_requests):
+            scheduled = started + i / self._rate
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            send_lags.append(loop.time() - scheduled)
+            client_ip = self._client_ips[i % len(self._client_ips)]
+            tasks.append(loop.create_task(self._send(client_ip, scheduled)))
+        results = await asyncio.gather(*tasks)
+        return {
+            "statuses": [status for status, _ in results],
+            "latencies": [latency for _, latency in results],
+            "send_lags": send_lags,
+            "elapsed_seconds": [loop.time() - started],
+        }
+
+    async def _send(self, client_ip: str, scheduled: float) -> Tuple[str, float]:
+        loop = asyncio.get_running_loop()
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    "127.0.0.1", self._port, local_addr=(client_ip, 0)
+                ),
+                self._timeout_second,
+            )
+            writer.write(self._request)
+            response = await asyncio.wait_for(reader.read(), self._timeout_second)
+            status = response[9:12].decode() if response else "closed"
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except ConnectionResetError:
+            status = "reset"
+        except OSError:
+            status = "error"
+        finally:
+            if writer:
+                writer.close()
+        return status, loop.time() - scheduled
+
+
+class ProcessMonitor(threading.Thread):
+    def __init__(self, pid: int, interval_second: float = 0.2) -> None:
+        super().__init__(daemon=True)
+        self._pid = pid
+        self._interval_second = interval_second
+        self._is_stop = threading.Event()
+        self.peak_rss_byte = 0
+        self._pid_to_cpu_second: Dict[int, float] = {}
+
+    def run(self) -> None:
+        while not self._is_stop.wait(self._interval_second):
+            self.sample()
+
+    def sample(self) -> None:
+        rss_byte = 0
+        for pid in self._get_pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/statm") as f:
+                    rss_byte += int(f.read().split()[1]) * _PAGE_SIZE
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            self._pid_to_cpu_second[pid] = (
+                int(fields[11]) + int(fields[12])
+            ) / _CLOCK_TICKS_PER_SECOND
+        self.peak_rss_byte = max(self.peak_rss_byte, rss_byte)
+
+    def get_cpu_second(self) -> float:
+        return sum(self._pid_to_cpu_second.values())
+
+    def stop(self) -> None:
+        self._is_stop.set()
+        self.join()
+        self.sample()
+
+    def _get_pids(self) -> List[int]:
+        pids = [self._pid]
+        try:
+            with open(f"/proc/{self._pid}/task/{self._pid}/children") as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        except FileNotFoundError:
+            pass
+        return pids
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get_client_ips(n_client_ips: int) -> List[str]:
+    # Every address in 127.0.0.0/8 is bound to the loopback interface on Linux.
+    return [
+        f"127.{i // (254 * 256) % 256}.{i // 254 % 256}.{1 + i % 254}"
+        for i in range(n_client_ips)
+    ]
+
+
+def get_percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def create_config(
+    algorithm: str, forward_port: int, limit_per_second: int
+) -> Dict[str, dict]:
+    return {
+        "common": {
+            "forward_host": "127.0.0.1",
+            "forward_port": forward_port,
+            "client_keep_alive_timeout_second": 0,
+        },
+        "rate_limit_algorithm": algorithm,
+        "token_bucket": {
+            "periodic_second": 1,
+            "n_tokens_to_be_added_per_periodic_second": limit_per_second,
+            "token_bucket_size": limit_per_second,
+        },
+        "leaky_bucket": {
+            "periodic_second": 1,
+            "n_request_to_be_processed_per_periodic_second": limit_per_second,
+            "request_queue_size": limit_per_second,
+        },
+        "sliding_window_log": {
+            "window_second": 1,
+            "max_n_requests_per_window": limit_per_second,
+        },
+        "sliding_window_counter": {
+            "window_second": 1,
+            "max_n_requests_per_window": limit_per_second,
+        },
+    }
+
+
+def start_limiter(
+    work_dir: str,
+    config: Dict[str, dict],
+    port: int,
+    server_mode: str,
+    n_workers: int,
+    timeout_second: float = 10,
+) -> Tuple[subprocess.Popen, str]:
+    config_path = os.path.join(work_dir, "config.yaml")
+    log_path = os.path.join(work_dir, f"limiter-{port}.log")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    with open(log_path, "w") as log_file:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(PROJECT_DIR, "src", "main.py"),
+                "-c",
+                config_path,
+                "-hn",
+                "127.0.0.1",
+                "-p",
+                str(port),
+                "-m",
+                server_mode,
+                "-w",
+                str(n_workers),
+            ],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+    deadline = time.monotonic() + timeout_second
+    while time.monotonic() < deadline:
+        with open(log_path) as f:
+            if f.read().count("start listening on") >= n_workers:
+                return process, log_path
+        if process.poll() is not None:
+            break
+        time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"rate limiter did not start. check out {log_path}")
+
+
+def stop_limiter(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _run_load_generator(load_generator: LoadGenerator, conn) -> None:
+    conn.send(load_generator.run())
+    conn.close()
+
+
+def run_load(
+    port: int,
+    rate: float,
+    duration_second: float,
+    client_ips: List[str],
+    body_size: int,
+    timeout_second: float,
+    n_load_processes: int,
+) -> Dict[str, list]:
+    context = multiprocessing.get_context("fork")
+    processes_and_conns = []
+    for i in range(n_load_processes):
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        load_generator = LoadGenerator(
+            port=port,
+            rate=rate / n_load_processes,
+            duration_second=duration_second,
+            client_ips=client_ips[i::n_load_processes] or client_ips,
+            body_size=body_size,
+            timeout_second=timeout_second,
+        )
+        process = context.Process(
+            target=_run_load_generator, args=(load_generator, child_conn)
+        )
+        process.start()
+        processes_and_conns.append((process, parent_conn))
+    merged = {"statuses": [], "latencies": [], "send_lags": [], "elapsed_seconds": []}
+    for process, conn in processes_and_conns:
+        for name, values in conn.recv().items():
+            merged[name].extend(values)
+        process.join()
+    return merged
+
+
+def run_scenario(
+    work_dir: str,
+    upstream_port: int,
+    algorithm: str,
+    server_mode: str,
+    n_workers: int,
+    rate: float,
+    body_size: int,
+    args: argparse.Namespace,
+) -> Dict[str, object]:
+    port = get_free_port()
+    process, log_path = start_limiter(
+        work_dir,
+        create_config(algorithm, upstream_port, args.limit_per_second),
+        port,
+        server_mode,
+        n_workers,
+    )
+    monitor = ProcessMonitor(process.pid)
+    try:
+        monitor.sample()
+        cpu_second_before = monitor.get_cpu_second()
+        monitor.start()
+        load = run_load(
+            port=port,
+            rate=rate,
+            duration_second=args.duration_second,
+            client_ips=get_client_ips(args.n_client_ips),
+            body_size=body_size,
+            timeout_second=args.timeout_second,
+            n_load_processes=args.n_load_processes,
+        )
+        monitor.stop()
+        elapsed_second = max(load["elapsed_seconds"])
+    finally:
+        stop_limiter(process)
+    latencies = sorted(
+        latency
+        for status, latency in zip(load["statuses"], load["latencies"])
+        if status.isdigit()
+    )
+    status_to_count: Dict[str, int] = {}
+    for status in load["statuses"]:
+        status_to_count[status] = status_to_count.get(status, 0) + 1
+    return {
+        "algorithm": algorithm,
+        "server_mode": server_mode,
+        "n_workers": n_workers,
+        "rate": rate,
+        "body_size": body_size,
+        "n_client_ips": args.n_client_ips,
+        "limit_per_second": args.limit_per_second,
+        "duration_second": args.duration_second,
+        "n_requests": len(load["statuses"]),
+        "n_responses": len(latencies),
+        "status_to_count": status_to_count,
+        "throughput": len(latencies) / elapsed_second,
+        "latency_ms": {
+            name: None if value is None else value * 1000
+            for name, value in (
+                ("p50", get_percentile(latencies, 0.5)),
+                ("p99", get_percentile(latencies, 0.99)),
+                ("p999", get_percentile(latencies, 0.999)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+        "max_send_lag_ms": max(load["send_lags"], default=0) * 1000,
+        "cpu_percent": (monitor.get_cpu_second() - cpu_second_before)
+        / elapsed_second
+        * 100,
+        "peak_rss_mb": monitor.peak_rss_byte / (1 << 20),
+    }
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_scenario_key(result: Dict[str, object]) -> Tuple:
+    return (
+        result["algorithm"],
+        result["server_mode"],
+        result["n_workers"],
+        result["rate"],
+        result["body_size"],
+    )
+
+
+def print_result(result: Dict[str, object]) -> None:
+    latency_ms = result["latency_ms"]
+    print(
+        f"{result['algorithm']:<22} {result['server_mode']:<8} w={result['n_workers']:<2} "
+        f"rate={result['rate']:<6g} body={result['body_size']:<6} "
+        f"rps={result['throughput']:<8.1f} "
+        f"p50={latency_ms['p50'] or 0:.2f}ms p99={latency_ms['p99'] or 0:.2f}ms "
+        f"p999={latency_ms['p999'] or 0:.2f}ms "
+        f"cpu={result['cpu_percent']:.0f}% rss={result['peak_rss_mb']:.1f}MB "
+        f"statuses={result['status_to_count']}",
+        flush=True,
+    )
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old_results = {get_scenario_key(r): r for r in json.load(f)["results"]}
+    with open(new_path) as f:
+        new_results = json.load(f)["results"]
+    for new_result in new_results:
+        old_result = old_results.get(get_scenario_key(new_result))
+        if old_result is None:
+            continue
+        changes = [
+            f"rps {old_result['throughput']:.1f} -> {new_result['throughput']:.1f}"
+        ]
+        for name in ("p50", "p99", "p999"):
+            old_value = old_result["latency_ms"][name]
+            new_value = new_result["latency_ms"][name]
+            if old_value is not None and new_value is not None:
+                changes.append(f"{name} {old_value:.2f} -> {new_value:.2f}ms")
+        changes.append(
+            f"cpu {old_result['cpu_percent']:.0f} -> {new_result['cpu_percent']:.0f}%"
+        )
+        changes.append(
+            f"rss {old_result['peak_rss_mb']:.1f} -> {new_result['peak_rss_mb']:.1f}MB"
+        )
+        print(
+            " ".join(str(v) for v in get_scenario_key(new_result)),
+            "|",
+            ", ".join(changes),
+        )
+
+
+def main(args: argparse.Namespace) -> None:
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+    upstream_port = get_free_port()
+    upstream = multiprocessing.get_context("fork").Process(
+        target=StubUpstream(upstream_port, args.response_body_size).run, daemon=True
+    )
+    upstream.start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="benchmark-") as work_dir:
+            for algorithm, server_mode, n_workers, rate, body_size in itertools.product(
+                args.algorithms,
+                args.server_modes,
+                args.n_workers,
+                args.rates,
+                args.body_sizes,
+            ):
+                result = run_scenario(
+                    work_dir,
+                    upstream_port,
+                    algorithm,
+                    server_mode,
+                    n_workers,
+                    rate,
+                    body_size,
+                    args,
+                )
+                print_result(result)
+                results.append(result)
+    finally:
+        upstream.terminate()
+        upstream.join()
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "git_commit": get_git_commit(),
+                "python_version": platform.python_version(),
+                "platform": platform.platform(),
+                "n_cpus": os.cpu_count(),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"results have been written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a",
+        "--algorithms",
+        metavar="",
+        help="rate limit algorithms to benchmark",
+        nargs="+",
+        choices=ALGORITHMS,
+        default=list(ALGORITHMS),
+    )
+    parser.add_argument(
+        "-m",
+        "--server-modes",
+        metavar="",
+        help="server modes to benchmark",
+        nargs="+",
+        choices=["blocking", "asyncio"],
+        default=["blocking", "asyncio"],
+    )
+    parser.add_argument(
+        "-w",
+        "--n-workers",
+        metavar="",
+        help="numbers of worker processes to benchmark",
+        nargs="+",
+        type=int,
+        default=[1],
+    )
+    parser.add_argument(
+        "-r",
+        "--rates",
+        metavar="",
+        help="request rates (requests per second) to benchmark",
+        nargs="+",
+        type=float,
+        default=[100, 500],
+    )
+    parser.add_argument(
+        "-b",
+        "--body-sizes",
+        metavar="",
+        help="request body sizes (bytes) to benchmark",
+        nargs="+",
+        type=int,
+        default=[0, 16384],
+    )
+    parser.add_argument(
+        "-d",
+        "--duration-second",
+        metavar="",
+        help="duration of each scenario",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "-n",
+        "--n-client-ips",
+        metavar="",
+        help="number of client ips requests are sent from",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "-l",
+        "--limit-per-second",
+        metavar="",
+        help="number of requests allowed per client ip per second",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--response-body-size",
+        metavar="",
+        help="response body size (bytes) of the stub upstream",
+        type=int,
+        default=128,
+    )
+    parser.add_argument(
+        "--n-load-processes",
+        metavar="",
+        help="number of processes generating load",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--timeout-second",
+        metavar="",
+        help="timeout of each request",
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="",
+        help="path of the results (.json)",
+        default="benchmark_results.json",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="",
+        help="compare two results (.json) instead of running benchmarks",
+        nargs=2,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s,%(msecs)03d %(levelname)-8s %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    if args.compare:
+        compare(*args.compare)
+    else:
+        main(args)
@@ -0,0 +1,55 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.metrics import Metrics
+
+
+class _AdminRequestHandler(BaseHTTPRequestHandler):
+    server: "_AdminHttpServer"
+
+    def do_GET(self) -> None:
+        if self.path.partition("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = Metrics().render(self.server.labels)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        self.server.logger.debug(format, *args)
+
+
+class _AdminHttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen_address, labels: str, logger: logging.Logger) -> None:
+        super().__init__(listen_address, _AdminRequestHandler)
+        self.labels = labels
+        self.logger = logger
+
+
+class AdminServer(threading.Thread):
+    def __init__(self, listen_host: str, listen_port: int, labels: str = "") -> None:
+        super().__init__(daemon=True)
+        self._listen_host = listen_host
+        self._listen_port = listen_port
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._http_server = _AdminHttpServer(
+            (listen_host, int(listen_port)), labels, self._logger
+        )
+
+    @property
+    def listen_address(self) -> str:
+        return f"{self._listen_host}:{self._listen_port}"
+
+    def run(self) -> None:
+        self._logger.info("start listening on %s", self.listen_address)
+        self._http_server.serve_forever()
+
+    def stop(self) -> None:
+        self._http_server.shutdown()
+        self._http_server.server_close()
@@ -1,25 +1,103 @@
-from typing import Literal
+from typing import Dict, List, Literal, Optional
 
-from pydantic import BaseSettings
+from pydantic import BaseModel, BaseSettings, validator
 
 
 class Config(BaseSettings):
     class Common(BaseSettings):
         forward_host: str = "127.0.0.1"
         forward_port: int = 8080
-        socket_buf_size: int = 1024
+        socket_buf_size: int = 65536
+        upstream_pool_size: int = 10
+        upstream_idle_timeout_second: float = 30
+        client_keep_alive_timeout_second: float = 5
+        storage: Literal["local", "remote"] = "local"
+        storage_host: str = "127.0.0.1"
+        storage_port: int = 6380
+        storage_timeout_second: float = 1
+        api_key_header: str = "X-Api-Key"
 
     class TokenBucket(BaseSettings):
-        periodic_second: int = 1
+        periodic_second: float = 1
         n_tokens_to_be_added_per_periodic_second: int = 2
         token_bucket_size: int = 2
+        max_n_token_buckets: int = 1000000
+        max_delay_second: float = 0
+        n_workers: int = 10
 
     class LeakyBucket(BaseSettings):
         periodic_second: int = 1
         n_request_to_be_processed_per_periodic_second: int = 2
         request_queue_size: int = 2
+        n_workers: int = 10
+
+    class SlidingWindowLog(BaseSettings):
+        window_second: float = 1
+        max_n_requests_per_window: int = 2
+        max_n_keys: int = 1000000
+
+    class SlidingWindowCounter(BaseSettings):
+        window_second: float = 1
+        max_n_requests_per_window: int = 2
+        max_n_keys: int = 1000000
+
+    class Rule(BaseModel):
+        name: str
+        path_prefix: str = "/"
+        method: Optional[str] = None
+        headers: Dict[str, str] = {}
+        api_key: Optional[str] = None
+        limit_by: Literal["client_ip", "api_key", "rule"] = "client_ip"
+        rate_limit_algorithm: Optional[
+            Literal[
+                "token bucket",
+                "leaky bucket",
+                "sliding window log",
+                "sliding window counter",
+            ]
+        ] = None
+        token_bucket: Optional["Config.TokenBucket"] = None
+        leaky_bucket: Optional["Config.LeakyBucket"] = None
+        sliding_window_log: Optional["Config.SlidingWindowLog"] = None
+        sliding_window_counter: Optional["Config.SlidingWindowCounter"] = None
 
     common: Common = Common()
-    rate_limit_algorithm: Literal["token bucket", "leaky bucket"] = "token bucket"
+    rate_limit_algorithm: Literal[
+        "token bucket",
+        "leaky bucket",
+        "sliding window log",
+        "sliding window counter",
+    ] = "token bucket"
     token_bucket: TokenBucket = TokenBucket()
     leaky_bucket: LeakyBucket = LeakyBucket()
+    sliding_window_log: SlidingWindowLog = SlidingWindowLog()
+    sliding_window_counter: SlidingWindowCounter = SlidingWindowCounter()
+    rules: List[Rule] = []
+
+    @validator("rules")
+    def check_rule_names_are_unique(cls, rules: List[Rule]) -> List[Rule]:
+        names = [rule.name for rule in rules]
+        if len(names) != len(set(names)):
+            raise ValueError(f"names of rules must be unique. (current: {names})")
+        return rules
+
+    def get_config_of_rule(self, rule: Rule) -> "Config":
+        update = {
+            "rate_limit_algorithm": rule.rate_limit_algorithm
+            or self.rate_limit_algorithm
+        }
+        for name in (
+            "token_bucket",
+            "leaky_bucket",
+            "sliding_window_log",
+            "sliding_window_counter",
+        ):
+            section = getattr(rule, name)
+            if section:
+                update[name] = getattr(self, name).copy(
+                    update=section.dict(exclude_unset=True)
+                )
+        return self.copy(update=update)
+
+
+Config.Rule.update_forward_refs(Config=Config)
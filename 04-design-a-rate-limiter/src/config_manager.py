@@ -1,14 +1,86 @@
+import ctypes
+import ctypes.util
 import logging
+import os
+import select
+import struct
 import threading
-from time import sleep
-from typing import Optional
+from typing import Optional, Tuple
 
 import yaml
 
 from src.config import Config
 
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class _InotifyWatcher:
+    def __init__(self, path: str) -> None:
+        self._file_name = os.path.basename(path).encode()
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # The directory is watched, since editors often replace the file by renaming.
+        wd = libc.inotify_add_watch(
+            self._fd,
+            os.path.dirname(os.path.abspath(path)).encode(),
+            _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE,
+        )
+        if wd < 0:
+            os.close(self._fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait_for_change(self, timeout_second: float) -> bool:
+        readable, _, _ = select.select([self._fd], [], [], timeout_second)
+        if not readable:
+            return False
+        data = os.read(self._fd, 65536)
+        is_changed, i = False, 0
+        while i < len(data):
+            _, _, _, name_size = _INOTIFY_EVENT.unpack_from(data, i)
+            i += _INOTIFY_EVENT.size
+            is_changed |= data[i : i + name_size].rstrip(b"\0") == self._file_name
+            i += name_size
+        return is_changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class _MtimePollingWatcher:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._stat = self._get_stat()
+        self._stop_event = threading.Event()
+
+    def wait_for_change(self, timeout_second: float) -> bool:
+        if self._stop_event.wait(timeout_second):
+            return False
+        stat = self._get_stat()
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+    def close(self) -> None:
+        self._stop_event.set()
+
+    def _get_stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
 
 class ConfigManager(threading.Thread):
+    _WAIT_TIMEOUT_SECOND = 1
+
     def __init__(self, config_path: Optional[str]) -> None:
         super().__init__()
         self.config_path = config_path
@@ -20,9 +92,14 @@ class ConfigManager(threading.Thread):
 
     def run(self) -> None:
         self._logger.debug("start to run")
-        while self.config_path and not self._is_stop:
-            self._watch_and_update_config()
-            sleep(5)
+        if self.config_path:
+            watcher = self._create_watcher()
+            try:
+                while not self._is_stop:
+                    if watcher.wait_for_change(self._WAIT_TIMEOUT_SECOND):
+                        self._watch_and_update_config()
+            finally:
+                watcher.close()
         self._logger.debug("has been completed")
 
     def get_config(self) -> Config:
@@ -32,14 +109,29 @@ class ConfigManager(threading.Thread):
     def stop(self) -> None:
         self._is_stop = True
 
+    def _create_watcher(self):
+        try:
+            return _InotifyWatcher(self.config_path)
+        except (AttributeError, OSError, TypeError) as e:
+            self._logger.info(
+                f"can not watch {self.config_path} with inotify ({e!r}). poll its mtime instead"
+            )
+            return _MtimePollingWatcher(self.config_path)
+
     def _watch_and_update_config(self) -> None:
         self._logger.debug(f"watch {self.config_path}")
-        config = self._get_config_from_path()
+        try:
+            config = self._get_config_from_path()
+        except Exception:
+            self._logger.exception(
+                f"failed to read {self.config_path}. keep current config"
+            )
+            return
         if config.dict() == self._config.dict():
             return
         self._logger.info(f"catch changed {self.config_path}. update config")
-        self.is_config_changed = True
         self._config = config
+        self.is_config_changed = True
 
     def _get_config_from_path(self) -> Config:
         with open(self.config_path) as f:
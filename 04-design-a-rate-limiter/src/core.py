@@ -1,5 +1,6 @@
 import socket
 from dataclasses import dataclass
+from typing import Optional
 
 
 class Singleton(type):
@@ -16,6 +17,14 @@ class Request:
     client_socket: socket.socket
     client_ip: str
     client_port: str
+    keep_alive_enabled: bool = False
+    keep_alive: bool = False
+    received: bytes = b""
+    rate_limit_key: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        if self.rate_limit_key is None:
+            self.rate_limit_key = self.client_ip
 
     @property
     def client_address(self) -> str:
@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import logging
+import signal
+from typing import Optional
+
+from src.rate_limit_algorithms.storages import StorageError
+from src.rate_limit_algorithms.storages.local import LocalStorage
+from src.rate_limit_algorithms.storages.remote import (
+    ERROR,
+    INCR_WITH_EXPIRY,
+    REFILL_AND_TAKE,
+    decode_key,
+)
+from src.snapshotter import Snapshotter
+from src.util import setup_logger
+
+_MAX_COMMAND_SIZE = 1 << 20
+
+
+class CounterServer:
+    def __init__(
+        self,
+        listen_host: str,
+        listen_port: str,
+        max_n_keys: int,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval_second: float = 60,
+    ) -> None:
+        self._listen_host = listen_host
+        self._listen_port = listen_port
+        self._storage = LocalStorage(max_n_keys)
+        self._snapshotter: Optional[Snapshotter] = None
+        if snapshot_path:
+            self._storage.load_snapshot(snapshot_path)
+            self._snapshotter = Snapshotter(
+                lambda: self._storage.save_snapshot(snapshot_path),
+                snapshot_interval_second,
+            )
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def listen_address(self) -> str:
+        return f"{self._listen_host}:{self._listen_port}"
+
+    def run(self) -> None:
+        if self._snapshotter:
+            self._snapshotter.start()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            if self._snapshotter:
+                self._snapshotter.stop()
+        self._logger.info("server socket has been closed")
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        serve_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, serve_task.cancel)
+        server = await asyncio.start_server(
+            self._handle, self._listen_host, int(self._listen_port)
+        )
+        self._logger.info("start listening on %s", self.listen_address)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            self._logger.debug("got shutdown signal")
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer_address = "{}:{}".format(*writer.get_extra_info("peername")[:2])
+        self._logger.debug("%s has been connected", peer_address)
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                end = buffer.rfind(b"\n")
+                if end == -1:
+                    if len(buffer) > _MAX_COMMAND_SIZE:
+                        break
+                    continue
+                # Every pipelined command in the buffer is executed in one step of
+                # the event loop, so each of them is atomic, and the responses go
+                # out in one write.
+                writer.write(
+                    b"".join(
+                        self._execute(command)
+                        for command in bytes(buffer[:end]).split(b"\n")
+                    )
+                )
+                del buffer[: end + 1]
+                await writer.drain()
+        except OSError as e:
+            self._logger.debug("connection of %s failed: %r", peer_address, e)
+        except asyncio.CancelledError:
+            self._logger.debug("connection of %s has been cancelled", peer_address)
+        finally:
+            writer.close()
+            self._logger.debug("%s has been disconnected", peer_address)
+
+    def _execute(self, command: bytes) -> bytes:
+        try:
+            # Arguments are separated by single spaces, so that an empty key is kept.
+            name, _, args = command.partition(b" ")
+            if name == REFILL_AND_TAKE:
+                key, token_bucket_size, n_tokens_per_second, *rest = args.split(b" ")
+                is_taken, current_n_tokens = self._storage.refill_and_take(
+                    decode_key(key),
+                    int(token_bucket_size),
+                    float(n_tokens_per_second),
+                    float(rest[0]) if rest else 0,
+                )
+                return b"%d %r\n" % (is_taken, current_n_tokens)
+            if name == INCR_WITH_EXPIRY:
+                expiry_second, *keys_and_amounts = args.split(b" ")
+                values = self._storage.incr_with_expiry(
+                    [
+                        (decode_key(key), int(amount))
+                        for key, amount in zip(
+                            keys_and_amounts[::2], keys_and_amounts[1::2]
+                        )
+                    ],
+                    float(expiry_second),
+                )
+                return b" ".join(b"%d" % value for value in values) + b"\n"
+            raise StorageError(f"unknown command {name!r}")
+        except (StorageError, ValueError) as e:
+            return b"%s %s\n" % (ERROR, str(e).encode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-hn",
+        "--hostname",
+        metavar="",
+        help="hostname for listening",
+        default="0.0.0.0",
+    )
+    parser.add_argument(
+        "-p", "--port", metavar="", help="port for listening", default="6380"
+    )
+    parser.add_argument(
+        "-k",
+        "--max-n-keys",
+        metavar="",
+        help="maximum number of keys kept in memory",
+        type=int,
+        default=1000000,
+    )
+    parser.add_argument(
+        "-s",
+        "--snapshot-path",
+        metavar="",
+        help="file path of the snapshot of the counters, loaded on start and saved periodically and on shutdown. disabled if not given",
+        default=None,
+    )
+    parser.add_argument(
+        "--snapshot-interval-second",
+        metavar="",
+        help="interval of saving the snapshot",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "-f",
+        "--log-format",
+        metavar="",
+        help="log format",
+        default="%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(name)s - %(message)s",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="print debug logs", default=False
+    )
+    args = parser.parse_args()
+
+    setup_logger(args.log_format, args.verbose)
+    CounterServer(
+        args.hostname,
+        args.port,
+        args.max_n_keys,
+        args.snapshot_path,
+        args.snapshot_interval_second,
+    ).run()
+    logging.getLogger().info("good bye!")
@@ -0,0 +1,553 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+from src.core import Request
+from src.http_message import (
+    MAX_HEAD_SIZE,
+    HttpBody,
+    HttpHead,
+    HttpMessageError,
+    find_head_end,
+)
+from src.metrics import Metrics
+from src.upstream import (
+    AsyncUpstreamConnectionPool,
+    UpstreamConnection,
+    UpstreamConnectionPool,
+)
+
+_CAN_SPLICE = hasattr(os, "splice")
+_SPLICE_CHUNK_SIZE = 1 << 20
+_HEAD_END_SIZE = 4
+_RETRYABLE_ERRORS = (ConnectionResetError, BrokenPipeError, HttpMessageError)
+_BAD_GATEWAY_RESPONSE = (
+    b"HTTP/1.1 502 Bad Gateway\r\n"
+    b"Content-Type: text/plan; encoding=utf8\r\n"
+    b"Content-Length: 11\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Bad Gateway"
+)
+
+_KEEP_ALIVE_HEADER_LINE = b"Connection: keep-alive\r\n"
+_CLOSE_HEADER_LINE = b"Connection: close\r\n"
+
+_UpstreamResponse = Tuple[UpstreamConnection, HttpHead, HttpBody, int, int]
+
+
+class Forwarder:
+    def __init__(
+        self,
+        forward_host: str,
+        forward_port: int,
+        socket_buf_size: int,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+    ) -> None:
+        self._forward_host = forward_host
+        self._forward_port = forward_port
+        self._socket_buf_size = socket_buf_size
+        self._upstream_pool_size = upstream_pool_size
+        self._upstream_idle_timeout_second = upstream_idle_timeout_second
+        self._pool: Optional[UpstreamConnectionPool] = None
+        self._async_pool: Optional[AsyncUpstreamConnectionPool] = None
+        self._buffers: Deque[bytearray] = deque()
+        self._metrics = Metrics()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def forward_address(self) -> str:
+        return f"{self._forward_host}:{self._forward_port}"
+
+    def forward(self, request: Request, rate_limit_header_lines: bytes) -> None:
+        buffer = self._acquire_buffer()
+        try:
+            self._forward(request, rate_limit_header_lines, buffer)
+        finally:
+            self._buffers.append(buffer)
+
+    async def forward_async(
+        self, request: Request, rate_limit_header_lines: bytes
+    ) -> None:
+        buffer = self._acquire_buffer()
+        try:
+            await self._forward_async(request, rate_limit_header_lines, buffer)
+        finally:
+            self._buffers.append(buffer)
+
+    def close(self) -> None:
+        if self._pool:
+            self._pool.close()
+        if self._async_pool:
+            self._async_pool.close()
+
+    def _forward(
+        self, request: Request, rate_limit_header_lines: bytes, buffer: bytearray
+    ) -> None:
+        request.keep_alive = False
+        try:
+            received = self._recv_head(
+                request.client_socket, buffer, self._fill_received(request, buffer)
+            )
+            if received is None:
+                return
+            (
+                request_head,
+                request_body,
+                upstream_request,
+                request.received,
+            ) = self._prepare_request(buffer, *received)
+        except (HttpMessageError, ConnectionResetError) as e:
+            self._logger.debug(
+                "can not read request of %s: %s", request.client_address, e
+            )
+            return
+        try:
+            upstream_response = self._request_upstream(
+                request,
+                request_head,
+                request_body,
+                upstream_request,
+                buffer,
+            )
+        except ConnectionRefusedError:
+            raise
+        except (OSError, HttpMessageError) as e:
+            self._logger.error(
+                "failed to get response from forward server %s: %s",
+                self.forward_address,
+                e,
+            )
+            request.client_socket.sendall(_BAD_GATEWAY_RESPONSE)
+            return
+        (
+            connection,
+            response_head,
+            response_body,
+            body_start_index,
+            n_filled,
+        ) = upstream_response
+        try:
+            request.keep_alive = self._is_keep_alive(
+                request, request_head, response_body
+            )
+            n_body = response_body.consume(
+                memoryview(buffer)[body_start_index:n_filled]
+            )
+            self._logger.debug("send data to client %s", request.client_address)
+            self._sendmsg_all(
+                request.client_socket,
+                [
+                    self._get_response_head(
+                        response_head, rate_limit_header_lines, request.keep_alive
+                    ),
+                    memoryview(buffer)[body_start_index : body_start_index + n_body],
+                ],
+            )
+            has_extra_bytes = body_start_index + n_body < n_filled
+            if not response_body.is_complete:
+                has_extra_bytes = bool(
+                    self._relay_body(
+                        connection.socket, request.client_socket, response_body, buffer
+                    )
+                )
+            connection.is_reusable = (
+                response_head.is_keep_alive
+                and response_body.is_delimited
+                and not has_extra_bytes
+            )
+        except (OSError, HttpMessageError) as e:
+            self._logger.error(
+                "failed to relay response to client %s: %s", request.client_address, e
+            )
+            request.keep_alive = False
+        finally:
+            self._pool.release(connection)
+
+    async def _forward_async(
+        self, request: Request, rate_limit_header_lines: bytes, buffer: bytearray
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        request.keep_alive = False
+        try:
+            received = await self._recv_head_async(
+                request.client_socket, buffer, self._fill_received(request, buffer)
+            )
+            if received is None:
+                return
+            (
+                request_head,
+                request_body,
+                upstream_request,
+                request.received,
+            ) = self._prepare_request(buffer, *received)
+        except (HttpMessageError, ConnectionResetError) as e:
+            self._logger.debug(
+                "can not read request of %s: %s", request.client_address, e
+            )
+            return
+        try:
+            upstream_response = await self._request_upstream_async(
+                request,
+                request_head,
+                request_body,
+                upstream_request,
+                buffer,
+            )
+        except ConnectionRefusedError:
+            raise
+        except (OSError, HttpMessageError) as e:
+            self._logger.error(
+                "failed to get response from forward server %s: %s",
+                self.forward_address,
+                e,
+            )
+            await loop.sock_sendall(request.client_socket, _BAD_GATEWAY_RESPONSE)
+            return
+        (
+            connection,
+            response_head,
+            response_body,
+            body_start_index,
+            n_filled,
+        ) = upstream_response
+        try:
+            request.keep_alive = self._is_keep_alive(
+                request, request_head, response_body
+            )
+            n_body = response_body.consume(
+                memoryview(buffer)[body_start_index:n_filled]
+            )
+            self._logger.debug("send data to client %s", request.client_address)
+            await loop.sock_sendall(
+                request.client_socket,
+                self._get_response_head(
+                    response_head, rate_limit_header_lines, request.keep_alive
+                ),
+            )
+            if n_body:
+                await loop.sock_sendall(
+                    request.client_socket,
+                    memoryview(buffer)[body_start_index : body_start_index + n_body],
+                )
+            has_extra_bytes = body_start_index + n_body < n_filled
+            if not response_body.is_complete:
+                has_extra_bytes = bool(
+                    await self._relay_body_async(
+                        connection.socket, request.client_socket, response_body, buffer
+                    )
+                )
+            connection.is_reusable = (
+                response_head.is_keep_alive
+                and response_body.is_delimited
+                and not has_extra_bytes
+            )
+        except (OSError, HttpMessageError) as e:
+            self._logger.error(
+                "failed to relay response to client %s: %s", request.client_address, e
+            )
+            request.keep_alive = False
+        finally:
+            self._async_pool.release(connection)
+
+    def _request_upstream(
+        self,
+        request: Request,
+        request_head: HttpHead,
+        request_body: HttpBody,
+        upstream_request: bytes,
+        buffer: bytearray,
+    ) -> _UpstreamResponse:
+        if self._pool is None:
+            self._pool = UpstreamConnectionPool(
+                self._forward_host,
+                self._forward_port,
+                self._upstream_pool_size,
+                self._upstream_idle_timeout_second,
+            )
+        can_retry = request_body.is_complete
+        connection = self._pool.acquire()
+        while True:
+            try:
+                self._logger.debug(
+                    "send data to forward server %s", self.forward_address
+                )
+                started = time.perf_counter()
+                connection.socket.sendall(upstream_request)
+                if not request_body.is_complete:
+                    request.received = self._relay_body(
+                        request.client_socket, connection.socket, request_body, buffer
+                    )
+                received = self._recv_head(connection.socket, buffer)
+                self._metrics.upstream_response_second.observe_since(started)
+                self._logger.debug(
+                    "got data from forward server %s", self.forward_address
+                )
+                return (connection,) + self._parse_response_head(
+                    request_head, buffer, received
+                )
+            except _RETRYABLE_ERRORS:
+                self._pool.release(connection)
+                if not (can_retry and connection.is_reused):
+                    raise
+                self._logger.debug(
+                    "reused connection to %s was broken. retry with new connection",
+                    self.forward_address,
+                )
+                can_retry = False
+                connection = self._pool.acquire(fresh=True)
+            except BaseException:
+                self._pool.release(connection)
+                raise
+
+    async def _request_upstream_async(
+        self,
+        request: Request,
+        request_head: HttpHead,
+        request_body: HttpBody,
+        upstream_request: bytes,
+        buffer: bytearray,
+    ) -> _UpstreamResponse:
+        loop = asyncio.get_running_loop()
+        if self._async_pool is None:
+            self._async_pool = AsyncUpstreamConnectionPool(
+                self._forward_host,
+                self._forward_port,
+                self._upstream_pool_size,
+                self._upstream_idle_timeout_second,
+            )
+        can_retry = request_body.is_complete
+        connection = await self._async_pool.acquire()
+        while True:
+            try:
+                self._logger.debug(
+                    "send data to forward server %s", self.forward_address
+                )
+                started = time.perf_counter()
+                await loop.sock_sendall(connection.socket, upstream_request)
+                if not request_body.is_complete:
+                    request.received = await self._relay_body_async(
+                        request.client_socket, connection.socket, request_body, buffer
+                    )
+                received = await self._recv_head_async(connection.socket, buffer)
+                self._metrics.upstream_response_second.observe_since(started)
+                self._logger.debug(
+                    "got data from forward server %s", self.forward_address
+                )
+                return (connection,) + self._parse_response_head(
+                    request_head, buffer, received
+                )
+            except _RETRYABLE_ERRORS:
+                self._async_pool.release(connection)
+                if not (can_retry and connection.is_reused):
+                    raise
+                self._logger.debug(
+                    "reused connection to %s was broken. retry with new connection",
+                    self.forward_address,
+                )
+                can_retry = False
+                connection = await self._async_pool.acquire(fresh=True)
+            except BaseException:
+                self._async_pool.release(connection)
+                raise
+
+    def _recv_head(
+        self, sock: socket.socket, buffer: bytearray, n_filled: int = 0
+    ) -> Optional[Tuple[int, int]]:
+        head_end_index = find_head_end(buffer, 0, n_filled)
+        if head_end_index != -1:
+            return head_end_index, n_filled
+        while True:
+            self._ensure_free_space(buffer, n_filled)
+            n_received = sock.recv_into(memoryview(buffer)[n_filled:])
+            if n_received == 0:
+                return self._on_eof_before_head_end(n_filled)
+            head_end_index = find_head_end(buffer, n_filled, n_filled + n_received)
+            n_filled += n_received
+            if head_end_index != -1:
+                return head_end_index, n_filled
+
+    async def _recv_head_async(
+        self, sock: socket.socket, buffer: bytearray, n_filled: int = 0
+    ) -> Optional[Tuple[int, int]]:
+        loop = asyncio.get_running_loop()
+        head_end_index = find_head_end(buffer, 0, n_filled)
+        if head_end_index != -1:
+            return head_end_index, n_filled
+        while True:
+            self._ensure_free_space(buffer, n_filled)
+            n_received = await loop.sock_recv_into(sock, memoryview(buffer)[n_filled:])
+            if n_received == 0:
+                return self._on_eof_before_head_end(n_filled)
+            head_end_index = find_head_end(buffer, n_filled, n_filled + n_received)
+            n_filled += n_received
+            if head_end_index != -1:
+                return head_end_index, n_filled
+
+    def _relay_body(
+        self,
+        src_socket: socket.socket,
+        dst_socket: socket.socket,
+        body: HttpBody,
+        buffer: bytearray,
+    ) -> bytes:
+        if _CAN_SPLICE and (body.remaining_length or 0) > len(buffer):
+            body.consume_length(
+                self._splice(src_socket, dst_socket, body.remaining_length)
+            )
+            return b""
+        view = memoryview(buffer)
+        while not body.is_complete:
+            n_received = src_socket.recv_into(view, body.get_recv_size(len(buffer)))
+            if n_received == 0:
+                body.feed_eof()
+                return b""
+            n_body = body.consume(view[:n_received])
+            dst_socket.sendall(view[:n_body])
+            if n_body < n_received:
+                return bytes(view[n_body:n_received])
+        return b""
+
+    async def _relay_body_async(
+        self,
+        src_socket: socket.socket,
+        dst_socket: socket.socket,
+        body: HttpBody,
+        buffer: bytearray,
+    ) -> bytes:
+        loop = asyncio.get_running_loop()
+        view = memoryview(buffer)
+        while not body.is_complete:
+            n_received = await loop.sock_recv_into(
+                src_socket, view[: body.get_recv_size(len(buffer))]
+            )
+            if n_received == 0:
+                body.feed_eof()
+                return b""
+            n_body = body.consume(view[:n_received])
+            await loop.sock_sendall(dst_socket, view[:n_body])
+            if n_body < n_received:
+                return bytes(view[n_body:n_received])
+        return b""
+
+    def _splice(
+        self, src_socket: socket.socket, dst_socket: socket.socket, n_bytes: int
+    ) -> int:
+        pipe_read_fd, pipe_write_fd = os.pipe()
+        n_remaining_bytes = n_bytes
+        try:
+            while n_remaining_bytes > 0:
+                n_moved = os.splice(
+                    src_socket.fileno(),
+                    pipe_write_fd,
+                    min(n_remaining_bytes, _SPLICE_CHUNK_SIZE),
+                )
+                if n_moved == 0:
+                    raise HttpMessageError(
+                        "connection was closed before the message is completed"
+                    )
+                n_remaining_bytes -= n_moved
+                while n_moved > 0:
+                    n_moved -= os.splice(pipe_read_fd, dst_socket.fileno(), n_moved)
+        finally:
+            os.close(pipe_read_fd)
+            os.close(pipe_write_fd)
+        return n_bytes
+
+    def _prepare_request(
+        self, buffer: bytearray, head_end_index: int, n_filled: int
+    ) -> Tuple[HttpHead, HttpBody, bytes, bytes]:
+        request_head = HttpHead(bytes(buffer[:head_end_index]))
+        request_body = request_head.create_body()
+        body_start_index = head_end_index + _HEAD_END_SIZE
+        n_body = request_body.consume(memoryview(buffer)[body_start_index:n_filled])
+        upstream_request = (
+            request_head.rewrite()
+            + buffer[body_start_index : body_start_index + n_body]
+        )
+        # Bytes after the body are of the next pipelined request.
+        next_received = bytes(buffer[body_start_index + n_body : n_filled])
+        return request_head, request_body, upstream_request, next_received
+
+    def _parse_response_head(
+        self,
+        request_head: HttpHead,
+        buffer: bytearray,
+        received: Optional[Tuple[int, int]],
+    ) -> Tuple[HttpHead, HttpBody, int, int]:
+        if received is None:
+            raise HttpMessageError("forward server closed the connection")
+        head_end_index, n_filled = received
+        response_head = HttpHead(
+            bytes(buffer[:head_end_index]),
+            is_response=True,
+            request_method=request_head.method,
+        )
+        return (
+            response_head,
+            response_head.create_body(),
+            head_end_index + _HEAD_END_SIZE,
+            n_filled,
+        )
+
+    def _get_response_head(
+        self,
+        response_head: HttpHead,
+        rate_limit_header_lines: bytes,
+        keep_alive: bool,
+    ) -> bytes:
+        return response_head.rewrite(
+            rate_limit_header_lines
+            + (_KEEP_ALIVE_HEADER_LINE if keep_alive else _CLOSE_HEADER_LINE)
+        )
+
+    def _is_keep_alive(
+        self, request: Request, request_head: HttpHead, response_body: HttpBody
+    ) -> bool:
+        return (
+            request.keep_alive_enabled
+            and request_head.is_keep_alive
+            and response_body.is_delimited
+        )
+
+    def _sendmsg_all(self, sock: socket.socket, buffers: List[memoryview]) -> None:
+        n_sent = sock.sendmsg(buffers)
+        for buf in buffers:
+            if n_sent < len(buf):
+                sock.sendall(memoryview(buf)[n_sent:])
+                n_sent = 0
+            else:
+                n_sent -= len(buf)
+
+    def _acquire_buffer(self) -> bytearray:
+        try:
+            return self._buffers.pop()
+        except IndexError:
+            return bytearray(self._socket_buf_size)
+
+    def _fill_received(self, request: Request, buffer: bytearray) -> int:
+        n_received = len(request.received)
+        if n_received > len(buffer):
+            buffer.extend(bytes(n_received - len(buffer)))
+        buffer[:n_received] = request.received
+        request.received = b""
+        return n_received
+
+    def _ensure_free_space(self, buffer: bytearray, n_filled: int) -> None:
+        if n_filled < len(buffer):
+            return
+        if len(buffer) >= MAX_HEAD_SIZE:
+            raise HttpMessageError("too large message head")
+        buffer.extend(bytes(len(buffer)))
+
+    def _on_eof_before_head_end(self, n_filled: int) -> None:
+        if n_filled == 0:
+            return None
+        raise HttpMessageError(
+            "connection was closed before the message head is completed"
+        )
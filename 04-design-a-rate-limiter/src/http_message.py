@@ -0,0 +1,245 @@
+import asyncio
+import socket
+from typing import Dict, Optional, Tuple
+
+MAX_HEAD_SIZE = 1 << 16
+
+_CRLF = b"\r\n"
+_HEAD_END = b"\r\n\r\n"
+_HOP_BY_HOP_HEADER_NAMES = {b"connection", b"keep-alive", b"proxy-connection"}
+_MAX_LINE_SIZE = 4096
+
+
+class HttpMessageError(Exception):
+    pass
+
+
+class HttpHead:
+    def __init__(
+        self, data: bytes, is_response: bool = False, request_method: bytes = b"GET"
+    ) -> None:
+        self.data = data
+        self.is_response = is_response
+        self.request_method = request_method
+        self.status_code = 0
+        try:
+            self.start_line, self.headers = parse_head(data)
+            if is_response:
+                self.status_code = int(self.start_line.split(b" ", 2)[1])
+        except (IndexError, ValueError) as e:
+            raise HttpMessageError(f"malformed message head: {e}")
+
+    @property
+    def method(self) -> bytes:
+        return self.start_line.split(b" ", 1)[0]
+
+    @property
+    def http_version(self) -> bytes:
+        if self.is_response:
+            return self.start_line.split(b" ", 1)[0]
+        return self.start_line.rsplit(b" ", 1)[-1]
+
+    @property
+    def is_keep_alive(self) -> bool:
+        connection = self.headers.get(b"connection", b"").lower()
+        if self.http_version == b"HTTP/1.0":
+            return b"keep-alive" in connection
+        return b"close" not in connection
+
+    def create_body(self) -> "HttpBody":
+        if not self._has_body():
+            return HttpBody(content_length=0)
+        if b"chunked" in self.headers.get(b"transfer-encoding", b"").lower():
+            return HttpBody(is_chunked=True)
+        if b"content-length" in self.headers:
+            try:
+                return HttpBody(content_length=int(self.headers[b"content-length"]))
+            except ValueError:
+                raise HttpMessageError("malformed content-length")
+        if self.is_response:
+            return HttpBody()
+        return HttpBody(content_length=0)
+
+    def rewrite(self, header_lines_to_be_added: bytes = b"") -> bytes:
+        return rewrite_head(self.data, header_lines_to_be_added)
+
+    def _has_body(self) -> bool:
+        if not self.is_response:
+            return True
+        return not (
+            self.request_method == b"HEAD"
+            or 100 <= self.status_code < 200
+            or self.status_code in (204, 304)
+        )
+
+
+class HttpBody:
+    _SIZE_LINE = 0
+    _DATA = 1
+    _DATA_CRLF = 2
+    _TRAILER_LINE = 3
+
+    def __init__(
+        self, content_length: Optional[int] = None, is_chunked: bool = False
+    ) -> None:
+        self.remaining_length = content_length
+        self.is_chunked = is_chunked
+        self.is_complete = content_length == 0
+
+        self._state = self._SIZE_LINE
+        self._n_remaining_chunk_bytes = 0
+        self._line = bytearray()
+
+    @property
+    def is_delimited(self) -> bool:
+        return self.remaining_length is not None or self.is_chunked
+
+    def get_recv_size(self, buf_size: int) -> int:
+        if self.remaining_length is not None:
+            return min(self.remaining_length, buf_size)
+        return buf_size
+
+    def consume(self, view: memoryview) -> int:
+        if self.is_complete:
+            return 0
+        if self.remaining_length is not None:
+            return self.consume_length(len(view))
+        if self.is_chunked:
+            return self._consume_chunked(view)
+        return len(view)
+
+    def consume_length(self, n_bytes: int) -> int:
+        n_consumed = min(self.remaining_length, n_bytes)
+        self.remaining_length -= n_consumed
+        self.is_complete = self.remaining_length == 0
+        return n_consumed
+
+    def feed_eof(self) -> None:
+        if self.is_complete:
+            return
+        if self.is_delimited:
+            raise HttpMessageError(
+                "connection was closed before the message is completed"
+            )
+        self.is_complete = True
+
+    def _consume_chunked(self, view: memoryview) -> int:
+        i, n = 0, len(view)
+        while i < n and not self.is_complete:
+            if self._state in (self._DATA, self._DATA_CRLF):
+                n_skipped = min(self._n_remaining_chunk_bytes, n - i)
+                i += n_skipped
+                self._n_remaining_chunk_bytes -= n_skipped
+                if self._n_remaining_chunk_bytes == 0:
+                    if self._state == self._DATA:
+                        self._state = self._DATA_CRLF
+                        self._n_remaining_chunk_bytes = len(_CRLF)
+                    else:
+                        self._state = self._SIZE_LINE
+                continue
+            byte = view[i]
+            i += 1
+            self._line.append(byte)
+            if len(self._line) > _MAX_LINE_SIZE:
+                raise HttpMessageError("too long chunk line")
+            if byte != ord("\n"):
+                continue
+            line = bytes(self._line).strip()
+            self._line.clear()
+            if self._state == self._TRAILER_LINE:
+                self.is_complete = not line
+                continue
+            try:
+                chunk_size = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                raise HttpMessageError(f"malformed chunk size: {line!r}")
+            if chunk_size == 0:
+                self._state = self._TRAILER_LINE
+            else:
+                self._state = self._DATA
+                self._n_remaining_chunk_bytes = chunk_size
+        return i
+
+
+def find_head_end(buffer: bytearray, n_searched: int, n_filled: int) -> int:
+    return buffer.find(_HEAD_END, max(0, n_searched - len(_HEAD_END) + 1), n_filled)
+
+
+def recv_head(sock: socket.socket, buf_size: int, received: bytes = b"") -> bytes:
+    received = bytearray(received)
+    if find_head_end(received, 0, len(received)) != -1:
+        return bytes(received)
+    while True:
+        data = sock.recv(buf_size)
+        if _feed_head(received, data):
+            return bytes(received)
+
+
+async def recv_head_async(
+    sock: socket.socket, buf_size: int, received: bytes = b""
+) -> bytes:
+    loop = asyncio.get_running_loop()
+    received = bytearray(received)
+    if find_head_end(received, 0, len(received)) != -1:
+        return bytes(received)
+    while True:
+        data = await loop.sock_recv(sock, buf_size)
+        if _feed_head(received, data):
+            return bytes(received)
+
+
+def _feed_head(received: bytearray, data: bytes) -> bool:
+    if not data:
+        if received:
+            raise HttpMessageError(
+                "connection was closed before the message head is completed"
+            )
+        return True
+    n_searched = len(received)
+    received += data
+    if find_head_end(received, n_searched, len(received)) != -1:
+        return True
+    if len(received) >= MAX_HEAD_SIZE:
+        raise HttpMessageError("too large message head")
+    return False
+
+
+def get_n_unreceived_body_bytes(received: bytes) -> int:
+    # Counts the body bytes of the first request in received which have not arrived yet.
+    head_end_index = received.find(_HEAD_END)
+    if head_end_index == -1:
+        return 0
+    try:
+        body = HttpHead(received[:head_end_index]).create_body()
+    except HttpMessageError:
+        return 0
+    if body.remaining_length is None:
+        return 0
+    n_received_body_bytes = len(received) - head_end_index - len(_HEAD_END)
+    return max(0, body.remaining_length - n_received_body_bytes)
+
+
+def parse_request_line(head: bytes) -> Tuple[bytes, bytes]:
+    request_line_end = head.find(_CRLF)
+    request_line = head if request_line_end == -1 else head[:request_line_end]
+    method, _, rest = request_line.partition(b" ")
+    target = rest.partition(b" ")[0]
+    return method, target.partition(b"?")[0]
+
+
+def parse_head(head: bytes) -> Tuple[bytes, Dict[bytes, bytes]]:
+    lines = head.split(_CRLF)
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def rewrite_head(head: bytes, header_lines_to_be_added: bytes = b"") -> bytes:
+    lines = [
+        line
+        for line in head.split(_CRLF)
+        if line.partition(b":")[0].strip().lower() not in _HOP_BY_HOP_HEADER_NAMES
+    ]
+    return _CRLF.join(lines) + _CRLF + header_lines_to_be_added + _CRLF
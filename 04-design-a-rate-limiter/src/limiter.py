@@ -0,0 +1,129 @@
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class TokenBucketLimiter:
+    def __init__(
+        self,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        max_n_keys: int,
+        initial_capacity: int = 1024,
+    ) -> None:
+        self._token_bucket_size = token_bucket_size
+        self._n_tokens_per_second = n_tokens_per_second
+        # A bucket idle for this long is full again, same as a new one.
+        self._idle_second = token_bucket_size / n_tokens_per_second
+        self._max_n_keys = max_n_keys
+        capacity = max(1, min(initial_capacity, max_n_keys))
+        self._current_n_tokens = np.zeros(capacity, dtype=np.float64)
+        self._last_ts = np.zeros(capacity, dtype=np.float64)
+        self._key_to_slot: Dict[str, int] = {}
+        self._slot_to_key: List[Optional[str]] = [None] * capacity
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    @property
+    def n_keys(self) -> int:
+        return len(self._key_to_slot)
+
+    def allow(self, keys: Sequence[str], now: Optional[float] = None) -> List[bool]:
+        if not keys:
+            return []
+        if now is None:
+            now = time.monotonic()
+        slots = self._get_slots(keys, now)
+        unique_slots, inverse, counts = np.unique(
+            slots, return_inverse=True, return_counts=True
+        )
+        current_n_tokens = np.minimum(
+            self._current_n_tokens[unique_slots]
+            + (now - self._last_ts[unique_slots]) * self._n_tokens_per_second,
+            self._token_bucket_size,
+        )
+        # The k-th request of a key in the batch is allowed while more than k tokens are left,
+        # which is what taking them one by one gives.
+        n_available_tokens = np.floor(current_n_tokens).astype(np.intp)
+        order = np.argsort(inverse, kind="stable")
+        group_starts = np.cumsum(counts) - counts
+        ranks = np.empty(len(keys), dtype=np.intp)
+        ranks[order] = np.arange(len(keys)) - np.repeat(group_starts, counts)
+        allowed = ranks < n_available_tokens[inverse]
+        self._current_n_tokens[unique_slots] = current_n_tokens - np.minimum(
+            counts, n_available_tokens
+        )
+        self._last_ts[unique_slots] = now
+        return allowed.tolist()
+
+    def get_current_n_tokens(
+        self, keys: Sequence[str], now: Optional[float] = None
+    ) -> List[float]:
+        if now is None:
+            now = time.monotonic()
+        n_tokens = np.full(len(keys), self._token_bucket_size, dtype=np.float64)
+        positions = [i for i, key in enumerate(keys) if key in self._key_to_slot]
+        if positions:
+            slots = np.array([self._key_to_slot[keys[i]] for i in positions])
+            n_tokens[positions] = np.minimum(
+                self._current_n_tokens[slots]
+                + (now - self._last_ts[slots]) * self._n_tokens_per_second,
+                self._token_bucket_size,
+            )
+        return n_tokens.tolist()
+
+    def _get_slots(self, keys: Sequence[str], now: float) -> np.ndarray:
+        key_to_slot = self._key_to_slot
+        new_keys = [key for key in dict.fromkeys(keys) if key not in key_to_slot]
+        if new_keys:
+            if len(new_keys) > len(self._free_slots):
+                self._make_free_slots(len(new_keys), keys, now)
+            for key in new_keys:
+                slot = self._free_slots.pop()
+                key_to_slot[key] = slot
+                self._slot_to_key[slot] = key
+                self._current_n_tokens[slot] = self._token_bucket_size
+                self._last_ts[slot] = now
+        return np.fromiter(
+            (key_to_slot[key] for key in keys), dtype=np.intp, count=len(keys)
+        )
+
+    def _make_free_slots(self, n_slots: int, keys: Sequence[str], now: float) -> None:
+        capacity = len(self._slot_to_key)
+        if capacity < self._max_n_keys:
+            self._grow(min(max(capacity * 2, self.n_keys + n_slots), self._max_n_keys))
+        n_missing_slots = n_slots - len(self._free_slots)
+        if n_missing_slots <= 0:
+            return
+        capacity = len(self._slot_to_key)
+        # Slots of the keys in the batch must not be handed to other keys of it.
+        is_evictable = np.fromiter(
+            (key is not None for key in self._slot_to_key), dtype=bool, count=capacity
+        )
+        is_evictable[
+            [self._key_to_slot[key] for key in keys if key in self._key_to_slot]
+        ] = False
+        if n_missing_slots > np.count_nonzero(is_evictable):
+            raise ValueError(f"more than {self._max_n_keys} keys in a batch")
+        evicted_slots = np.flatnonzero(
+            is_evictable & (self._last_ts <= now - self._idle_second)
+        )
+        if len(evicted_slots) < n_missing_slots:
+            # Evict the least recently used eighth of the table at once
+            # so that the sweep is not repeated for every new key.
+            n_evicted = min(
+                max(n_missing_slots, capacity // 8), np.count_nonzero(is_evictable)
+            )
+            last_ts = np.where(is_evictable, self._last_ts, np.inf)
+            evicted_slots = np.argpartition(last_ts, n_evicted - 1)[:n_evicted]
+        for slot in evicted_slots.tolist():
+            del self._key_to_slot[self._slot_to_key[slot]]
+            self._slot_to_key[slot] = None
+            self._free_slots.append(slot)
+
+    def _grow(self, capacity: int) -> None:
+        old_capacity = len(self._slot_to_key)
+        self._current_n_tokens = np.resize(self._current_n_tokens, capacity)
+        self._last_ts = np.resize(self._last_ts, capacity)
+        self._slot_to_key.extend([None] * (capacity - old_capacity))
+        self._free_slots.extend(range(capacity - 1, old_capacity - 1, -1))
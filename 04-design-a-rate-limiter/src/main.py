@@ -1,10 +1,15 @@
 import argparse
 import logging
+import multiprocessing
 import signal
+from typing import Optional
 
+from src.admin_server import AdminServer
 from src.config_manager import ConfigManager
 from src.core import GracefulExit
-from src.server import Server
+from src.rate_limit_algorithms.storages.shared_memory import SharedMemoryTable
+from src.server import AsyncServer, Server
+from src.snapshotter import Snapshotter
 from src.util import setup_logger
 
 parser = argparse.ArgumentParser()
@@ -15,6 +20,44 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--port", metavar="", help="port for listening", default="8000"
 )
+parser.add_argument(
+    "-m",
+    "--server-mode",
+    metavar="",
+    help="server mode (blocking or asyncio)",
+    choices=["blocking", "asyncio"],
+    default="blocking",
+)
+parser.add_argument(
+    "-w",
+    "--n-workers",
+    metavar="",
+    help="number of worker processes",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "-a",
+    "--admin-port",
+    metavar="",
+    help="port for listening admin requests such as /metrics. disabled if not given. worker i listens on this port + i",
+    type=int,
+    default=None,
+)
+parser.add_argument(
+    "-s",
+    "--snapshot-path",
+    metavar="",
+    help="file path of the snapshot of the rate limit states, loaded on start and saved periodically and on shutdown. disabled if not given",
+    default=None,
+)
+parser.add_argument(
+    "--snapshot-interval-second",
+    metavar="",
+    help="interval of saving the snapshot",
+    type=float,
+    default=60,
+)
 parser.add_argument(
     "-f",
     "--log-format",
@@ -34,19 +77,95 @@ logger = logging.getLogger()
 def _register_gracefully_exit_handler() -> None:
     def raise_graceful_exit(*args):
         logger.debug("got shutdown signal")
+        # Workers may get both the signal sent to the process group and the one
+        # forwarded by the main process. Shut down only once.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         raise GracefulExit()
 
     signal.signal(signal.SIGINT, raise_graceful_exit)
     signal.signal(signal.SIGTERM, raise_graceful_exit)
 
 
-if __name__ == "__main__":
-    _register_gracefully_exit_handler()
+def _run_server(
+    shared_memory_table: Optional[SharedMemoryTable] = None,
+    worker_index: int = 0,
+) -> None:
+    admin_server = None
+    if args.admin_port is not None:
+        admin_server = AdminServer(
+            args.hostname,
+            args.admin_port + worker_index,
+            labels=f'worker="{worker_index}"' if args.n_workers > 1 else "",
+        )
+        admin_server.start()
     config_manager = ConfigManager(args.config)
     config_manager.start()
-    server = Server(args.hostname, args.port, config_manager)
+    server_class = AsyncServer if args.server_mode == "asyncio" else Server
+    # Workers share the table, whose snapshot is taken by the main process.
+    snapshot_path = args.snapshot_path if shared_memory_table is None else None
+    server = server_class(
+        args.hostname,
+        args.port,
+        config_manager,
+        reuse_port=args.n_workers > 1,
+        shared_memory_table=shared_memory_table,
+        snapshot_path=snapshot_path,
+    )
+    snapshotter = None
+    if snapshot_path:
+        snapshotter = Snapshotter(server.save_snapshot, args.snapshot_interval_second)
+        snapshotter.start()
     try:
         server.run()
     finally:
+        if snapshotter:
+            snapshotter.stop()
         config_manager.stop()
+        if admin_server:
+            admin_server.stop()
+
+
+def _run_workers() -> None:
+    config = ConfigManager(args.config).get_config()
+    shared_memory_table = SharedMemoryTable(config.token_bucket.max_n_token_buckets)
+    snapshotter = None
+    if args.snapshot_path:
+        shared_memory_table.load_snapshot(args.snapshot_path)
+        snapshotter = Snapshotter(
+            lambda: shared_memory_table.save_snapshot(args.snapshot_path),
+            args.snapshot_interval_second,
+        )
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(
+            target=_run_server, args=(shared_memory_table, i), name=f"worker-{i}"
+        )
+        for i in range(args.n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info(f"started {args.n_workers} workers")
+    if snapshotter:
+        snapshotter.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except GracefulExit:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+    finally:
+        if snapshotter:
+            snapshotter.stop()
+
+
+if __name__ == "__main__":
+    _register_gracefully_exit_handler()
+    if args.n_workers > 1:
+        _run_workers()
+    else:
+        _run_server()
     logger.info("good bye!")
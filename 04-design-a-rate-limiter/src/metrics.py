@@ -0,0 +1,133 @@
+import time
+from array import array
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.core import Singleton
+
+DEFAULT_RULE_NAME = "default"
+
+_LATENCY_BUCKET_SECONDS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    __slots__ = ("bucket_bounds", "bucket_counts", "sum", "count")
+
+    def __init__(
+        self, bucket_bounds: Tuple[float, ...] = _LATENCY_BUCKET_SECONDS
+    ) -> None:
+        self.bucket_bounds = bucket_bounds
+        # The last bucket counts values greater than every bound.
+        self.bucket_counts = array("Q", bytes(8 * (len(bucket_bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.bucket_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_since(self, started: float) -> None:
+        self.observe(time.perf_counter() - started)
+
+    def render(self, name: str, labels: str = "") -> List[str]:
+        lines = []
+        n_cumulated = 0
+        separator = "," if labels else ""
+        for bound, n in zip(self.bucket_bounds, self.bucket_counts):
+            n_cumulated += n
+            lines.append(
+                f'{name}_bucket{{{labels}{separator}le="{bound}"}} {n_cumulated}'
+            )
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        label_set = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{label_set} {self.sum}")
+        lines.append(f"{name}_count{label_set} {self.count}")
+        return lines
+
+
+class RuleMetrics:
+    def __init__(self) -> None:
+        self.n_allowed_requests = 0
+        self.n_throttled_requests = 0
+        self.decision_second = Histogram()
+        self.get_n_keys: Optional[Callable[[], Optional[int]]] = None
+        self.get_n_queued_requests: Optional[Callable[[], int]] = None
+
+    def observe_decision(self, is_allowed: bool, started: float) -> None:
+        self.decision_second.observe(time.perf_counter() - started)
+        if is_allowed:
+            self.n_allowed_requests += 1
+        else:
+            self.n_throttled_requests += 1
+
+
+class Metrics(metaclass=Singleton):
+    def __init__(self) -> None:
+        self.upstream_connect_second = Histogram()
+        self.upstream_response_second = Histogram()
+        self._rule_name_to_rule_metrics: Dict[str, RuleMetrics] = {}
+
+    def get_rule_metrics(self, rule_name: str = DEFAULT_RULE_NAME) -> RuleMetrics:
+        rule_metrics = self._rule_name_to_rule_metrics.get(rule_name)
+        if rule_metrics is None:
+            rule_metrics = RuleMetrics()
+            self._rule_name_to_rule_metrics[rule_name] = rule_metrics
+        return rule_metrics
+
+    def render(self, labels: str = "") -> bytes:
+        separator = "," if labels else ""
+        rule_labels_and_metrics = [
+            (f'{labels}{separator}rule="{rule_name}"', rule_metrics)
+            for rule_name, rule_metrics in list(self._rule_name_to_rule_metrics.items())
+        ]
+        lines = ["# TYPE rate_limiter_requests_total counter"]
+        for rule_labels, rule_metrics in rule_labels_and_metrics:
+            lines.append(
+                f'rate_limiter_requests_total{{{rule_labels},result="allowed"}} {rule_metrics.n_allowed_requests}'
+            )
+            lines.append(
+                f'rate_limiter_requests_total{{{rule_labels},result="throttled"}} {rule_metrics.n_throttled_requests}'
+            )
+        lines.append("# TYPE rate_limiter_decision_seconds histogram")
+        for rule_labels, rule_metrics in rule_labels_and_metrics:
+            lines.extend(
+                rule_metrics.decision_second.render(
+                    "rate_limiter_decision_seconds", rule_labels
+                )
+            )
+        lines.append("# TYPE rate_limiter_active_keys gauge")
+        for rule_labels, rule_metrics in rule_labels_and_metrics:
+            n_keys = rule_metrics.get_n_keys() if rule_metrics.get_n_keys else None
+            if n_keys is not None:
+                lines.append(f"rate_limiter_active_keys{{{rule_labels}}} {n_keys}")
+        lines.append("# TYPE rate_limiter_queued_requests gauge")
+        for rule_labels, rule_metrics in rule_labels_and_metrics:
+            if rule_metrics.get_n_queued_requests:
+                lines.append(
+                    f"rate_limiter_queued_requests{{{rule_labels}}} {rule_metrics.get_n_queued_requests()}"
+                )
+        for name, histogram in (
+            ("rate_limiter_upstream_connect_seconds", self.upstream_connect_second),
+            ("rate_limiter_upstream_response_seconds", self.upstream_response_second),
+        ):
+            lines.append(f"# TYPE {name} histogram")
+            lines.extend(histogram.render(name, labels))
+        return ("\n".join(lines) + "\n").encode("utf-8")
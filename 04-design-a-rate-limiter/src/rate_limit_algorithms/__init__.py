@@ -1,6 +1,16 @@
 import abc
+import asyncio
+import logging
+import socket
+import time
 
 from src.core import Request
+from src.forwarder import Forwarder
+from src.http_message import get_n_unreceived_body_bytes
+from src.responses import ResponseTemplates
+
+_DRAIN_TIMEOUT_SECOND = 0.1
+_MAX_N_DRAINED_BYTES = 1 << 16
 
 
 class RateLimitAlgorithm(abc.ABC):
@@ -12,6 +22,188 @@ class RateLimitAlgorithm(abc.ABC):
     def handle(self, request: Request) -> None:
         pass
 
+    @abc.abstractmethod
+    async def handle_async(self, request: Request) -> None:
+        pass
+
     @abc.abstractmethod
     def teardown(self) -> None:
         pass
+
+    def take_over(self, rate_limit_algorithm: "RateLimitAlgorithm") -> None:
+        pass
+
+    def save_snapshot(self, path: str) -> None:
+        pass
+
+    def load_snapshot(self, path: str) -> None:
+        pass
+
+
+class ForwardingRateLimitAlgorithm(RateLimitAlgorithm):
+    def __init__(
+        self,
+        limit: int,
+        retry_after_second: float,
+        socket_buf_size: int,
+        forward_host: str,
+        forward_port: str,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+    ) -> None:
+        self._socket_buf_size = socket_buf_size
+        self._forwarder = Forwarder(
+            forward_host=forward_host,
+            forward_port=forward_port,
+            socket_buf_size=socket_buf_size,
+            upstream_pool_size=upstream_pool_size,
+            upstream_idle_timeout_second=upstream_idle_timeout_second,
+        )
+        self._response_templates = ResponseTemplates(
+            limit=limit,
+            retry_after_second=retry_after_second,
+            forward_address=self._forwarder.forward_address,
+        )
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _forward_request(self, request: Request, n_remaining: int) -> None:
+        try:
+            self._forwarder.forward(
+                request,
+                self._response_templates.get_rate_limit_header_lines(n_remaining),
+            )
+        except ConnectionRefusedError:
+            request.keep_alive = False
+            self._logger.error(
+                "send failure response to client %s", request.client_address
+            )
+            request.client_socket.send(
+                self._response_templates.connection_refused_response
+            )
+        finally:
+            if not request.keep_alive:
+                request.client_socket.close()
+
+    async def _forward_request_async(self, request: Request, n_remaining: int) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await self._forwarder.forward_async(
+                request,
+                self._response_templates.get_rate_limit_header_lines(n_remaining),
+            )
+        except ConnectionRefusedError:
+            request.keep_alive = False
+            self._logger.error(
+                "send failure response to client %s", request.client_address
+            )
+            await loop.sock_sendall(
+                request.client_socket,
+                self._response_templates.connection_refused_response,
+            )
+        finally:
+            if not request.keep_alive:
+                request.client_socket.close()
+
+    def _respond_with_failure(self, request: Request) -> None:
+        self._respond_and_close(
+            request, self._response_templates.too_many_requests_response
+        )
+
+    async def _respond_with_failure_async(self, request: Request) -> None:
+        await self._respond_and_close_async(
+            request, self._response_templates.too_many_requests_response
+        )
+
+    def _respond_with_storage_error(self, request: Request) -> None:
+        self._respond_and_close(
+            request, self._response_templates.storage_error_response
+        )
+
+    async def _respond_with_storage_error_async(self, request: Request) -> None:
+        await self._respond_and_close_async(
+            request, self._response_templates.storage_error_response
+        )
+
+    def _respond_and_close(self, request: Request, response: bytes) -> None:
+        try:
+            self._logger.info(
+                "send failure response to client %s", request.client_address
+            )
+            request.client_socket.sendall(response)
+            self._drain(request)
+        finally:
+            request.client_socket.close()
+
+    async def _respond_and_close_async(self, request: Request, response: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            self._logger.info(
+                "send failure response to client %s", request.client_address
+            )
+            await loop.sock_sendall(request.client_socket, response)
+            await self._drain_async(request)
+        finally:
+            request.client_socket.close()
+
+    # Closing a socket with unread data resets the connection, and the client may lose the response.
+    # So what has arrived is read, and the rest of the body is waited for only as long as
+    # its Content-Length is known, since this runs in the accept loop in blocking mode.
+    def _drain(self, request: Request) -> None:
+        client_socket = request.client_socket
+        try:
+            client_socket.shutdown(socket.SHUT_WR)
+            n_unread_bytes = self._drain_arrived_bytes(request)
+            deadline = time.monotonic() + _DRAIN_TIMEOUT_SECOND
+            while n_unread_bytes > 0:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return
+                client_socket.settimeout(timeout)
+                data = client_socket.recv(min(n_unread_bytes, self._socket_buf_size))
+                if not data:
+                    return
+                n_unread_bytes -= len(data)
+        except OSError:
+            pass
+
+    async def _drain_async(self, request: Request) -> None:
+        loop = asyncio.get_running_loop()
+        client_socket = request.client_socket
+
+        async def recv_unread_bytes(n_unread_bytes: int) -> None:
+            while n_unread_bytes > 0:
+                data = await loop.sock_recv(
+                    client_socket, min(n_unread_bytes, self._socket_buf_size)
+                )
+                if not data:
+                    return
+                n_unread_bytes -= len(data)
+
+        try:
+            client_socket.shutdown(socket.SHUT_WR)
+            await asyncio.wait_for(
+                recv_unread_bytes(self._drain_arrived_bytes(request)),
+                timeout=_DRAIN_TIMEOUT_SECOND,
+            )
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    def _drain_arrived_bytes(self, request: Request) -> int:
+        # Returns how many bytes of the body are still to come.
+        received = bytearray(request.received)
+        n_drained_bytes = 0
+        while n_drained_bytes < _MAX_N_DRAINED_BYTES:
+            try:
+                data = request.client_socket.recv(
+                    self._socket_buf_size, socket.MSG_DONTWAIT
+                )
+            except BlockingIOError:
+                break
+            if not data:
+                return 0
+            n_drained_bytes += len(data)
+            received += data
+        return min(
+            get_n_unreceived_body_bytes(bytes(received)),
+            _MAX_N_DRAINED_BYTES - n_drained_bytes,
+        )
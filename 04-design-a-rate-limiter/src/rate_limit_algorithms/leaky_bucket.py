@@ -1,262 +1,419 @@
+import asyncio
+import heapq
 import logging
-import queue
-import socket
 import threading
 import time
-from typing import Dict, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 from src.core import Request
-from src.rate_limit_algorithms import RateLimitAlgorithm
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms import ForwardingRateLimitAlgorithm, RateLimitAlgorithm
 
+_QueuedRequest = Tuple[Request, Optional[asyncio.Future]]
 
-class _RequestProcessor(threading.Thread):
+
+class _RequestQueues:
     def __init__(
         self,
-        client_ip: str,
-        periodic_second: int,
+        periodic_second: float,
         n_request_to_be_processed_per_periodic_second: int,
-        request_queue: queue.Queue,
-        socket_buf_size: int,
-        forward_host: str,
-        forward_port: str,
+        request_queue_size: int,
     ) -> None:
-        super().__init__()
-        self.has_been_started = False
-        self.is_stop = False
-
-        self._client_ip = client_ip
         self._periodic_second = periodic_second
         self._n_request_to_be_processed_per_periodic_second = (
             n_request_to_be_processed_per_periodic_second
         )
-        self._request_queue = request_queue
-        self._socket_buf_size = socket_buf_size
-        self._forward_host = forward_host
-        self._forward_port = forward_port
-        self._last_ts = int(time.time())
-        self._idle_threshold_second = 60
-        self._logger = logging.getLogger(
-            f"{self.__class__.__name__} ({self._client_ip})"
+        self._request_queue_size = request_queue_size
+        self._client_ip_to_request_queue: Dict[str, Deque[_QueuedRequest]] = {}
+        self._drain_deadlines: List[Tuple[float, str]] = []
+        self.n_queued_requests = 0
+
+    @property
+    def n_client_ips(self) -> int:
+        return len(self._client_ip_to_request_queue)
+
+    @property
+    def next_drain_deadline(self) -> Optional[float]:
+        return self._drain_deadlines[0][0] if self._drain_deadlines else None
+
+    def qsize(self, client_ip: str) -> int:
+        return len(self._client_ip_to_request_queue.get(client_ip, ()))
+
+    def put(self, queued_request: _QueuedRequest, now: float) -> bool:
+        client_ip = queued_request[0].rate_limit_key
+        request_queue = self._client_ip_to_request_queue.get(client_ip)
+        if request_queue is None:
+            request_queue = deque()
+            self._client_ip_to_request_queue[client_ip] = request_queue
+            heapq.heappush(self._drain_deadlines, (now, client_ip))
+        if len(request_queue) >= self._request_queue_size:
+            return False
+        request_queue.append(queued_request)
+        self.n_queued_requests += 1
+        return True
+
+    def pop_due(self, now: float) -> List[Tuple[_QueuedRequest, int]]:
+        due_requests = []
+        while self._drain_deadlines and self._drain_deadlines[0][0] <= now:
+            _, client_ip = heapq.heappop(self._drain_deadlines)
+            request_queue = self._client_ip_to_request_queue[client_ip]
+            if not request_queue:
+                del self._client_ip_to_request_queue[client_ip]
+                continue
+            for _ in range(
+                min(
+                    self._n_request_to_be_processed_per_periodic_second,
+                    len(request_queue),
+                )
+            ):
+                due_requests.append(
+                    (
+                        request_queue.popleft(),
+                        max(0, self._request_queue_size - len(request_queue)),
+                    )
+                )
+            heapq.heappush(
+                self._drain_deadlines, (now + self._periodic_second, client_ip)
+            )
+        self.n_queued_requests -= len(due_requests)
+        return due_requests
+
+    def clear(self) -> List[_QueuedRequest]:
+        queued_requests = [
+            queued_request
+            for request_queue in self._client_ip_to_request_queue.values()
+            for queued_request in request_queue
+        ]
+        self._client_ip_to_request_queue.clear()
+        self._drain_deadlines.clear()
+        self.n_queued_requests = 0
+        return queued_requests
+
+    def take_over(self, request_queues: "_RequestQueues") -> None:
+        # New parameters are applied to each queue when it is drained next time.
+        self._client_ip_to_request_queue = request_queues._client_ip_to_request_queue
+        self._drain_deadlines = request_queues._drain_deadlines
+        self.n_queued_requests = request_queues.n_queued_requests
+        request_queues._client_ip_to_request_queue = {}
+        request_queues._drain_deadlines = []
+        request_queues.n_queued_requests = 0
+
+
+class _RequestProcessor(threading.Thread):
+    def __init__(
+        self,
+        request_queues: _RequestQueues,
+        n_workers: int,
+        forward_request,
+    ) -> None:
+        super().__init__(daemon=True)
+        self.is_stop = False
+
+        self._request_queues = request_queues
+        self._forward_request = forward_request
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=n_workers, thread_name_prefix=self.__class__.__name__
         )
+        self._logger = logging.getLogger(self.__class__.__name__)
 
     @property
-    def current_n_requests(self) -> int:
-        return self._request_queue.qsize()
+    def request_queues(self) -> _RequestQueues:
+        return self._request_queues
+
+    def put(self, request: Request) -> bool:
+        with self._condition:
+            next_drain_deadline = self._request_queues.next_drain_deadline
+            if not self._request_queues.put((request, None), time.monotonic()):
+                return False
+            if next_drain_deadline != self._request_queues.next_drain_deadline:
+                self._condition.notify()
+            return True
+
+    def qsize(self, client_ip: str) -> int:
+        with self._condition:
+            return self._request_queues.qsize(client_ip)
 
     def run(self) -> None:
-        self.has_been_started = True
-        while not self.is_stop:
-            count = min(
-                self._n_request_to_be_processed_per_periodic_second,
-                self._request_queue.qsize(),
-            )
-            if count == 0:
-                current_ts = int(time.time())
-                if current_ts - self._last_ts >= self._idle_threshold_second:
+        with self._condition:
+            while not self.is_stop:
+                due_requests = self._request_queues.pop_due(time.monotonic())
+                if due_requests:
                     self._logger.debug(
-                        f"queue is empty during {current_ts - self._last_ts}s. stop the loop"
+                        "process %s requests in queues of %s client ips",
+                        len(due_requests),
+                        self._request_queues.n_client_ips,
                     )
-                    self.is_stop = True
-            else:
-                self._logger.info(
-                    f"process requests in queue. current [# of requests / queue size] in queue is [{count}/{self._request_queue.maxsize}]"
+                for (request, _), n_remaining in due_requests:
+                    self._executor.submit(self._forward_request, request, n_remaining)
+                next_drain_deadline = self._request_queues.next_drain_deadline
+                self._condition.wait(
+                    None
+                    if next_drain_deadline is None
+                    else max(0.0, next_drain_deadline - time.monotonic())
                 )
-                for i in range(1, count + 1):
-                    request: Request = self._request_queue.get_nowait()
-                    self._logger.info(
-                        f"process request of {request.client_address} in queue [{i}/{count}]"
-                    )
-                    self._forward_request(request)
-                self._last_ts = int(time.time())
-            time.sleep(self._periodic_second)
         self._logger.debug("will be terminated.")
 
+    def hand_over(self, request_processor: "_RequestProcessor") -> None:
+        with self._condition:
+            if self.is_stop:
+                return
+            self.is_stop = True
+            self._condition.notify()
+            with request_processor._condition:
+                request_processor._request_queues.take_over(self._request_queues)
+                request_processor._condition.notify()
+        self.join()
+        # Requests which have been dequeued already are still forwarded.
+        self._executor.shutdown(wait=False)
+
     def stop(self) -> None:
-        self.is_stop = True
+        with self._condition:
+            if self.is_stop:
+                return
+            self.is_stop = True
+            self._condition.notify()
+            queued_requests = self._request_queues.clear()
+        self.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for request, _ in queued_requests:
+            request.client_socket.close()
 
-    def _forward_request(self, request: Request) -> None:
-        try:
-            with socket.socket() as forward_socket:
-                data = request.client_socket.recv(self._socket_buf_size)
-                self._logger.debug(
-                    f"start to connect forward server {self._forward_host}:{self._forward_port}"
-                )
-                forward_socket.connect((self._forward_host, self._forward_port))
-                self._logger.debug(
-                    f"send data to forward server {self._forward_host}:{self._forward_port}"
-                )
-                forward_socket.send(data)
-                data = forward_socket.recv(self._socket_buf_size)
-                decoded_data = data.decode()
-                self._logger.debug(
-                    f"got data from forward server {self._forward_host}:{self._forward_port}"
-                )
-            decoded_data_blocks = decoded_data.split("\r\n\r\n")
-            decoded_data_blocks[0] = (
-                decoded_data_blocks[0]
-                + "\r\n"
-                + "\r\n".join(
-                    f"{k}: {v}"
-                    for k, v in {
-                        "X-Ratelimit-Remaining": self._request_queue.maxsize
-                        - self._request_queue.qsize(),
-                        "X-Ratelimit-Limit": self._request_queue.maxsize,
-                        "X-Ratelimit-Retry-After": self._periodic_second,
-                    }.items()
-                )
-            )
-            decoded_data = "\r\n\r\n".join(decoded_data_blocks)
-            data = decoded_data.encode("utf-8")
-            self._logger.debug(f"send data to client {request.client_address}")
-            request.client_socket.send(data)
-        except ConnectionRefusedError:
-            content = f"Connection was refused. Make sure the forward server is running on {self._forward_host}:{self._forward_port}"
-            header = "\n".join(
-                [
-                    "HTTP/1.1 429 Too many requests",
-                    "\r\n".join(
-                        f"{k}: {v}"
-                        for k, v in {
-                            "Content-Type": "text/plan; encoding=utf8",
-                            "Content-Length": len(content),
-                            "Connection": "close",
-                            "X-Ratelimit-Remaining": 0,
-                            "X-Ratelimit-Limit": self._request_queue.qsize(),
-                            "X-Ratelimit-Retry-After": self._periodic_second,
-                        }.items()
-                    ),
-                ]
-            )
-            data = "\n\n".join([header, content])
+
+class _AsyncRequestProcessor:
+    def __init__(self, request_queues: _RequestQueues, forward_request_async) -> None:
+        self._request_queues = request_queues
+        self._forward_request_async = forward_request_async
+        self._loop = asyncio.get_running_loop()
+        self._drain_timer: Optional[asyncio.TimerHandle] = None
+        self._forward_tasks: Set[asyncio.Task] = set()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def request_queues(self) -> _RequestQueues:
+        return self._request_queues
+
+    def put(self, request: Request, is_processed: asyncio.Future) -> bool:
+        if not self._request_queues.put((request, is_processed), self._loop.time()):
+            return False
+        self._schedule_drain()
+        return True
+
+    def qsize(self, client_ip: str) -> int:
+        return self._request_queues.qsize(client_ip)
+
+    def hand_over(self, request_processor: "_AsyncRequestProcessor") -> None:
+        if self._drain_timer:
+            self._drain_timer.cancel()
+            self._drain_timer = None
+        request_processor._request_queues.take_over(self._request_queues)
+        for forward_task in self._forward_tasks:
+            forward_task.remove_done_callback(self._forward_tasks.discard)
+            forward_task.add_done_callback(request_processor._forward_tasks.discard)
+        request_processor._forward_tasks |= self._forward_tasks
+        self._forward_tasks = set()
+        request_processor._schedule_drain()
+
+    def stop(self) -> None:
+        if self._drain_timer:
+            self._drain_timer.cancel()
+        for forward_task in self._forward_tasks:
+            forward_task.cancel()
+        for request, is_processed in self._request_queues.clear():
+            is_processed.cancel()
+            request.client_socket.close()
+
+    def _drain(self) -> None:
+        self._drain_timer = None
+        due_requests = self._request_queues.pop_due(self._loop.time())
+        if due_requests:
             self._logger.debug(
-                f"send failure response to client {request.client_address}"
+                "process %s requests in queues of %s client ips",
+                len(due_requests),
+                self._request_queues.n_client_ips,
             )
-            request.client_socket.send(data.encode("utf-8"))
-        finally:
-            request.client_socket.close()
+        for (request, is_processed), n_remaining in due_requests:
+            forward_task = self._loop.create_task(
+                self._forward_request_async(request, n_remaining, is_processed)
+            )
+            self._forward_tasks.add(forward_task)
+            forward_task.add_done_callback(self._forward_tasks.discard)
+        self._schedule_drain()
 
+    def _schedule_drain(self) -> None:
+        next_drain_deadline = self._request_queues.next_drain_deadline
+        if next_drain_deadline is None:
+            return
+        if self._drain_timer:
+            if self._drain_timer.when() <= next_drain_deadline:
+                return
+            self._drain_timer.cancel()
+        self._drain_timer = self._loop.call_at(next_drain_deadline, self._drain)
 
-class LeakyBucketAlgorithm(RateLimitAlgorithm):
+
+class LeakyBucketAlgorithm(ForwardingRateLimitAlgorithm):
     def __init__(
         self,
         periodic_second: int,
         n_request_to_be_processed_per_periodic_second: int,
         request_queue_size: int,
+        n_workers: int,
         socket_buf_size: int,
         forward_host: str,
         forward_port: str,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+        rule_metrics: RuleMetrics,
     ) -> None:
         self._periodic_second = periodic_second
         self._n_request_to_be_processed_per_periodic_second = (
             n_request_to_be_processed_per_periodic_second
         )
         self._request_queue_size = request_queue_size
-        self._socket_buf_size = socket_buf_size
-        self._forward_host = forward_host
-        self._forward_port = forward_port
-        self._client_ip_to_request_processor_and_request_queue: Dict[
-            str, Tuple[_RequestProcessor, queue.Queue]
-        ] = {}
-        self._logger = logging.getLogger(self.__class__.__name__)
+        self._n_workers = n_workers
+        super().__init__(
+            limit=self._request_queue_size,
+            retry_after_second=self._periodic_second,
+            socket_buf_size=socket_buf_size,
+            forward_host=forward_host,
+            forward_port=forward_port,
+            upstream_pool_size=upstream_pool_size,
+            upstream_idle_timeout_second=upstream_idle_timeout_second,
+        )
+        self._request_processor: Optional[_RequestProcessor] = None
+        self._async_request_processor: Optional[_AsyncRequestProcessor] = None
+        self._rule_metrics = rule_metrics
 
     def setup(self) -> None:
-        pass
+        self._rule_metrics.get_n_keys = self._get_n_client_ips
+        self._rule_metrics.get_n_queued_requests = self._get_n_queued_requests
 
     def teardown(self) -> None:
-        for i, (client_ip, (request_processor, request_queue)) in enumerate(
-            self._client_ip_to_request_processor_and_request_queue.items(), 1
-        ):
-            self._logger.debug(
-                f"wait for _RequestProcessor and Queue of {client_ip} to be terminated [{i}/{len(self._client_ip_to_request_processor_and_request_queue)}]"
-            )
-            request_processor.stop()
-            request_processor.join()
-            del request_queue
+        if self._request_processor:
+            self._logger.debug("wait for _RequestProcessor to be terminated")
+            self._request_processor.stop()
+        if self._async_request_processor:
+            self._logger.debug("stop _AsyncRequestProcessor")
+            self._async_request_processor.stop()
+        self._forwarder.close()
 
     def handle(self, request: Request) -> None:
-        self._logger.debug(f"handle request of {request.client_address}")
-        request_processor_and_request_queue = (
-            self._client_ip_to_request_processor_and_request_queue.get(
-                request.client_ip, None
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        if not self._request_processor:
+            self._logger.debug("_RequestProcessor has not been started yet. start it")
+            self._request_processor = self._create_request_processor()
+        is_put = self._request_processor.put(request)
+        self._rule_metrics.observe_decision(is_put, started)
+        if is_put:
+            self._logger.info(
+                "request from %s has been added to queue. current [# of requests / queue_size] in queue is [%s/%s]",
+                request.client_address,
+                self._request_processor.qsize(request.rate_limit_key),
+                self._request_queue_size,
             )
+            return
+        self._logger.info(
+            "reqeust queue is full. request from %s has not been added to queue",
+            request.client_address,
         )
-        if not request_processor_and_request_queue:
-            self._logger.debug(
-                f"_RequestProcessor for {request.client_ip} has not been created yet. create thread"
-            )
-            request_queue = queue.Queue(self._request_queue_size)
-            request_processor = _RequestProcessor(
-                client_ip=request.client_ip,
-                periodic_second=self._periodic_second,
-                n_request_to_be_processed_per_periodic_second=self._n_request_to_be_processed_per_periodic_second,
-                request_queue=request_queue,
-                socket_buf_size=self._socket_buf_size,
-                forward_host=self._forward_host,
-                forward_port=self._forward_port,
+        self._respond_with_failure(request)
+
+    async def handle_async(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        if not self._async_request_processor:
+            self._async_request_processor = self._create_async_request_processor()
+        is_processed = asyncio.get_running_loop().create_future()
+        is_put = self._async_request_processor.put(request, is_processed)
+        self._rule_metrics.observe_decision(is_put, started)
+        if is_put:
+            self._logger.info(
+                "request from %s has been added to queue. current [# of requests / queue_size] in queue is [%s/%s]",
+                request.client_address,
+                self._async_request_processor.qsize(request.rate_limit_key),
+                self._request_queue_size,
             )
-            self._client_ip_to_request_processor_and_request_queue[
-                request.client_ip
-            ] = (request_processor, request_queue)
-        else:
-            request_processor, request_queue = request_processor_and_request_queue
-        if not request_processor.has_been_started:
-            self._logger.debug(
-                f"_RequestProcessor for {request.client_ip} has not been started yet. start the thread"
+            await is_processed
+            return
+        self._logger.info(
+            "reqeust queue is full. request from %s has not been added to queue",
+            request.client_address,
+        )
+        await self._respond_with_failure_async(request)
+
+    def take_over(self, rate_limit_algorithm: RateLimitAlgorithm) -> None:
+        if not isinstance(rate_limit_algorithm, LeakyBucketAlgorithm):
+            return
+        if rate_limit_algorithm._request_processor:
+            self._request_processor = self._create_request_processor()
+            rate_limit_algorithm._request_processor.hand_over(self._request_processor)
+        if rate_limit_algorithm._async_request_processor:
+            self._async_request_processor = self._create_async_request_processor()
+            rate_limit_algorithm._async_request_processor.hand_over(
+                self._async_request_processor
             )
-            request_processor.start()
-        if request_processor.is_stop:
-            self._logger.debug(
-                f"_RequestProcessor for {request.client_ip} has been stop. create and start new thread"
+
+    def _get_n_client_ips(self) -> int:
+        return sum(
+            request_processor.request_queues.n_client_ips
+            for request_processor in (
+                self._request_processor,
+                self._async_request_processor,
             )
-            request_processor = _RequestProcessor(
-                client_ip=request.client_ip,
-                periodic_second=self._periodic_second,
-                n_request_to_be_processed_per_periodic_second=self._n_request_to_be_processed_per_periodic_second,
-                request_queue=request_queue,
-                socket_buf_size=self._socket_buf_size,
-                forward_host=self._forward_host,
-                forward_port=self._forward_port,
+            if request_processor
+        )
+
+    def _get_n_queued_requests(self) -> int:
+        return sum(
+            request_processor.request_queues.n_queued_requests
+            for request_processor in (
+                self._request_processor,
+                self._async_request_processor,
             )
-            request_queue = queue.Queue(self._request_queue_size)
-            self._client_ip_to_request_processor_and_request_queue[
-                request.client_ip
-            ] = (request_processor, request_queue)
-            request_processor.start()
+            if request_processor
+        )
+
+    def _create_request_processor(self) -> _RequestProcessor:
+        request_processor = _RequestProcessor(
+            request_queues=self._create_request_queues(),
+            n_workers=self._n_workers,
+            forward_request=self._forward_queued_request,
+        )
+        request_processor.start()
+        return request_processor
+
+    def _create_async_request_processor(self) -> _AsyncRequestProcessor:
+        return _AsyncRequestProcessor(
+            request_queues=self._create_request_queues(),
+            forward_request_async=self._forward_queued_request_async,
+        )
+
+    def _create_request_queues(self) -> _RequestQueues:
+        return _RequestQueues(
+            periodic_second=self._periodic_second,
+            n_request_to_be_processed_per_periodic_second=self._n_request_to_be_processed_per_periodic_second,
+            request_queue_size=self._request_queue_size,
+        )
+
+    def _forward_queued_request(self, request: Request, n_remaining: int) -> None:
+        self._logger.info("process request of %s in queue", request.client_address)
         try:
-            request_queue.put_nowait(request)
-            self._logger.info(
-                f"request from {request.client_address} has been added to queue. current [# of requests / queue_size] in queue is [{request_queue.qsize()}/{request_queue.maxsize}]"
+            self._forward_request(request, n_remaining)
+        except Exception:
+            self._logger.exception(
+                "failed to forward request of %s", request.client_address
             )
-        except queue.Full:
-            self._logger.info(
-                f"reqeust queue is full. request from {request.client_address} has not been added to queue"
-            )
-            self._respond_with_failure(request, request_processor.current_n_requests)
+            request.client_socket.close()
 
-    def _respond_with_failure(self, request: Request, request_queue_size: int) -> None:
+    async def _forward_queued_request_async(
+        self, request: Request, n_remaining: int, is_processed: asyncio.Future
+    ) -> None:
+        self._logger.info("process request of %s in queue", request.client_address)
         try:
-            content = "Please retry after minutes"
-            header = "\n".join(
-                [
-                    "HTTP/1.1 429 Too many requests",
-                    "\r\n".join(
-                        f"{k}: {v}"
-                        for k, v in {
-                            "Content-Type": "text/plan; encoding=utf8",
-                            "Content-Length": len(content),
-                            "Connection": "close",
-                            "X-Ratelimit-Remaining": self._request_queue_size
-                            - request_queue_size,
-                            "X-Ratelimit-Limit": self._request_queue_size,
-                            "X-Ratelimit-Retry-After": self._periodic_second,
-                        }.items()
-                    ),
-                ]
-            )
-            data = "\n\n".join([header, content])
-            self._logger.info(
-                f"send failure response to client {request.client_address}"
-            )
-            request.client_socket.send(data.encode("utf-8"))
+            await self._forward_request_async(request, n_remaining)
         finally:
-            request.client_socket.close()
+            if not is_processed.done():
+                is_processed.set_result(None)
@@ -0,0 +1,196 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from src.config import Config
+from src.core import Request
+from src.http_message import (
+    HttpMessageError,
+    parse_head,
+    parse_request_line,
+    recv_head,
+    recv_head_async,
+)
+from src.rate_limit_algorithms import RateLimitAlgorithm
+
+
+class CompiledRule:
+    def __init__(self, rule: Config.Rule, api_key_header: str) -> None:
+        self.name = rule.name
+        self.method = rule.method.upper().encode("latin-1") if rule.method else None
+        self.headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in rule.headers.items()
+        ]
+        self.api_key = rule.api_key.encode("latin-1") if rule.api_key else None
+        self.limit_by = rule.limit_by
+        self.api_key_header = api_key_header.lower().encode("latin-1")
+
+    @property
+    def needs_headers(self) -> bool:
+        return (
+            bool(self.headers) or self.api_key is not None or self.limit_by == "api_key"
+        )
+
+    def get_rate_limit_key(
+        self, method: bytes, headers: Dict[bytes, bytes], client_ip: str
+    ) -> Optional[str]:
+        if self.method is not None and method != self.method:
+            return None
+        for name, value in self.headers:
+            if headers.get(name) != value:
+                return None
+        api_key = headers.get(self.api_key_header)
+        if self.api_key is not None and api_key != self.api_key:
+            return None
+        if self.limit_by == "client_ip":
+            return f"{self.name}:{client_ip}"
+        if self.limit_by == "api_key":
+            if api_key is None:
+                return None
+            return f"{self.name}:{api_key.decode('latin-1')}"
+        return self.name
+
+
+class _RuleTrieNode:
+    __slots__ = ("children", "rules")
+
+    def __init__(self) -> None:
+        self.children: Dict[bytes, _RuleTrieNode] = {}
+        self.rules: List[CompiledRule] = []
+
+
+class RuleIndex:
+    def __init__(self, rules: List[Config.Rule], api_key_header: str) -> None:
+        self._root = _RuleTrieNode()
+        self.needs_headers = False
+        for rule in rules:
+            compiled_rule = CompiledRule(rule, api_key_header)
+            node = self._root
+            for segment in rule.path_prefix.encode("latin-1").split(b"/"):
+                if segment:
+                    node = node.children.setdefault(segment, _RuleTrieNode())
+            node.rules.append(compiled_rule)
+            self.needs_headers = self.needs_headers or compiled_rule.needs_headers
+
+    def match(
+        self, method: bytes, path: bytes, headers: Dict[bytes, bytes], client_ip: str
+    ) -> Optional[Tuple[CompiledRule, str]]:
+        # The longest path prefix wins, and rules of the same prefix are tried in order.
+        node = self._root
+        nodes = [node]
+        for segment in path.split(b"/"):
+            if not segment:
+                continue
+            node = node.children.get(segment)
+            if node is None:
+                break
+            nodes.append(node)
+        for node in reversed(nodes):
+            for rule in node.rules:
+                rate_limit_key = rule.get_rate_limit_key(method, headers, client_ip)
+                if rate_limit_key is not None:
+                    return rule, rate_limit_key
+        return None
+
+
+class RuleEngine(RateLimitAlgorithm):
+    def __init__(
+        self,
+        rules: List[Config.Rule],
+        rule_name_to_rate_limit_algorithm: Dict[str, RateLimitAlgorithm],
+        default_rate_limit_algorithm: RateLimitAlgorithm,
+        api_key_header: str,
+        socket_buf_size: int,
+    ) -> None:
+        self._rule_index = RuleIndex(rules, api_key_header)
+        self._rule_name_to_rate_limit_algorithm = rule_name_to_rate_limit_algorithm
+        self._default_rate_limit_algorithm = default_rate_limit_algorithm
+        self._socket_buf_size = socket_buf_size
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def default_rate_limit_algorithm(self) -> RateLimitAlgorithm:
+        return self._default_rate_limit_algorithm
+
+    def setup(self) -> None:
+        self._default_rate_limit_algorithm.setup()
+        for rate_limit_algorithm in self._rule_name_to_rate_limit_algorithm.values():
+            rate_limit_algorithm.setup()
+
+    def handle(self, request: Request) -> None:
+        try:
+            request.received = recv_head(
+                request.client_socket, self._socket_buf_size, request.received
+            )
+        except (HttpMessageError, OSError) as e:
+            self._logger.debug(
+                "can not read request of %s: %s", request.client_address, e
+            )
+            request.client_socket.close()
+            return
+        if not request.received:
+            request.client_socket.close()
+            return
+        self._get_rate_limit_algorithm(request).handle(request)
+
+    async def handle_async(self, request: Request) -> None:
+        try:
+            request.received = await recv_head_async(
+                request.client_socket, self._socket_buf_size, request.received
+            )
+        except (HttpMessageError, OSError) as e:
+            self._logger.debug(
+                "can not read request of %s: %s", request.client_address, e
+            )
+            request.client_socket.close()
+            return
+        if not request.received:
+            request.client_socket.close()
+            return
+        await self._get_rate_limit_algorithm(request).handle_async(request)
+
+    def teardown(self) -> None:
+        self._default_rate_limit_algorithm.teardown()
+        for rate_limit_algorithm in self._rule_name_to_rate_limit_algorithm.values():
+            rate_limit_algorithm.teardown()
+
+    def take_over(self, rate_limit_algorithm: RateLimitAlgorithm) -> None:
+        if not isinstance(rate_limit_algorithm, RuleEngine):
+            self._default_rate_limit_algorithm.take_over(rate_limit_algorithm)
+            return
+        self._default_rate_limit_algorithm.take_over(
+            rate_limit_algorithm._default_rate_limit_algorithm
+        )
+        old_rule_name_to_rate_limit_algorithm = (
+            rate_limit_algorithm._rule_name_to_rate_limit_algorithm
+        )
+        for name, rate_limit_algo in self._rule_name_to_rate_limit_algorithm.items():
+            if name in old_rule_name_to_rate_limit_algorithm:
+                rate_limit_algo.take_over(old_rule_name_to_rate_limit_algorithm[name])
+
+    def save_snapshot(self, path: str) -> None:
+        self._default_rate_limit_algorithm.save_snapshot(path)
+        for name, rate_limit_algo in self._rule_name_to_rate_limit_algorithm.items():
+            rate_limit_algo.save_snapshot(f"{path}.{name}")
+
+    def load_snapshot(self, path: str) -> None:
+        self._default_rate_limit_algorithm.load_snapshot(path)
+        for name, rate_limit_algo in self._rule_name_to_rate_limit_algorithm.items():
+            rate_limit_algo.load_snapshot(f"{path}.{name}")
+
+    def _get_rate_limit_algorithm(self, request: Request) -> RateLimitAlgorithm:
+        head_end_index = request.received.find(b"\r\n\r\n")
+        head = request.received[:head_end_index]
+        method, path = parse_request_line(head)
+        headers = parse_head(head)[1] if self._rule_index.needs_headers else {}
+        matched = self._rule_index.match(method, path, headers, request.client_ip)
+        if matched is None:
+            return self._default_rate_limit_algorithm
+        rule, request.rate_limit_key = matched
+        self._logger.debug(
+            "request of %s matches rule %s. limit it by %s",
+            request.client_address,
+            rule.name,
+            request.rate_limit_key,
+        )
+        return self._rule_name_to_rate_limit_algorithm[rule.name]
@@ -0,0 +1,346 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from src.core import Request
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms import ForwardingRateLimitAlgorithm, RateLimitAlgorithm
+from src.rate_limit_algorithms.storages import (
+    Storage,
+    StorageError,
+    StorageProtocolError,
+)
+
+
+class SlidingWindowCounter:
+    __slots__ = ("window_index", "n_previous_requests", "n_current_requests", "last_ts")
+
+    def __init__(self) -> None:
+        self.window_index = 0
+        self.n_previous_requests = 0
+        self.n_current_requests = 0
+        self.last_ts = float("-inf")
+
+
+class SlidingWindowCounterStore:
+    def __init__(
+        self, window_second: float, max_n_requests_per_window: int, max_n_keys: int
+    ) -> None:
+        self._window_second = window_second
+        self._max_n_requests_per_window = max_n_requests_per_window
+        self._max_n_keys = max_n_keys
+        self._client_ip_to_sliding_window_counter: OrderedDict[
+            str, SlidingWindowCounter
+        ] = OrderedDict()
+        self._previous_store: Optional[SlidingWindowCounterStore] = None
+        self._previous_store_expire_ts = 0.0
+
+    def __len__(self) -> int:
+        return len(self._client_ip_to_sliding_window_counter)
+
+    def get(self, client_ip: str) -> SlidingWindowCounter:
+        sliding_window_counter = self._client_ip_to_sliding_window_counter.get(
+            client_ip
+        )
+        if sliding_window_counter is None:
+            sliding_window_counter = (
+                self._pop_from_previous_store(client_ip) or SlidingWindowCounter()
+            )
+            self._client_ip_to_sliding_window_counter[
+                client_ip
+            ] = sliding_window_counter
+        else:
+            self._client_ip_to_sliding_window_counter.move_to_end(client_ip)
+        return sliding_window_counter
+
+    def try_acquire(
+        self, sliding_window_counter: SlidingWindowCounter, now: Optional[float] = None
+    ) -> bool:
+        if now is None:
+            now = time.monotonic()
+        sliding_window_counter.last_ts = now
+        self._evict(now)
+        if (
+            self._get_n_estimated_requests(sliding_window_counter, now)
+            >= self._max_n_requests_per_window
+        ):
+            return False
+        sliding_window_counter.n_current_requests += 1
+        return True
+
+    def get_n_remaining_requests(
+        self, sliding_window_counter: SlidingWindowCounter, now: Optional[float] = None
+    ) -> int:
+        if now is None:
+            now = time.monotonic()
+        return max(
+            0,
+            int(
+                self._max_n_requests_per_window
+                - self._get_n_estimated_requests(sliding_window_counter, now)
+            ),
+        )
+
+    def _get_n_estimated_requests(
+        self, sliding_window_counter: SlidingWindowCounter, now: float
+    ) -> float:
+        window_position = now / self._window_second
+        window_index = int(window_position)
+        n_elapsed_windows = window_index - sliding_window_counter.window_index
+        if n_elapsed_windows:
+            sliding_window_counter.n_previous_requests = (
+                sliding_window_counter.n_current_requests
+                if n_elapsed_windows == 1
+                else 0
+            )
+            sliding_window_counter.n_current_requests = 0
+            sliding_window_counter.window_index = window_index
+        # The previous window is weighted by how much of it still overlaps
+        # the sliding window ending now.
+        return sliding_window_counter.n_current_requests + (
+            sliding_window_counter.n_previous_requests
+            * (1 - (window_position - window_index))
+        )
+
+    def take_over(self, store: "SlidingWindowCounterStore") -> None:
+        if store._window_second == self._window_second:
+            self._client_ip_to_sliding_window_counter = (
+                store._client_ip_to_sliding_window_counter
+            )
+            return
+        # Counters are converted lazily when their client IP is seen next time.
+        self._previous_store = store
+        self._previous_store_expire_ts = time.monotonic() + 2 * store._window_second
+
+    def _pop_from_previous_store(
+        self, client_ip: str
+    ) -> Optional[SlidingWindowCounter]:
+        if self._previous_store is None:
+            return None
+        now = time.monotonic()
+        if now >= self._previous_store_expire_ts:
+            self._previous_store = None
+            return None
+        previous_sliding_window_counter = (
+            self._previous_store._client_ip_to_sliding_window_counter.pop(
+                client_ip, None
+            )
+        )
+        if previous_sliding_window_counter is None:
+            return None
+        sliding_window_counter = SlidingWindowCounter()
+        sliding_window_counter.window_index = int(now / self._window_second)
+        sliding_window_counter.n_current_requests = math.ceil(
+            self._previous_store._get_n_estimated_requests(
+                previous_sliding_window_counter, now
+            )
+        )
+        sliding_window_counter.last_ts = now
+        return sliding_window_counter
+
+    def _evict(self, now: float) -> None:
+        sliding_window_counters = self._client_ip_to_sliding_window_counter
+        while len(sliding_window_counters) > self._max_n_keys:
+            sliding_window_counters.popitem(last=False)
+        while sliding_window_counters:
+            oldest_sliding_window_counter = next(iter(sliding_window_counters.values()))
+            if now - oldest_sliding_window_counter.last_ts < 2 * self._window_second:
+                break
+            sliding_window_counters.popitem(last=False)
+
+
+class SlidingWindowCounterAlgorithm(ForwardingRateLimitAlgorithm):
+    def __init__(
+        self,
+        window_second: float,
+        max_n_requests_per_window: int,
+        max_n_keys: int,
+        socket_buf_size: int,
+        forward_host: str,
+        forward_port: str,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+        rule_metrics: RuleMetrics,
+        storage: Optional[Storage] = None,
+    ) -> None:
+        self._window_second = window_second
+        self._max_n_requests_per_window = max_n_requests_per_window
+        super().__init__(
+            limit=self._max_n_requests_per_window,
+            retry_after_second=self._window_second,
+            socket_buf_size=socket_buf_size,
+            forward_host=forward_host,
+            forward_port=forward_port,
+            upstream_pool_size=upstream_pool_size,
+            upstream_idle_timeout_second=upstream_idle_timeout_second,
+        )
+        self._sliding_window_counter_store = SlidingWindowCounterStore(
+            window_second=window_second,
+            max_n_requests_per_window=max_n_requests_per_window,
+            max_n_keys=max_n_keys,
+        )
+        self._storage = storage
+        self._rule_metrics = rule_metrics
+
+    def setup(self) -> None:
+        self._rule_metrics.get_n_keys = (
+            self._storage.get_n_keys
+            if self._storage
+            else self._sliding_window_counter_store.__len__
+        )
+
+    def handle(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        try:
+            is_acquired, n_remaining_requests = self._try_acquire(
+                request.rate_limit_key
+            )
+        except StorageProtocolError:
+            # The storage can not process the request, so it would never be limited.
+            self._logger.exception(
+                "failed to count request. can not forward request from %s",
+                request.client_address,
+            )
+            self._rule_metrics.observe_decision(False, started)
+            self._respond_with_storage_error(request)
+            return
+        except StorageError:
+            self._logger.exception(
+                "failed to count request. forward request from %s anyway",
+                request.client_address,
+            )
+            is_acquired, n_remaining_requests = True, 0
+        self._rule_metrics.observe_decision(is_acquired, started)
+        if not is_acquired:
+            self._logger.info(
+                "sliding window counter is full. can not forward request from %s",
+                request.client_address,
+            )
+            self._respond_with_failure(request)
+            return
+        self._forward_request(request, n_remaining_requests)
+
+    async def handle_async(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        try:
+            is_acquired, n_remaining_requests = await self._try_acquire_async(
+                request.rate_limit_key
+            )
+        except StorageProtocolError:
+            # The storage can not process the request, so it would never be limited.
+            self._logger.exception(
+                "failed to count request. can not forward request from %s",
+                request.client_address,
+            )
+            self._rule_metrics.observe_decision(False, started)
+            await self._respond_with_storage_error_async(request)
+            return
+        except StorageError:
+            self._logger.exception(
+                "failed to count request. forward request from %s anyway",
+                request.client_address,
+            )
+            is_acquired, n_remaining_requests = True, 0
+        self._rule_metrics.observe_decision(is_acquired, started)
+        if not is_acquired:
+            self._logger.info(
+                "sliding window counter is full. can not forward request from %s",
+                request.client_address,
+            )
+            await self._respond_with_failure_async(request)
+            return
+        await self._forward_request_async(request, n_remaining_requests)
+
+    def _try_acquire(self, client_ip: str) -> Tuple[bool, int]:
+        if not self._storage:
+            return self._try_acquire_from_store(client_ip)
+        now = time.time()
+        keys_and_amounts = self._get_keys_and_amounts(client_ip, now)
+        n_previous_requests, n_current_requests = self._storage.incr_with_expiry(
+            keys_and_amounts, 2 * self._window_second
+        )
+        n_remaining_requests = self._get_n_remaining_requests(
+            now, n_previous_requests, n_current_requests
+        )
+        if n_remaining_requests < 0:
+            self._storage.incr_with_expiry(
+                ((keys_and_amounts[1][0], -1),), 2 * self._window_second
+            )
+            return False, 0
+        return True, n_remaining_requests
+
+    async def _try_acquire_async(self, client_ip: str) -> Tuple[bool, int]:
+        if not self._storage:
+            return self._try_acquire_from_store(client_ip)
+        now = time.time()
+        keys_and_amounts = self._get_keys_and_amounts(client_ip, now)
+        (
+            n_previous_requests,
+            n_current_requests,
+        ) = await self._storage.incr_with_expiry_async(
+            keys_and_amounts, 2 * self._window_second
+        )
+        n_remaining_requests = self._get_n_remaining_requests(
+            now, n_previous_requests, n_current_requests
+        )
+        if n_remaining_requests < 0:
+            await self._storage.incr_with_expiry_async(
+                ((keys_and_amounts[1][0], -1),), 2 * self._window_second
+            )
+            return False, 0
+        return True, n_remaining_requests
+
+    def _try_acquire_from_store(self, client_ip: str) -> Tuple[bool, int]:
+        sliding_window_counter = self._sliding_window_counter_store.get(client_ip)
+        if not self._sliding_window_counter_store.try_acquire(sliding_window_counter):
+            return False, 0
+        return True, self._sliding_window_counter_store.get_n_remaining_requests(
+            sliding_window_counter
+        )
+
+    def _get_keys_and_amounts(
+        self, client_ip: str, now: float
+    ) -> Tuple[Tuple[str, int], Tuple[str, int]]:
+        # Wall clock is used as the window index is shared between rate limiters.
+        window_index = int(now / self._window_second)
+        return (f"{client_ip}:{window_index - 1}", 0), (
+            f"{client_ip}:{window_index}",
+            1,
+        )
+
+    def _get_n_remaining_requests(
+        self, now: float, n_previous_requests: int, n_current_requests: int
+    ) -> int:
+        window_position = now / self._window_second
+        n_estimated_requests = n_current_requests + n_previous_requests * (
+            1 - (window_position - int(window_position))
+        )
+        # n_current_requests already counts this request.
+        if n_estimated_requests >= self._max_n_requests_per_window + 1:
+            return -1
+        return max(0, int(self._max_n_requests_per_window - n_estimated_requests))
+
+    def teardown(self) -> None:
+        self._forwarder.close()
+        if self._storage:
+            self._storage.close()
+
+    def save_snapshot(self, path: str) -> None:
+        if self._storage:
+            self._storage.save_snapshot(path)
+
+    def load_snapshot(self, path: str) -> None:
+        if self._storage:
+            self._storage.load_snapshot(path)
+
+    def take_over(self, rate_limit_algorithm: RateLimitAlgorithm) -> None:
+        if not isinstance(rate_limit_algorithm, SlidingWindowCounterAlgorithm):
+            return
+        self._sliding_window_counter_store.take_over(
+            rate_limit_algorithm._sliding_window_counter_store
+        )
+        if self._storage and rate_limit_algorithm._storage:
+            self._storage.take_over(rate_limit_algorithm._storage)
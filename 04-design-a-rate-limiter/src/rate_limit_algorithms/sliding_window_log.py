@@ -0,0 +1,201 @@
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Optional
+
+from src.core import Request
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms import ForwardingRateLimitAlgorithm, RateLimitAlgorithm
+
+
+class SlidingWindowLog:
+    __slots__ = ("timestamps", "oldest_index", "last_ts")
+
+    def __init__(self, max_n_requests_per_window: int) -> None:
+        self.timestamps = array("d", [float("-inf")]) * max_n_requests_per_window
+        self.oldest_index = 0
+        self.last_ts = float("-inf")
+
+
+class SlidingWindowLogStore:
+    def __init__(
+        self, window_second: float, max_n_requests_per_window: int, max_n_keys: int
+    ) -> None:
+        self._window_second = window_second
+        self._max_n_requests_per_window = max_n_requests_per_window
+        self._max_n_keys = max_n_keys
+        self._client_ip_to_sliding_window_log: OrderedDict[
+            str, SlidingWindowLog
+        ] = OrderedDict()
+        self._previous_store: Optional[SlidingWindowLogStore] = None
+        self._previous_store_expire_ts = 0.0
+
+    def __len__(self) -> int:
+        return len(self._client_ip_to_sliding_window_log)
+
+    def get(self, client_ip: str) -> SlidingWindowLog:
+        sliding_window_log = self._client_ip_to_sliding_window_log.get(client_ip)
+        if sliding_window_log is None:
+            sliding_window_log = self._pop_from_previous_store(
+                client_ip
+            ) or SlidingWindowLog(self._max_n_requests_per_window)
+            self._client_ip_to_sliding_window_log[client_ip] = sliding_window_log
+        else:
+            self._client_ip_to_sliding_window_log.move_to_end(client_ip)
+        return sliding_window_log
+
+    def try_acquire(
+        self, sliding_window_log: SlidingWindowLog, now: Optional[float] = None
+    ) -> bool:
+        if now is None:
+            now = time.monotonic()
+        sliding_window_log.last_ts = now
+        self._evict(now)
+        # The ring keeps the timestamps of the last accepted requests in order,
+        # so the slot to be overwritten is always the oldest one.
+        i = sliding_window_log.oldest_index
+        if sliding_window_log.timestamps[i] > now - self._window_second:
+            return False
+        sliding_window_log.timestamps[i] = now
+        sliding_window_log.oldest_index = (i + 1) % self._max_n_requests_per_window
+        return True
+
+    def get_n_remaining_requests(
+        self, sliding_window_log: SlidingWindowLog, now: Optional[float] = None
+    ) -> int:
+        if now is None:
+            now = time.monotonic()
+        timestamps = sliding_window_log.timestamps
+        i = sliding_window_log.oldest_index
+        expired_ts = now - self._window_second
+        return (
+            bisect_right(timestamps, expired_ts, i, len(timestamps))
+            - i
+            + bisect_right(timestamps, expired_ts, 0, i)
+        )
+
+    def take_over(self, store: "SlidingWindowLogStore") -> None:
+        if store._max_n_requests_per_window == self._max_n_requests_per_window:
+            self._client_ip_to_sliding_window_log = (
+                store._client_ip_to_sliding_window_log
+            )
+            return
+        # Logs are resized lazily when their client IP is seen next time.
+        self._previous_store = store
+        self._previous_store_expire_ts = time.monotonic() + store._window_second
+
+    def _pop_from_previous_store(self, client_ip: str) -> Optional[SlidingWindowLog]:
+        if self._previous_store is None:
+            return None
+        if time.monotonic() >= self._previous_store_expire_ts:
+            self._previous_store = None
+            return None
+        previous_sliding_window_log = (
+            self._previous_store._client_ip_to_sliding_window_log.pop(client_ip, None)
+        )
+        if previous_sliding_window_log is None:
+            return None
+        previous_timestamps = previous_sliding_window_log.timestamps
+        sliding_window_log = SlidingWindowLog(self._max_n_requests_per_window)
+        n_timestamps = min(len(previous_timestamps), self._max_n_requests_per_window)
+        start_index = previous_sliding_window_log.oldest_index + len(
+            previous_timestamps
+        )
+        for i in range(n_timestamps):
+            sliding_window_log.timestamps[i] = previous_timestamps[
+                (start_index - n_timestamps + i) % len(previous_timestamps)
+            ]
+        sliding_window_log.oldest_index = n_timestamps % self._max_n_requests_per_window
+        sliding_window_log.last_ts = previous_sliding_window_log.last_ts
+        return sliding_window_log
+
+    def _evict(self, now: float) -> None:
+        sliding_window_logs = self._client_ip_to_sliding_window_log
+        while len(sliding_window_logs) > self._max_n_keys:
+            sliding_window_logs.popitem(last=False)
+        while sliding_window_logs:
+            oldest_sliding_window_log = next(iter(sliding_window_logs.values()))
+            if now - oldest_sliding_window_log.last_ts < self._window_second:
+                break
+            sliding_window_logs.popitem(last=False)
+
+
+class SlidingWindowLogAlgorithm(ForwardingRateLimitAlgorithm):
+    def __init__(
+        self,
+        window_second: float,
+        max_n_requests_per_window: int,
+        max_n_keys: int,
+        socket_buf_size: int,
+        forward_host: str,
+        forward_port: str,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+        rule_metrics: RuleMetrics,
+    ) -> None:
+        self._window_second = window_second
+        self._max_n_requests_per_window = max_n_requests_per_window
+        super().__init__(
+            limit=self._max_n_requests_per_window,
+            retry_after_second=self._window_second,
+            socket_buf_size=socket_buf_size,
+            forward_host=forward_host,
+            forward_port=forward_port,
+            upstream_pool_size=upstream_pool_size,
+            upstream_idle_timeout_second=upstream_idle_timeout_second,
+        )
+        self._sliding_window_log_store = SlidingWindowLogStore(
+            window_second=window_second,
+            max_n_requests_per_window=max_n_requests_per_window,
+            max_n_keys=max_n_keys,
+        )
+        self._rule_metrics = rule_metrics
+
+    def setup(self) -> None:
+        self._rule_metrics.get_n_keys = self._sliding_window_log_store.__len__
+
+    def handle(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        sliding_window_log = self._sliding_window_log_store.get(request.rate_limit_key)
+        is_acquired = self._sliding_window_log_store.try_acquire(sliding_window_log)
+        self._rule_metrics.observe_decision(is_acquired, started)
+        if not is_acquired:
+            self._logger.info(
+                "sliding window log is full. can not forward request from %s",
+                request.client_address,
+            )
+            self._respond_with_failure(request)
+            return
+        self._forward_request(
+            request,
+            self._sliding_window_log_store.get_n_remaining_requests(sliding_window_log),
+        )
+
+    async def handle_async(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        sliding_window_log = self._sliding_window_log_store.get(request.rate_limit_key)
+        is_acquired = self._sliding_window_log_store.try_acquire(sliding_window_log)
+        self._rule_metrics.observe_decision(is_acquired, started)
+        if not is_acquired:
+            self._logger.info(
+                "sliding window log is full. can not forward request from %s",
+                request.client_address,
+            )
+            await self._respond_with_failure_async(request)
+            return
+        await self._forward_request_async(
+            request,
+            self._sliding_window_log_store.get_n_remaining_requests(sliding_window_log),
+        )
+
+    def teardown(self) -> None:
+        self._forwarder.close()
+
+    def take_over(self, rate_limit_algorithm: RateLimitAlgorithm) -> None:
+        if isinstance(rate_limit_algorithm, SlidingWindowLogAlgorithm):
+            self._sliding_window_log_store.take_over(
+                rate_limit_algorithm._sliding_window_log_store
+            )
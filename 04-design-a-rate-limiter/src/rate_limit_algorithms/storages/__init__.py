@@ -0,0 +1,60 @@
+import abc
+from typing import List, Optional, Sequence, Tuple
+
+
+class StorageError(Exception):
+    pass
+
+
+class StorageProtocolError(StorageError):
+    pass
+
+
+class Storage(abc.ABC):
+    @abc.abstractmethod
+    def refill_and_take(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        pass
+
+    @abc.abstractmethod
+    async def refill_and_take_async(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        pass
+
+    @abc.abstractmethod
+    def incr_with_expiry(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        pass
+
+    @abc.abstractmethod
+    async def incr_with_expiry_async(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+    def take_over(self, storage: "Storage") -> None:
+        pass
+
+    def get_n_keys(self) -> Optional[int]:
+        return None
+
+    def save_snapshot(self, path: str) -> None:
+        pass
+
+    def load_snapshot(self, path: str) -> None:
+        pass
@@ -0,0 +1,208 @@
+import heapq
+import itertools
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.rate_limit_algorithms.storages import Storage
+from src.rate_limit_algorithms.storages.snapshot import (
+    Snapshot,
+    hash_key,
+    write_snapshot,
+)
+
+
+class _TokenBucket:
+    __slots__ = ("current_n_tokens", "last_ts")
+
+    def __init__(self, current_n_tokens: float, last_ts: float) -> None:
+        self.current_n_tokens = current_n_tokens
+        self.last_ts = last_ts
+
+
+class _Counter:
+    __slots__ = ("value", "expire_ts")
+
+    def __init__(self, value: int, expire_ts: float) -> None:
+        self.value = value
+        self.expire_ts = expire_ts
+
+
+class LocalStorage(Storage):
+    def __init__(self, max_n_keys: int) -> None:
+        self._max_n_keys = max_n_keys
+        self._key_to_token_bucket: OrderedDict[str, _TokenBucket] = OrderedDict()
+        self._key_to_counter: Dict[str, _Counter] = {}
+        self._counter_expirations: List[Tuple[float, str]] = []
+        self._token_bucket_idle_second = math.inf
+        self._snapshot: Optional[Snapshot] = None
+
+    @property
+    def n_token_buckets(self) -> int:
+        return len(self._key_to_token_bucket)
+
+    @property
+    def n_counters(self) -> int:
+        return len(self._key_to_counter)
+
+    def refill_and_take(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+        now: Optional[float] = None,
+    ) -> Tuple[bool, float]:
+        if now is None:
+            now = time.monotonic()
+        token_bucket = self._key_to_token_bucket.get(key)
+        if token_bucket is None:
+            token_bucket = self._load_token_bucket(key, token_bucket_size, now)
+            self._key_to_token_bucket[key] = token_bucket
+        else:
+            self._key_to_token_bucket.move_to_end(key)
+        token_bucket.current_n_tokens = min(
+            token_bucket.current_n_tokens
+            + (now - token_bucket.last_ts) * n_tokens_per_second,
+            token_bucket_size,
+        )
+        token_bucket.last_ts = now
+        # A bucket idle for this long is full again, same as a new one.
+        self._token_bucket_idle_second = (
+            token_bucket_size + n_borrowable_tokens
+        ) / n_tokens_per_second
+        self._evict_token_buckets(now - self._token_bucket_idle_second)
+        # Borrowed tokens make the bucket negative, and are paid back by refills.
+        if token_bucket.current_n_tokens < 1 - n_borrowable_tokens:
+            return False, token_bucket.current_n_tokens
+        token_bucket.current_n_tokens -= 1
+        return True, token_bucket.current_n_tokens
+
+    async def refill_and_take_async(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        return self.refill_and_take(
+            key, token_bucket_size, n_tokens_per_second, n_borrowable_tokens
+        )
+
+    def incr_with_expiry(
+        self,
+        keys_and_amounts: Sequence[Tuple[str, int]],
+        expiry_second: float,
+        now: Optional[float] = None,
+    ) -> List[int]:
+        if now is None:
+            now = time.monotonic()
+        self._evict_counters(now)
+        values = []
+        for key, amount in keys_and_amounts:
+            counter = self._key_to_counter.get(key)
+            if counter is None:
+                counter = self._load_counter(key, now)
+                if counter is None:
+                    # Nothing to roll back once the counter has expired or been evicted.
+                    if amount <= 0:
+                        values.append(0)
+                        continue
+                    counter = _Counter(0, now + expiry_second)
+                self._key_to_counter[key] = counter
+                heapq.heappush(self._counter_expirations, (counter.expire_ts, key))
+            counter.value = max(0, counter.value + amount)
+            values.append(counter.value)
+        return values
+
+    async def incr_with_expiry_async(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        return self.incr_with_expiry(keys_and_amounts, expiry_second)
+
+    def close(self) -> None:
+        pass
+
+    def get_n_keys(self) -> Optional[int]:
+        return self.n_token_buckets + self.n_counters
+
+    def take_over(self, storage: Storage) -> None:
+        if not isinstance(storage, LocalStorage):
+            return
+        # New parameters are applied to each bucket when it is refilled next time.
+        self._key_to_token_bucket = storage._key_to_token_bucket
+        self._key_to_counter = storage._key_to_counter
+        self._counter_expirations = storage._counter_expirations
+        self._token_bucket_idle_second = storage._token_bucket_idle_second
+        self._snapshot = storage._snapshot
+        storage._key_to_token_bucket = OrderedDict()
+        storage._key_to_counter = {}
+        storage._counter_expirations = []
+        storage._snapshot = None
+
+    def save_snapshot(self, path: str) -> None:
+        # This may be called from another thread. Copying the tables in C holds the GIL,
+        # and the buckets changed while they are written are saved either way.
+        token_buckets = list(self._key_to_token_bucket.items())
+        counters = list(self._key_to_counter.items())
+        now = time.monotonic()
+        write_snapshot(
+            path,
+            itertools.chain(
+                self._snapshot.iter_records(now) if self._snapshot else (),
+                (
+                    (
+                        hash_key(key),
+                        token_bucket.current_n_tokens,
+                        token_bucket.last_ts,
+                        token_bucket.last_ts + self._token_bucket_idle_second,
+                    )
+                    for key, token_bucket in token_buckets
+                ),
+                (
+                    (hash_key(key), counter.value, now, counter.expire_ts)
+                    for key, counter in counters
+                ),
+            ),
+        )
+
+    def load_snapshot(self, path: str) -> None:
+        self._snapshot = Snapshot.open(path)
+
+    def _load_token_bucket(
+        self, key: str, token_bucket_size: int, now: float
+    ) -> _TokenBucket:
+        if self._snapshot is not None:
+            record = self._snapshot.pop(hash_key(key), now)
+            if record is not None:
+                current_n_tokens, last_ts, _ = record
+                return _TokenBucket(current_n_tokens, min(last_ts, now))
+        return _TokenBucket(token_bucket_size, now)
+
+    def _load_counter(self, key: str, now: float) -> Optional[_Counter]:
+        if self._snapshot is None:
+            return None
+        record = self._snapshot.pop(hash_key(key), now)
+        if record is None:
+            return None
+        value, _, expire_ts = record
+        return _Counter(int(value), expire_ts)
+
+    def _evict_token_buckets(self, expired_ts: float) -> None:
+        token_buckets = self._key_to_token_bucket
+        while len(token_buckets) > self._max_n_keys:
+            token_buckets.popitem(last=False)
+        while token_buckets:
+            oldest_token_bucket = next(iter(token_buckets.values()))
+            if oldest_token_bucket.last_ts > expired_ts:
+                break
+            token_buckets.popitem(last=False)
+
+    def _evict_counters(self, now: float) -> None:
+        while self._counter_expirations and self._counter_expirations[0][0] <= now:
+            _, key = heapq.heappop(self._counter_expirations)
+            del self._key_to_counter[key]
+        while len(self._key_to_counter) > self._max_n_keys:
+            _, key = heapq.heappop(self._counter_expirations)
+            del self._key_to_counter[key]
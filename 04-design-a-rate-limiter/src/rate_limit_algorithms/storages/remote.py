@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import socket
+import threading
+import urllib.parse
+from collections import deque
+from typing import BinaryIO, Callable, Deque, List, Optional, Sequence, Tuple, TypeVar
+
+from src.rate_limit_algorithms.storages import (
+    Storage,
+    StorageError,
+    StorageProtocolError,
+)
+
+REFILL_AND_TAKE = b"RT"
+INCR_WITH_EXPIRY = b"IE"
+ERROR = b"ERR"
+
+T = TypeVar("T")
+
+
+# Keys are percent-encoded, since spaces and newlines separate arguments and commands.
+def encode_key(key: str) -> bytes:
+    return urllib.parse.quote(key, safe="").encode()
+
+
+def decode_key(encoded_key: bytes) -> str:
+    return urllib.parse.unquote(encoded_key.decode("ascii"), errors="strict")
+
+
+def encode_refill_and_take(
+    key: str,
+    token_bucket_size: int,
+    n_tokens_per_second: float,
+    n_borrowable_tokens: float = 0,
+) -> bytes:
+    return b"%s %s %d %r %r\n" % (
+        REFILL_AND_TAKE,
+        encode_key(key),
+        token_bucket_size,
+        n_tokens_per_second,
+        n_borrowable_tokens,
+    )
+
+
+def encode_incr_with_expiry(
+    keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+) -> bytes:
+    return b"%s %r %s\n" % (
+        INCR_WITH_EXPIRY,
+        expiry_second,
+        b" ".join(
+            b"%s %d" % (encode_key(key), amount) for key, amount in keys_and_amounts
+        ),
+    )
+
+
+def decode_refill_and_take(response: bytes) -> Tuple[bool, float]:
+    try:
+        is_taken, current_n_tokens = _check_error(response).split()
+        return is_taken == b"1", float(current_n_tokens)
+    except ValueError:
+        raise StorageProtocolError(f"malformed response {response!r}")
+
+
+def decode_incr_with_expiry(response: bytes) -> List[int]:
+    try:
+        return [int(value) for value in _check_error(response).split()]
+    except ValueError:
+        raise StorageProtocolError(f"malformed response {response!r}")
+
+
+def _check_error(response: bytes) -> bytes:
+    if not response:
+        raise StorageError("connection was closed by the storage server")
+    if response.startswith(ERROR):
+        raise StorageProtocolError(
+            response[len(ERROR) :].strip().decode(errors="replace")
+        )
+    return response
+
+
+class RemoteStorage(Storage):
+    def __init__(
+        self, storage_host: str, storage_port: int, timeout_second: float
+    ) -> None:
+        self._storage_host = storage_host
+        self._storage_port = storage_port
+        self._timeout_second = timeout_second
+
+        self._lock = threading.Lock()
+        self._socket: Optional[socket.socket] = None
+        self._file: Optional[BinaryIO] = None
+
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending_responses: Deque[asyncio.Future] = deque()
+        self._write_buffer = bytearray()
+        self._is_flush_scheduled = False
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def storage_address(self) -> str:
+        return f"{self._storage_host}:{self._storage_port}"
+
+    def refill_and_take(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        return self._execute(
+            encode_refill_and_take(
+                key, token_bucket_size, n_tokens_per_second, n_borrowable_tokens
+            ),
+            decode_refill_and_take,
+        )
+
+    async def refill_and_take_async(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        return await self._execute_async(
+            encode_refill_and_take(
+                key, token_bucket_size, n_tokens_per_second, n_borrowable_tokens
+            ),
+            decode_refill_and_take,
+        )
+
+    def incr_with_expiry(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        return self._execute(
+            encode_incr_with_expiry(keys_and_amounts, expiry_second),
+            decode_incr_with_expiry,
+        )
+
+    async def incr_with_expiry_async(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        return await self._execute_async(
+            encode_incr_with_expiry(keys_and_amounts, expiry_second),
+            decode_incr_with_expiry,
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_socket()
+        self._close_stream(StorageError("storage has been closed"))
+
+    def _execute(self, command: bytes, decode: Callable[[bytes], T]) -> T:
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._connect()
+                self._socket.sendall(command)
+                response = self._file.readline()
+            except OSError as e:
+                self._close_socket()
+                raise StorageError(
+                    f"failed to communicate with storage server {self.storage_address}: {e}"
+                )
+            try:
+                return decode(response)
+            except StorageError:
+                # Only an error response keeps the connection in step with the server.
+                if not response.startswith(ERROR):
+                    self._close_socket()
+                raise
+
+    def _connect(self) -> None:
+        self._logger.debug("start to connect storage server %s", self.storage_address)
+        self._socket = socket.create_connection(
+            (self._storage_host, self._storage_port), self._timeout_second
+        )
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile("rb")
+
+    def _close_socket(self) -> None:
+        if self._socket is None:
+            return
+        self._file.close()
+        self._socket.close()
+        self._socket = self._file = None
+
+    async def _execute_async(self, command: bytes, decode: Callable[[bytes], T]) -> T:
+        if self._writer is None:
+            await self._connect_async()
+        writer = self._writer
+        loop = asyncio.get_running_loop()
+        response = loop.create_future()
+        self._pending_responses.append(response)
+        self._write_buffer += command
+        # Commands issued in the same loop iteration go out in one write,
+        # and responses come back in order on the same connection.
+        if not self._is_flush_scheduled:
+            self._is_flush_scheduled = True
+            loop.call_soon(self._flush)
+        response = await response
+        try:
+            return decode(response)
+        except StorageError as e:
+            if not response.startswith(ERROR) and self._writer is writer:
+                self._close_stream(e)
+            raise
+
+    async def _connect_async(self) -> None:
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self._logger.debug(
+                "start to connect storage server %s", self.storage_address
+            )
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self._storage_host, self._storage_port),
+                    self._timeout_second,
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                raise StorageError(
+                    f"failed to connect storage server {self.storage_address}: {e!r}"
+                )
+            self._writer.get_extra_info("socket").setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+            )
+            self._read_task = asyncio.get_running_loop().create_task(
+                self._read_responses()
+            )
+
+    def _flush(self) -> None:
+        self._is_flush_scheduled = False
+        if self._writer is None:
+            return
+        self._writer.write(self._write_buffer)
+        self._write_buffer.clear()
+        # One timer per flushed batch instead of one per command. Responses come
+        # in order, so the batch is late if its last response is still pending.
+        asyncio.get_running_loop().call_later(
+            self._timeout_second, self._check_timeout, self._pending_responses[-1]
+        )
+
+    def _check_timeout(self, last_response: asyncio.Future) -> None:
+        if last_response.done():
+            return
+        self._close_stream(
+            StorageError(
+                f"storage server {self.storage_address} did not respond in {self._timeout_second}s"
+            )
+        )
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                response = await self._reader.readline()
+                if not response:
+                    raise ConnectionResetError("connection was closed")
+                pending_response = self._pending_responses.popleft()
+                if not pending_response.done():
+                    pending_response.set_result(response)
+        except asyncio.CancelledError:
+            pass
+        except (OSError, IndexError) as e:
+            self._close_stream(
+                StorageError(
+                    f"failed to communicate with storage server {self.storage_address}: {e!r}"
+                )
+            )
+
+    def _close_stream(self, error: StorageError) -> None:
+        if self._writer is None:
+            return
+        if self._read_task and self._read_task is not asyncio.current_task():
+            self._read_task.cancel()
+        self._writer.close()
+        self._reader = self._writer = self._read_task = None
+        self._write_buffer.clear()
+        while self._pending_responses:
+            response = self._pending_responses.popleft()
+            if not response.done():
+                response.set_exception(error)
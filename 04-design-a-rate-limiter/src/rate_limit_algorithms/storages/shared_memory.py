@@ -0,0 +1,202 @@
+import itertools
+import mmap
+import multiprocessing
+import struct
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from src.rate_limit_algorithms.storages import Storage
+from src.rate_limit_algorithms.storages.snapshot import (
+    Record,
+    Snapshot,
+    hash_key,
+    write_snapshot,
+)
+
+
+class SharedMemoryTable:
+    _SLOT = struct.Struct("<Qddd")
+    _N_SLOTS_PER_SEGMENT = 256
+    _MAX_N_LOCKS = 64
+
+    def __init__(self, capacity: int) -> None:
+        self._n_segments = max(1, -(-capacity // self._N_SLOTS_PER_SEGMENT))
+        # An anonymous mapping is shared with the worker processes forked after this.
+        self._buffer = mmap.mmap(
+            -1, self._n_segments * self._N_SLOTS_PER_SEGMENT * self._SLOT.size
+        )
+        context = multiprocessing.get_context("fork")
+        self._locks = [
+            context.Lock() for _ in range(min(self._n_segments, self._MAX_N_LOCKS))
+        ]
+        self._snapshot: Optional[Snapshot] = None
+
+    @property
+    def capacity(self) -> int:
+        return self._n_segments * self._N_SLOTS_PER_SEGMENT
+
+    def get_key_hash(self, key: str) -> int:
+        return hash_key(key)
+
+    def get_lock(self, key_hash: int):
+        return self._locks[self._get_segment(key_hash) % len(self._locks)]
+
+    def find_slot(self, key_hash: int, now: float) -> Tuple[int, bool]:
+        segment_offset = (
+            self._get_segment(key_hash) * self._N_SLOTS_PER_SEGMENT * self._SLOT.size
+        )
+        reusable_offset = oldest_offset = None
+        oldest_expire_ts = float("inf")
+        for i in range(self._N_SLOTS_PER_SEGMENT):
+            offset = segment_offset + (
+                (key_hash + i) % self._N_SLOTS_PER_SEGMENT * self._SLOT.size
+            )
+            slot_key_hash, _, _, expire_ts = self._SLOT.unpack_from(
+                self._buffer, offset
+            )
+            if slot_key_hash == key_hash:
+                return offset, expire_ts > now
+            if slot_key_hash == 0:
+                return (offset if reusable_offset is None else reusable_offset), False
+            if reusable_offset is None and expire_ts <= now:
+                reusable_offset = offset
+            if expire_ts < oldest_expire_ts:
+                oldest_offset, oldest_expire_ts = offset, expire_ts
+        return (oldest_offset if reusable_offset is None else reusable_offset), False
+
+    def read(self, offset: int) -> Tuple[int, float, float, float]:
+        return self._SLOT.unpack_from(self._buffer, offset)
+
+    def write(
+        self, offset: int, key_hash: int, value: float, ts: float, expire_ts: float
+    ) -> None:
+        self._SLOT.pack_into(self._buffer, offset, key_hash, value, ts, expire_ts)
+
+    def load_snapshot(self, path: str) -> None:
+        # Loaded before the workers are forked, so that each of them maps the same file.
+        self._snapshot = Snapshot.open(path)
+
+    def pop_snapshot(
+        self, key_hash: int, now: float
+    ) -> Optional[Tuple[float, float, float]]:
+        if self._snapshot is None:
+            return None
+        return self._snapshot.pop(key_hash, now)
+
+    def save_snapshot(self, path: str) -> None:
+        now = time.monotonic()
+        # Records which have been taken out in the workers are saved again from the table.
+        write_snapshot(
+            path,
+            itertools.chain(
+                self._snapshot.iter_records(now) if self._snapshot else (),
+                self._iter_records(now),
+            ),
+        )
+
+    def _iter_records(self, now: float) -> Iterator[Record]:
+        segment_size = self._N_SLOTS_PER_SEGMENT * self._SLOT.size
+        for segment in range(self._n_segments):
+            with self._locks[segment % len(self._locks)]:
+                records = [
+                    record
+                    for record in self._SLOT.iter_unpack(
+                        self._buffer[
+                            segment * segment_size : (segment + 1) * segment_size
+                        ]
+                    )
+                    if record[0] and record[3] > now
+                ]
+            yield from records
+
+    def _get_segment(self, key_hash: int) -> int:
+        return (key_hash >> 32) % self._n_segments
+
+
+class SharedMemoryStorage(Storage):
+    def __init__(self, shared_memory_table: SharedMemoryTable) -> None:
+        self._table = shared_memory_table
+
+    def refill_and_take(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        key_hash = self._table.get_key_hash(key)
+        with self._table.get_lock(key_hash):
+            # CLOCK_MONOTONIC is system wide, so timestamps are comparable between workers.
+            now = time.monotonic()
+            offset, is_found = self._table.find_slot(key_hash, now)
+            if is_found:
+                _, current_n_tokens, last_ts, _ = self._table.read(offset)
+            else:
+                record = self._table.pop_snapshot(key_hash, now)
+                if record is not None:
+                    current_n_tokens, last_ts, _ = record
+                    is_found = True
+            if is_found:
+                current_n_tokens = min(
+                    current_n_tokens + (now - last_ts) * n_tokens_per_second,
+                    token_bucket_size,
+                )
+            else:
+                current_n_tokens = token_bucket_size
+            is_taken = current_n_tokens >= 1 - n_borrowable_tokens
+            if is_taken:
+                current_n_tokens -= 1
+            # A bucket idle until it is full again is the same as a new one.
+            expire_ts = (
+                now + (token_bucket_size - current_n_tokens) / n_tokens_per_second
+            )
+            self._table.write(offset, key_hash, current_n_tokens, now, expire_ts)
+        return is_taken, current_n_tokens
+
+    async def refill_and_take_async(
+        self,
+        key: str,
+        token_bucket_size: int,
+        n_tokens_per_second: float,
+        n_borrowable_tokens: float = 0,
+    ) -> Tuple[bool, float]:
+        return self.refill_and_take(
+            key, token_bucket_size, n_tokens_per_second, n_borrowable_tokens
+        )
+
+    def incr_with_expiry(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        values = []
+        for key, amount in keys_and_amounts:
+            key_hash = self._table.get_key_hash(key)
+            with self._table.get_lock(key_hash):
+                now = time.monotonic()
+                offset, is_found = self._table.find_slot(key_hash, now)
+                if is_found:
+                    _, value, created_ts, expire_ts = self._table.read(offset)
+                else:
+                    record = self._table.pop_snapshot(key_hash, now)
+                    if record is not None:
+                        value, created_ts, expire_ts = record
+                        is_found = True
+                if is_found:
+                    # A rollback never takes a counter below 0.
+                    value = max(0, value + amount)
+                    self._table.write(offset, key_hash, value, created_ts, expire_ts)
+                elif amount > 0:
+                    value = amount
+                    self._table.write(offset, key_hash, value, now, now + expiry_second)
+                else:
+                    # Nothing to roll back once the counter has expired or been evicted.
+                    value = 0
+            values.append(int(value))
+        return values
+
+    async def incr_with_expiry_async(
+        self, keys_and_amounts: Sequence[Tuple[str, int]], expiry_second: float
+    ) -> List[int]:
+        return self.incr_with_expiry(keys_and_amounts, expiry_second)
+
+    def close(self) -> None:
+        pass
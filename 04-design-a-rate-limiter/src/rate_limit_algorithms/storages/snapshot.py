@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from typing import Iterable, Iterator, Optional, Tuple
+
+_MAGIC = b"RLSNAP01"
+_HEADER = struct.Struct("<8sQ")
+# key hash, value, timestamp and expiry timestamp, both in wall clock seconds.
+_RECORD = struct.Struct("<Qddd")
+_KEY_HASH = struct.Struct("<Q")
+_EXPIRE_TS = struct.Struct("<d")
+_EXPIRE_TS_OFFSET = 24
+
+Record = Tuple[int, float, float, float]
+
+
+def hash_key(key: str) -> int:
+    key_hash = int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+    )
+    return key_hash or 1
+
+
+def write_snapshot(path: str, records: Iterable[Record]) -> int:
+    # Timestamps are on the monotonic clock, which does not survive a reboot.
+    wall_clock_offset = time.time() - time.monotonic()
+    # Later records of the same key hash win.
+    key_hash_to_record = {record[0]: record for record in records}
+    buffer = bytearray(_HEADER.size + len(key_hash_to_record) * _RECORD.size)
+    _HEADER.pack_into(buffer, 0, _MAGIC, len(key_hash_to_record))
+    offset = _HEADER.size
+    for key_hash in sorted(key_hash_to_record):
+        _, value, ts, expire_ts = key_hash_to_record[key_hash]
+        _RECORD.pack_into(
+            buffer,
+            offset,
+            key_hash,
+            value,
+            ts + wall_clock_offset,
+            expire_ts + wall_clock_offset,
+        )
+        offset += _RECORD.size
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(key_hash_to_record)
+
+
+class Snapshot:
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            # A private mapping, so that records taken out are not written back to the file.
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, self._n_records = _HEADER.unpack_from(self._buffer, 0)
+        if (
+            magic != _MAGIC
+            or len(self._buffer) != _HEADER.size + self._n_records * _RECORD.size
+        ):
+            self._buffer.close()
+            raise ValueError(f"{path} is not a snapshot")
+        self._wall_clock_offset = time.time() - time.monotonic()
+
+    @classmethod
+    def open(cls, path: str) -> Optional["Snapshot"]:
+        logger = logging.getLogger(cls.__name__)
+        try:
+            snapshot = cls(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("ignore snapshot %s: %s", path, e)
+            return None
+        logger.info("loaded snapshot %s of %s records", path, len(snapshot))
+        return snapshot
+
+    def __len__(self) -> int:
+        return self._n_records
+
+    def pop(self, key_hash: int, now: float) -> Optional[Tuple[float, float, float]]:
+        lo, hi = 0, self._n_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (mid_key_hash,) = _KEY_HASH.unpack_from(
+                self._buffer, _HEADER.size + mid * _RECORD.size
+            )
+            if mid_key_hash < key_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        offset = _HEADER.size + lo * _RECORD.size
+        if (
+            lo == self._n_records
+            or _KEY_HASH.unpack_from(self._buffer, offset)[0] != key_hash
+        ):
+            return None
+        _, value, ts, expire_ts = _RECORD.unpack_from(self._buffer, offset)
+        # A record is taken out only once. The state may have changed since then.
+        _EXPIRE_TS.pack_into(self._buffer, offset + _EXPIRE_TS_OFFSET, -math.inf)
+        expire_ts -= self._wall_clock_offset
+        if expire_ts <= now:
+            return None
+        return value, ts - self._wall_clock_offset, expire_ts
+
+    def iter_records(self, now: float) -> Iterator[Record]:
+        with memoryview(self._buffer) as buffer:
+            for key_hash, value, ts, expire_ts in _RECORD.iter_unpack(
+                buffer[_HEADER.size :]
+            ):
+                expire_ts -= self._wall_clock_offset
+                if expire_ts > now:
+                    yield key_hash, value, ts - self._wall_clock_offset, expire_ts
+
+    def close(self) -> None:
+        self._buffer.close()
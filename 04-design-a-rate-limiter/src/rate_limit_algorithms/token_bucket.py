@@ -1,188 +1,438 @@
+import asyncio
+import heapq
+import itertools
 import logging
-import socket
+import threading
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
 
 from src.core import Request
-from src.rate_limit_algorithms import RateLimitAlgorithm
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms import ForwardingRateLimitAlgorithm, RateLimitAlgorithm
+from src.rate_limit_algorithms.storages import (
+    Storage,
+    StorageError,
+    StorageProtocolError,
+)
 
+_DelayedRequest = Tuple[Request, Optional[asyncio.Future]]
 
-class BucketIsEmpty(Exception):
-    pass
 
+class _DelayedRequests:
+    def __init__(self) -> None:
+        self._release_deadlines: List[
+            Tuple[float, int, Request, Optional[asyncio.Future]]
+        ] = []
+        # Requests of the same deadline are released in the order they came.
+        self._sequence = itertools.count()
 
-class TokenBucket:
-    def __init__(
-        self,
-        client_ip: str,
-        periodic_second: int,
-        n_tokens_to_be_added_per_periodic_second: int,
-        token_bucket_size: int,
-    ) -> None:
-        self.current_n_tokens = token_bucket_size
+    def __len__(self) -> int:
+        return len(self._release_deadlines)
 
-        self._client_ip = client_ip
-        self._periodic_second = periodic_second
-        self._n_tokens_to_be_added_per_periodic_second = (
-            n_tokens_to_be_added_per_periodic_second
+    @property
+    def next_release_deadline(self) -> Optional[float]:
+        return self._release_deadlines[0][0] if self._release_deadlines else None
+
+    def put(self, delayed_request: _DelayedRequest, release_ts: float) -> None:
+        request, is_processed = delayed_request
+        heapq.heappush(
+            self._release_deadlines,
+            (release_ts, next(self._sequence), request, is_processed),
         )
-        self._token_bucket_size = token_bucket_size
-        self._last_ts = None
-        self._logger = logging.getLogger(
-            f"{self.__class__.__name__} ({self._client_ip})"
+
+    def pop_due(self, now: float) -> List[_DelayedRequest]:
+        due_requests = []
+        while self._release_deadlines and self._release_deadlines[0][0] <= now:
+            _, _, request, is_processed = heapq.heappop(self._release_deadlines)
+            due_requests.append((request, is_processed))
+        return due_requests
+
+    def clear(self) -> List[_DelayedRequest]:
+        delayed_requests = [
+            (request, is_processed)
+            for _, _, request, is_processed in self._release_deadlines
+        ]
+        self._release_deadlines.clear()
+        return delayed_requests
+
+    def take_over(self, delayed_requests: "_DelayedRequests") -> None:
+        self._release_deadlines = delayed_requests._release_deadlines
+        self._sequence = delayed_requests._sequence
+        delayed_requests._release_deadlines = []
+
+
+class _DelayedRequestProcessor(threading.Thread):
+    def __init__(self, n_workers: int, forward_request) -> None:
+        super().__init__(daemon=True)
+        self.is_stop = False
+
+        self._delayed_requests = _DelayedRequests()
+        self._forward_request = forward_request
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=n_workers, thread_name_prefix=self.__class__.__name__
         )
+        self._logger = logging.getLogger(self.__class__.__name__)
 
-    def get_token(self) -> None:
-        if self._last_ts:
-            current_ts = int(time.time())
-            n_tokens_to_be_added = self._n_tokens_to_be_added_per_periodic_second * (
-                (current_ts - self._last_ts) // self._periodic_second
-            )
-            self.current_n_tokens = min(
-                self.current_n_tokens + n_tokens_to_be_added, self._token_bucket_size
-            )
-            self._logger.debug(
-                f"{n_tokens_to_be_added} tokens has been added. current # of tokens is {self.current_n_tokens}"
+    @property
+    def n_delayed_requests(self) -> int:
+        return len(self._delayed_requests)
+
+    def put(self, request: Request, delay_second: float) -> None:
+        with self._condition:
+            next_release_deadline = self._delayed_requests.next_release_deadline
+            self._delayed_requests.put((request, None), time.monotonic() + delay_second)
+            if next_release_deadline != self._delayed_requests.next_release_deadline:
+                self._condition.notify()
+
+    def run(self) -> None:
+        with self._condition:
+            while not self.is_stop:
+                due_requests = self._delayed_requests.pop_due(time.monotonic())
+                if due_requests:
+                    self._logger.debug("release %s delayed requests", len(due_requests))
+                for request, _ in due_requests:
+                    self._executor.submit(self._forward_request, request)
+                next_release_deadline = self._delayed_requests.next_release_deadline
+                self._condition.wait(
+                    None
+                    if next_release_deadline is None
+                    else max(0.0, next_release_deadline - time.monotonic())
+                )
+        self._logger.debug("will be terminated.")
+
+    def hand_over(self, request_processor: "_DelayedRequestProcessor") -> None:
+        with self._condition:
+            if self.is_stop:
+                return
+            self.is_stop = True
+            self._condition.notify()
+            with request_processor._condition:
+                request_processor._delayed_requests.take_over(self._delayed_requests)
+                request_processor._condition.notify()
+        self.join()
+        # Requests which have been released already are still forwarded.
+        self._executor.shutdown(wait=False)
+
+    def stop(self) -> None:
+        with self._condition:
+            if self.is_stop:
+                return
+            self.is_stop = True
+            self._condition.notify()
+            delayed_requests = self._delayed_requests.clear()
+        self.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for request, _ in delayed_requests:
+            request.client_socket.close()
+
+
+class _AsyncDelayedRequestProcessor:
+    def __init__(self, forward_request_async) -> None:
+        self._delayed_requests = _DelayedRequests()
+        self._forward_request_async = forward_request_async
+        self._loop = asyncio.get_running_loop()
+        self._release_timer: Optional[asyncio.TimerHandle] = None
+        self._forward_tasks: Set[asyncio.Task] = set()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def n_delayed_requests(self) -> int:
+        return len(self._delayed_requests)
+
+    def put(
+        self, request: Request, delay_second: float, is_processed: asyncio.Future
+    ) -> None:
+        self._delayed_requests.put(
+            (request, is_processed), self._loop.time() + delay_second
+        )
+        self._schedule_release()
+
+    def hand_over(self, request_processor: "_AsyncDelayedRequestProcessor") -> None:
+        if self._release_timer:
+            self._release_timer.cancel()
+            self._release_timer = None
+        request_processor._delayed_requests.take_over(self._delayed_requests)
+        for forward_task in self._forward_tasks:
+            forward_task.remove_done_callback(self._forward_tasks.discard)
+            forward_task.add_done_callback(request_processor._forward_tasks.discard)
+        request_processor._forward_tasks |= self._forward_tasks
+        self._forward_tasks = set()
+        request_processor._schedule_release()
+
+    def stop(self) -> None:
+        if self._release_timer:
+            self._release_timer.cancel()
+        for forward_task in self._forward_tasks:
+            forward_task.cancel()
+        for request, is_processed in self._delayed_requests.clear():
+            is_processed.cancel()
+            request.client_socket.close()
+
+    def _release(self) -> None:
+        self._release_timer = None
+        due_requests = self._delayed_requests.pop_due(self._loop.time())
+        if due_requests:
+            self._logger.debug("release %s delayed requests", len(due_requests))
+        for request, is_processed in due_requests:
+            forward_task = self._loop.create_task(
+                self._forward_request_async(request, is_processed)
             )
-        if self.current_n_tokens <= 0:
-            raise BucketIsEmpty()
-        self.current_n_tokens -= 1
-        self._last_ts = int(time.time())
+            self._forward_tasks.add(forward_task)
+            forward_task.add_done_callback(self._forward_tasks.discard)
+        self._schedule_release()
+
+    def _schedule_release(self) -> None:
+        next_release_deadline = self._delayed_requests.next_release_deadline
+        if next_release_deadline is None:
+            return
+        if self._release_timer:
+            if self._release_timer.when() <= next_release_deadline:
+                return
+            self._release_timer.cancel()
+        self._release_timer = self._loop.call_at(next_release_deadline, self._release)
 
 
-class TokenBucketAlgorithm(RateLimitAlgorithm):
+class TokenBucketAlgorithm(ForwardingRateLimitAlgorithm):
     def __init__(
         self,
-        periodic_second: int,
+        periodic_second: float,
         n_tokens_to_be_added_per_periodic_second: int,
         token_bucket_size: int,
+        max_delay_second: float,
+        n_workers: int,
+        storage: Storage,
         socket_buf_size: int,
         forward_host: str,
         forward_port: str,
+        upstream_pool_size: int,
+        upstream_idle_timeout_second: float,
+        rule_metrics: RuleMetrics,
     ) -> None:
         self._periodic_second = periodic_second
         self._n_tokens_to_be_added_per_periodic_second = (
             n_tokens_to_be_added_per_periodic_second
         )
         self._token_bucket_size = token_bucket_size
-        self._socket_buf_size = socket_buf_size
-        self._forward_host = forward_host
-        self._forward_port = forward_port
-        self._logger = logging.getLogger(self.__class__.__name__)
-        self._client_ip_to_token_bucket: Dict[str, TokenBucket] = {}
+        self._max_delay_second = max_delay_second
+        self._n_workers = n_workers
+        super().__init__(
+            limit=self._token_bucket_size,
+            retry_after_second=self._periodic_second,
+            socket_buf_size=socket_buf_size,
+            forward_host=forward_host,
+            forward_port=forward_port,
+            upstream_pool_size=upstream_pool_size,
+            upstream_idle_timeout_second=upstream_idle_timeout_second,
+        )
+        self._n_tokens_per_second = (
+            n_tokens_to_be_added_per_periodic_second / periodic_second
+        )
+        # A request may borrow tokens which are refilled within max_delay_second,
+        # and is delayed until its token is refilled.
+        self._n_borrowable_tokens = max_delay_second * self._n_tokens_per_second
+        self._storage = storage
+        self._delayed_request_processor: Optional[_DelayedRequestProcessor] = None
+        self._async_delayed_request_processor: Optional[
+            _AsyncDelayedRequestProcessor
+        ] = None
+        self._rule_metrics = rule_metrics
 
     def setup(self) -> None:
-        pass
+        self._rule_metrics.get_n_keys = self._storage.get_n_keys
+        if self._max_delay_second > 0:
+            self._rule_metrics.get_n_queued_requests = self._get_n_delayed_requests
 
     def handle(self, request: Request) -> None:
-        self._logger.debug(f"handle request of {request.client_address}")
-        token_bucket = self._client_ip_to_token_bucket.get(request.client_ip, None)
-        if not token_bucket:
-            self._logger.debug(
-                f"token bucket of {request.client_ip} has not been created yet. create token bucket"
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
+        try:
+            is_taken, current_n_tokens = self._storage.refill_and_take(
+                request.rate_limit_key,
+                self._token_bucket_size,
+                self._n_tokens_per_second,
+                self._n_borrowable_tokens,
             )
-            token_bucket = TokenBucket(
-                client_ip=request.client_ip,
-                periodic_second=self._periodic_second,
-                n_tokens_to_be_added_per_periodic_second=self._n_tokens_to_be_added_per_periodic_second,
-                token_bucket_size=self._token_bucket_size,
+        except StorageProtocolError:
+            # The storage can not process the request, so it would never be limited.
+            self._logger.exception(
+                "failed to get token. can not forward request from %s",
+                request.client_address,
             )
-            self._client_ip_to_token_bucket[request.client_ip] = token_bucket
-        try:
-            token_bucket.get_token()
-            self._logger.info(
-                f"get token successfully. current [# of tokens / bucket size] is [{token_bucket.current_n_tokens}/{self._token_bucket_size}]"
+            self._rule_metrics.observe_decision(False, started)
+            self._respond_with_storage_error(request)
+            return
+        except StorageError:
+            self._logger.exception(
+                "failed to get token. forward request from %s anyway",
+                request.client_address,
             )
-            self._forward_request(request, token_bucket)
-        except BucketIsEmpty:
+            is_taken, current_n_tokens = True, 0
+        self._rule_metrics.observe_decision(is_taken, started)
+        if not is_taken:
             self._logger.info(
-                f"token bucket is emtpy. can not forward request from {request.client_address}"
+                "token bucket is emtpy. can not forward request from %s",
+                request.client_address,
             )
             self._respond_with_failure(request)
+            return
+        if current_n_tokens < 0:
+            self._delay_request(request, current_n_tokens)
+            return
+        self._logger.info(
+            "get token successfully. current [# of tokens / bucket size] is [%d/%s]",
+            current_n_tokens,
+            self._token_bucket_size,
+        )
+        self._forward_request(request, int(current_n_tokens))
 
-    def _forward_request(self, request: Request, token_bucket: TokenBucket) -> None:
+    async def handle_async(self, request: Request) -> None:
+        started = time.perf_counter()
+        self._logger.debug("handle request of %s", request.client_address)
         try:
-            with socket.socket() as forward_socket:
-                data = request.client_socket.recv(self._socket_buf_size)
-                self._logger.debug(
-                    f"start to connect forward server {self._forward_host}:{self._forward_port}"
-                )
-                forward_socket.connect((self._forward_host, self._forward_port))
-                self._logger.debug(
-                    f"send data to forward server {self._forward_host}:{self._forward_port}"
-                )
-                forward_socket.send(data)
-                data = forward_socket.recv(self._socket_buf_size)
-                decoded_data = data.decode()
-                self._logger.debug(
-                    f"got data from forward server {self._forward_host}:{self._forward_port}"
-                )
-            decoded_data_blocks = decoded_data.split("\r\n\r\n")
-            decoded_data_blocks[0] = (
-                decoded_data_blocks[0]
-                + "\r\n"
-                + "\r\n".join(
-                    f"{k}: {v}"
-                    for k, v in {
-                        "X-Ratelimit-Remaining": token_bucket.current_n_tokens,
-                        "X-Ratelimit-Limit": self._token_bucket_size,
-                        "X-Ratelimit-Retry-After": self._periodic_second,
-                    }.items()
-                )
+            is_taken, current_n_tokens = await self._storage.refill_and_take_async(
+                request.rate_limit_key,
+                self._token_bucket_size,
+                self._n_tokens_per_second,
+                self._n_borrowable_tokens,
             )
-            decoded_data = "\r\n\r\n".join(decoded_data_blocks)
-            data = decoded_data.encode("utf-8")
-            self._logger.debug(f"send data to client {request.client_address}")
-            request.client_socket.send(data)
-        except ConnectionRefusedError as e:
-            content = f"Connection was refused. Make sure the forward server is running on {self._forward_host}:{self._forward_port}"
-            header = "\n".join(
-                [
-                    "HTTP/1.1 503 Service Unavailable",
-                    "\r\n".join(
-                        f"{k}: {v}"
-                        for k, v in {
-                            "Content-Type": "text/plan; encoding=utf8",
-                            "Content-Length": len(content),
-                            "Connection": "close",
-                        }.items()
-                    ),
-                ]
+        except StorageProtocolError:
+            # The storage can not process the request, so it would never be limited.
+            self._logger.exception(
+                "failed to get token. can not forward request from %s",
+                request.client_address,
             )
-            data = "\n\n".join([header, content])
-            self._logger.error(
-                f"send failure response to client {request.client_address}"
+            self._rule_metrics.observe_decision(False, started)
+            await self._respond_with_storage_error_async(request)
+            return
+        except StorageError:
+            self._logger.exception(
+                "failed to get token. forward request from %s anyway",
+                request.client_address,
             )
-            request.client_socket.send(data.encode("utf-8"))
-        finally:
-            request.client_socket.close()
+            is_taken, current_n_tokens = True, 0
+        self._rule_metrics.observe_decision(is_taken, started)
+        if not is_taken:
+            self._logger.info(
+                "token bucket is emtpy. can not forward request from %s",
+                request.client_address,
+            )
+            await self._respond_with_failure_async(request)
+            return
+        if current_n_tokens < 0:
+            await self._delay_request_async(request, current_n_tokens)
+            return
+        self._logger.info(
+            "get token successfully. current [# of tokens / bucket size] is [%d/%s]",
+            current_n_tokens,
+            self._token_bucket_size,
+        )
+        await self._forward_request_async(request, int(current_n_tokens))
 
-    def _respond_with_failure(self, request: Request) -> None:
-        try:
-            content = "Please retry after minutes"
-            header = "\n".join(
-                [
-                    "HTTP/1.1 429 Too many requests",
-                    "\r\n".join(
-                        f"{k}: {v}"
-                        for k, v in {
-                            "Content-Type": "text/plan; encoding=utf8",
-                            "Content-Length": len(content),
-                            "Connection": "close",
-                            "X-Ratelimit-Remaining": 0,
-                            "X-Ratelimit-Limit": self._token_bucket_size,
-                            "X-Ratelimit-Retry-After": self._periodic_second,
-                        }.items()
-                    ),
-                ]
+    def _delay_request(self, request: Request, current_n_tokens: float) -> None:
+        delay_second = -current_n_tokens / self._n_tokens_per_second
+        self._logger.info(
+            "token bucket is empty. delay request from %s for %.3f seconds",
+            request.client_address,
+            delay_second,
+        )
+        if not self._delayed_request_processor:
+            self._delayed_request_processor = self._create_delayed_request_processor()
+        self._delayed_request_processor.put(request, delay_second)
+
+    async def _delay_request_async(
+        self, request: Request, current_n_tokens: float
+    ) -> None:
+        delay_second = -current_n_tokens / self._n_tokens_per_second
+        self._logger.info(
+            "token bucket is empty. delay request from %s for %.3f seconds",
+            request.client_address,
+            delay_second,
+        )
+        if not self._async_delayed_request_processor:
+            self._async_delayed_request_processor = (
+                self._create_async_delayed_request_processor()
             )
-            data = "\n\n".join([header, content])
-            self._logger.info(
-                f"send failure response to client {request.client_address}"
+        is_processed = asyncio.get_running_loop().create_future()
+        self._async_delayed_request_processor.put(request, delay_second, is_processed)
+        await is_processed
+
+    def _forward_delayed_request(self, request: Request) -> None:
+        try:
+            self._forward_request(request, 0)
+        except Exception:
+            self._logger.exception(
+                "failed to forward delayed request of %s", request.client_address
             )
-            request.client_socket.send(data.encode("utf-8"))
-        finally:
             request.client_socket.close()
 
+    async def _forward_delayed_request_async(
+        self, request: Request, is_processed: asyncio.Future
+    ) -> None:
+        try:
+            await self._forward_request_async(request, 0)
+        except Exception as e:
+            if not is_processed.done():
+                is_processed.set_exception(e)
+        else:
+            if not is_processed.done():
+                is_processed.set_result(None)
+
     def teardown(self) -> None:
-        pass
+        if self._delayed_request_processor:
+            self._logger.debug("wait for _DelayedRequestProcessor to be terminated")
+            self._delayed_request_processor.stop()
+        if self._async_delayed_request_processor:
+            self._logger.debug("stop _AsyncDelayedRequestProcessor")
+            self._async_delayed_request_processor.stop()
+        self._forwarder.close()
+        self._storage.close()
+
+    def save_snapshot(self, path: str) -> None:
+        self._storage.save_snapshot(path)
+
+    def load_snapshot(self, path: str) -> None:
+        self._storage.load_snapshot(path)
+
+    def take_over(self, rate_limit_algorithm: RateLimitAlgorithm) -> None:
+        if not isinstance(rate_limit_algorithm, TokenBucketAlgorithm):
+            return
+        self._storage.take_over(rate_limit_algorithm._storage)
+        # Delayed requests are released as they were scheduled, even if shaping is turned off.
+        if rate_limit_algorithm._delayed_request_processor:
+            self._delayed_request_processor = self._create_delayed_request_processor()
+            rate_limit_algorithm._delayed_request_processor.hand_over(
+                self._delayed_request_processor
+            )
+        if rate_limit_algorithm._async_delayed_request_processor:
+            self._async_delayed_request_processor = (
+                self._create_async_delayed_request_processor()
+            )
+            rate_limit_algorithm._async_delayed_request_processor.hand_over(
+                self._async_delayed_request_processor
+            )
+
+    def _get_n_delayed_requests(self) -> int:
+        return sum(
+            request_processor.n_delayed_requests
+            for request_processor in (
+                self._delayed_request_processor,
+                self._async_delayed_request_processor,
+            )
+            if request_processor
+        )
+
+    def _create_delayed_request_processor(self) -> _DelayedRequestProcessor:
+        request_processor = _DelayedRequestProcessor(
+            n_workers=self._n_workers, forward_request=self._forward_delayed_request
+        )
+        request_processor.start()
+        return request_processor
+
+    def _create_async_delayed_request_processor(
+        self,
+    ) -> _AsyncDelayedRequestProcessor:
+        return _AsyncDelayedRequestProcessor(
+            forward_request_async=self._forward_delayed_request_async
+        )
@@ -0,0 +1,72 @@
+from typing import Iterable, Tuple
+
+_TOO_MANY_REQUESTS_CONTENT = b"Please retry after minutes"
+_STORAGE_ERROR_CONTENT = b"Rate limit could not be checked"
+
+
+def encode_header_lines(headers: Iterable[Tuple[str, object]]) -> bytes:
+    return b"".join(f"{k}: {v}\r\n".encode("latin-1") for k, v in headers)
+
+
+def encode_response(
+    status: str, headers: Iterable[Tuple[str, object]], content: bytes
+) -> bytes:
+    return (
+        f"HTTP/1.1 {status}\r\n".encode("latin-1")
+        + encode_header_lines(headers)
+        + b"\r\n"
+        + content
+    )
+
+
+class ResponseTemplates:
+    def __init__(
+        self, limit: int, retry_after_second: float, forward_address: str
+    ) -> None:
+        # Only X-Ratelimit-Remaining changes between responses of a limit configuration,
+        # so the other headers are encoded once and the number is spliced in front of them.
+        self._static_rate_limit_header_lines = encode_header_lines(
+            [
+                ("X-Ratelimit-Limit", limit),
+                ("X-Ratelimit-Retry-After", retry_after_second),
+            ]
+        )
+        self.too_many_requests_response = encode_response(
+            "429 Too many requests",
+            [
+                ("Content-Type", "text/plan; encoding=utf8"),
+                ("Content-Length", len(_TOO_MANY_REQUESTS_CONTENT)),
+                ("Connection", "close"),
+                ("X-Ratelimit-Remaining", 0),
+                ("X-Ratelimit-Limit", limit),
+                ("X-Ratelimit-Retry-After", retry_after_second),
+            ],
+            _TOO_MANY_REQUESTS_CONTENT,
+        )
+        self.storage_error_response = encode_response(
+            "503 Service Unavailable",
+            [
+                ("Content-Type", "text/plan; encoding=utf8"),
+                ("Content-Length", len(_STORAGE_ERROR_CONTENT)),
+                ("Connection", "close"),
+            ],
+            _STORAGE_ERROR_CONTENT,
+        )
+        content = f"Connection was refused. Make sure the forward server is running on {forward_address}".encode(
+            "utf-8"
+        )
+        self.connection_refused_response = encode_response(
+            "503 Service Unavailable",
+            [
+                ("Content-Type", "text/plan; encoding=utf8"),
+                ("Content-Length", len(content)),
+                ("Connection", "close"),
+            ],
+            content,
+        )
+
+    def get_rate_limit_header_lines(self, n_remaining: int) -> bytes:
+        return b"X-Ratelimit-Remaining: %d\r\n%b" % (
+            n_remaining,
+            self._static_rate_limit_header_lines,
+        )
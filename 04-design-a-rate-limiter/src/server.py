@@ -1,45 +1,88 @@
+import asyncio
 import logging
+import signal
 import socket
+import threading
+from typing import Optional, Set, Tuple
 
 from src.config import Config
 from src.config_manager import ConfigManager
 from src.core import GracefulExit, Request
+from src.metrics import DEFAULT_RULE_NAME, Metrics
 from src.rate_limit_algorithms import RateLimitAlgorithm
 from src.rate_limit_algorithms.leaky_bucket import LeakyBucketAlgorithm
+from src.rate_limit_algorithms.rule_engine import RuleEngine
+from src.rate_limit_algorithms.sliding_window_counter import (
+    SlidingWindowCounterAlgorithm,
+)
+from src.rate_limit_algorithms.sliding_window_log import SlidingWindowLogAlgorithm
+from src.rate_limit_algorithms.storages import Storage
+from src.rate_limit_algorithms.storages.local import LocalStorage
+from src.rate_limit_algorithms.storages.remote import RemoteStorage
+from src.rate_limit_algorithms.storages.shared_memory import (
+    SharedMemoryStorage,
+    SharedMemoryTable,
+)
 from src.rate_limit_algorithms.token_bucket import TokenBucketAlgorithm
 
 
 class Server:
     def __init__(
-        self, listen_host: str, listen_port: str, config_manager: ConfigManager
+        self,
+        listen_host: str,
+        listen_port: str,
+        config_manager: ConfigManager,
+        reuse_port: bool = False,
+        shared_memory_table: Optional[SharedMemoryTable] = None,
+        snapshot_path: Optional[str] = None,
     ) -> None:
         self._listen_host = listen_host
         self._listen_port = listen_port
         self._config_manager = config_manager
+        self._reuse_port = reuse_port
+        self._shared_memory_table = shared_memory_table
+        self._snapshot_path = snapshot_path
+        self._rate_limit_algo: Optional[RateLimitAlgorithm] = None
         self._logger = logging.getLogger(self.__class__.__name__)
 
     @property
     def listen_address(self):
         return f"{self._listen_host}:{self._listen_port}"
 
+    def save_snapshot(self) -> None:
+        # The algorithm may be replaced by a reload meanwhile. Its state is taken over by the new one.
+        rate_limit_algo = self._rate_limit_algo
+        if self._snapshot_path and rate_limit_algo:
+            rate_limit_algo.save_snapshot(self._snapshot_path)
+
     def run(self) -> None:
         with socket.socket() as server_socket:
+            if self._reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind((self._listen_host, int(self._listen_port)))
             server_socket.listen()
-            self._logger.info(f"start listening on {self.listen_address}")
+            self._logger.info("start listening on %s", self.listen_address)
             rate_limit_algo = self._create_rate_limit_algorithm(
                 self._config_manager.get_config()
             )
             rate_limit_algo.setup()
+            self._load_snapshot(rate_limit_algo)
+            self._rate_limit_algo = rate_limit_algo
             while True:
+                client_socket = None
                 try:
                     client_socket, client_address = server_socket.accept()
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     if self._config_manager.is_config_changed:
-                        rate_limit_algo.teardown()
-                        rate_limit_algo = self._create_rate_limit_algorithm(
-                            self._config_manager.get_config()
+                        old_rate_limit_algo = rate_limit_algo
+                        rate_limit_algo = self._reload_rate_limit_algorithm(
+                            old_rate_limit_algo, self._config_manager.get_config()
                         )
-                        rate_limit_algo.setup()
+                        self._rate_limit_algo = rate_limit_algo
+                        # Forwards of the old algorithm may be still in flight.
+                        threading.Thread(
+                            target=old_rate_limit_algo.teardown, daemon=True
+                        ).start()
                     client_ip, client_port = client_address
                     request = Request(
                         client_socket=client_socket,
@@ -48,7 +91,7 @@ class Server:
                     )
                     rate_limit_algo.handle(request)
                 except Exception as e:
-                    if self._is_socket_connected(client_socket):
+                    if client_socket and self._is_socket_connected(client_socket):
                         client_socket.close()
                     rate_limit_algo.teardown()
                     if e.__class__ == GracefulExit:
@@ -56,31 +99,261 @@ class Server:
                     raise e
         self._logger.info("server socket has been closed")
 
+    def _load_snapshot(self, rate_limit_algo: RateLimitAlgorithm) -> None:
+        if self._snapshot_path:
+            rate_limit_algo.load_snapshot(self._snapshot_path)
+
+    def _reload_rate_limit_algorithm(
+        self, rate_limit_algo: RateLimitAlgorithm, config: Config
+    ) -> RateLimitAlgorithm:
+        new_rate_limit_algo = self._create_rate_limit_algorithm(config)
+        new_rate_limit_algo.setup()
+        if isinstance(rate_limit_algo, RuleEngine) and not isinstance(
+            new_rate_limit_algo, RuleEngine
+        ):
+            rate_limit_algo = rate_limit_algo.default_rate_limit_algorithm
+        new_rate_limit_algo.take_over(rate_limit_algo)
+        self._logger.info(
+            "reloaded a rate limit algorithm of (%s) instance",
+            config.rate_limit_algorithm,
+        )
+        return new_rate_limit_algo
+
     def _create_rate_limit_algorithm(self, config: Config) -> RateLimitAlgorithm:
+        if not config.rules:
+            return self._create_rate_limit_algorithm_of_config(config)
+        return RuleEngine(
+            rules=config.rules,
+            rule_name_to_rate_limit_algorithm={
+                rule.name: self._create_rate_limit_algorithm_of_config(
+                    config.get_config_of_rule(rule), rule.name
+                )
+                for rule in config.rules
+            },
+            default_rate_limit_algorithm=self._create_rate_limit_algorithm_of_config(
+                config
+            ),
+            api_key_header=config.common.api_key_header,
+            socket_buf_size=config.common.socket_buf_size,
+        )
+
+    def _create_rate_limit_algorithm_of_config(
+        self, config: Config, rule_name: str = DEFAULT_RULE_NAME
+    ) -> RateLimitAlgorithm:
+        rule_metrics = Metrics().get_rule_metrics(rule_name)
         self._logger.debug(
-            f"create a rate limit algorithm of ({config.rate_limit_algorithm}) instance"
+            "create a rate limit algorithm of (%s) instance",
+            config.rate_limit_algorithm,
         )
+        storage = self._create_storage(config)
+        if storage and config.rate_limit_algorithm in (
+            "leaky bucket",
+            "sliding window log",
+        ):
+            self._logger.warning(
+                "state of %s is kept in this process, not in the storage. its limits apply to each process",
+                config.rate_limit_algorithm,
+            )
+            storage.close()
         if config.rate_limit_algorithm == "token bucket":
             return TokenBucketAlgorithm(
                 periodic_second=config.token_bucket.periodic_second,
                 n_tokens_to_be_added_per_periodic_second=config.token_bucket.n_tokens_to_be_added_per_periodic_second,
                 token_bucket_size=config.token_bucket.token_bucket_size,
+                max_delay_second=config.token_bucket.max_delay_second,
+                n_workers=config.token_bucket.n_workers,
+                storage=storage
+                or LocalStorage(config.token_bucket.max_n_token_buckets),
                 socket_buf_size=config.common.socket_buf_size,
                 forward_host=config.common.forward_host,
                 forward_port=config.common.forward_port,
+                upstream_pool_size=config.common.upstream_pool_size,
+                upstream_idle_timeout_second=config.common.upstream_idle_timeout_second,
+                rule_metrics=rule_metrics,
             )
         elif config.rate_limit_algorithm == "leaky bucket":
             return LeakyBucketAlgorithm(
                 periodic_second=config.leaky_bucket.periodic_second,
                 n_request_to_be_processed_per_periodic_second=config.leaky_bucket.n_request_to_be_processed_per_periodic_second,
                 request_queue_size=config.leaky_bucket.request_queue_size,
+                n_workers=config.leaky_bucket.n_workers,
+                socket_buf_size=config.common.socket_buf_size,
+                forward_host=config.common.forward_host,
+                forward_port=config.common.forward_port,
+                upstream_pool_size=config.common.upstream_pool_size,
+                upstream_idle_timeout_second=config.common.upstream_idle_timeout_second,
+                rule_metrics=rule_metrics,
+            )
+        if config.rate_limit_algorithm == "sliding window log":
+            return SlidingWindowLogAlgorithm(
+                window_second=config.sliding_window_log.window_second,
+                max_n_requests_per_window=config.sliding_window_log.max_n_requests_per_window,
+                max_n_keys=config.sliding_window_log.max_n_keys,
                 socket_buf_size=config.common.socket_buf_size,
                 forward_host=config.common.forward_host,
                 forward_port=config.common.forward_port,
+                upstream_pool_size=config.common.upstream_pool_size,
+                upstream_idle_timeout_second=config.common.upstream_idle_timeout_second,
+                rule_metrics=rule_metrics,
+            )
+        if config.rate_limit_algorithm == "sliding window counter":
+            return SlidingWindowCounterAlgorithm(
+                window_second=config.sliding_window_counter.window_second,
+                max_n_requests_per_window=config.sliding_window_counter.max_n_requests_per_window,
+                max_n_keys=config.sliding_window_counter.max_n_keys,
+                socket_buf_size=config.common.socket_buf_size,
+                forward_host=config.common.forward_host,
+                forward_port=config.common.forward_port,
+                upstream_pool_size=config.common.upstream_pool_size,
+                upstream_idle_timeout_second=config.common.upstream_idle_timeout_second,
+                rule_metrics=rule_metrics,
+                storage=storage,
             )
         raise NotImplementedError(
-            f"config.rate_limit_algorithm must be 'token bucket' or 'leaky bucket'. (current: {config.rate_limit_algorithm})"
+            f"config.rate_limit_algorithm must be one of 'token bucket', 'leaky bucket', 'sliding window log' or 'sliding window counter'. (current: {config.rate_limit_algorithm})"
         )
 
+    def _create_storage(self, config: Config) -> Optional[Storage]:
+        if config.common.storage == "remote":
+            return RemoteStorage(
+                storage_host=config.common.storage_host,
+                storage_port=config.common.storage_port,
+                timeout_second=config.common.storage_timeout_second,
+            )
+        if self._shared_memory_table:
+            return SharedMemoryStorage(self._shared_memory_table)
+        return None
+
     def _is_socket_connected(self, s: socket.socket) -> bool:
         return s.fileno() != -1
+
+
+class AsyncServer(Server):
+    def __init__(
+        self,
+        listen_host: str,
+        listen_port: str,
+        config_manager: ConfigManager,
+        reuse_port: bool = False,
+        shared_memory_table: Optional[SharedMemoryTable] = None,
+        snapshot_path: Optional[str] = None,
+    ) -> None:
+        super().__init__(
+            listen_host,
+            listen_port,
+            config_manager,
+            reuse_port,
+            shared_memory_table,
+            snapshot_path,
+        )
+        self._client_keep_alive_timeout_second = 0.0
+        self._handle_tasks: Set[asyncio.Task] = set()
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+        self._logger.info("server socket has been closed")
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        serve_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, serve_task.cancel)
+        with socket.socket() as server_socket:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind((self._listen_host, int(self._listen_port)))
+            server_socket.listen(socket.SOMAXCONN)
+            server_socket.setblocking(False)
+            self._logger.info("start listening on %s", self.listen_address)
+            self._update_rate_limit_algorithm()
+            try:
+                while True:
+                    client_socket, client_address = await loop.sock_accept(
+                        server_socket
+                    )
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    if self._config_manager.is_config_changed:
+                        old_rate_limit_algo = self._rate_limit_algo
+                        self._update_rate_limit_algorithm()
+                        old_rate_limit_algo.teardown()
+                    handle_task = loop.create_task(
+                        self._handle(client_socket, client_address)
+                    )
+                    self._handle_tasks.add(handle_task)
+                    handle_task.add_done_callback(self._handle_tasks.discard)
+            except asyncio.CancelledError:
+                self._logger.debug("got shutdown signal")
+            finally:
+                for handle_task in self._handle_tasks:
+                    handle_task.cancel()
+                self._rate_limit_algo.teardown()
+
+    def _update_rate_limit_algorithm(self) -> None:
+        config = self._config_manager.get_config()
+        if self._rate_limit_algo:
+            self._rate_limit_algo = self._reload_rate_limit_algorithm(
+                self._rate_limit_algo, config
+            )
+        else:
+            self._rate_limit_algo = self._create_rate_limit_algorithm(config)
+            self._rate_limit_algo.setup()
+            self._load_snapshot(self._rate_limit_algo)
+        self._client_keep_alive_timeout_second = (
+            config.common.client_keep_alive_timeout_second
+        )
+
+    async def _handle(
+        self, client_socket: socket.socket, client_address: Tuple[str, int]
+    ) -> None:
+        client_ip, client_port = client_address
+        received = b""
+        try:
+            while True:
+                request = Request(
+                    client_socket=client_socket,
+                    client_ip=client_ip,
+                    client_port=client_port,
+                    keep_alive_enabled=self._client_keep_alive_timeout_second > 0,
+                    received=received,
+                )
+                await self._rate_limit_algo.handle_async(request)
+                if not request.keep_alive:
+                    break
+                # The next request may have been read already with this one.
+                received = request.received
+                if not received and not await self._wait_for_next_request(
+                    client_socket
+                ):
+                    self._logger.debug(
+                        "keep-alive connection of %s has been closed",
+                        request.client_address,
+                    )
+                    break
+        except Exception:
+            self._logger.exception(
+                "failed to handle request of %s:%s", client_ip, client_port
+            )
+        finally:
+            if self._is_socket_connected(client_socket):
+                client_socket.close()
+
+    async def _wait_for_next_request(self, client_socket: socket.socket) -> bool:
+        loop = asyncio.get_running_loop()
+        is_readable = loop.create_future()
+        loop.add_reader(
+            client_socket.fileno(),
+            lambda: is_readable.done() or is_readable.set_result(None),
+        )
+        try:
+            await asyncio.wait_for(
+                is_readable, timeout=self._client_keep_alive_timeout_second
+            )
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(client_socket.fileno())
+        try:
+            return client_socket.recv(1, socket.MSG_PEEK) != b""
+        except (BlockingIOError, ConnectionResetError):
+            return False
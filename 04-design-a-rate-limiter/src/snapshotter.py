@@ -0,0 +1,36 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+
+class Snapshotter(threading.Thread):
+    def __init__(
+        self, save_snapshot: Callable[[], None], interval_second: float
+    ) -> None:
+        super().__init__(daemon=True)
+        self._save_snapshot = save_snapshot
+        self._interval_second = interval_second
+        self._stopped = threading.Event()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval_second):
+            self._save()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        self._save()
+
+    def _save(self) -> None:
+        start_ts = time.monotonic()
+        try:
+            self._save_snapshot()
+        except Exception:
+            self._logger.exception("failed to save a snapshot")
+            return
+        self._logger.debug(
+            "saved a snapshot in %.3f seconds", time.monotonic() - start_ts
+        )
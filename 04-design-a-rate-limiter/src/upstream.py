@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Deque, Iterator, Optional
+
+from src.metrics import Metrics
+
+
+class UpstreamConnection:
+    def __init__(self, sock: socket.socket) -> None:
+        self.socket = sock
+        self.n_uses = 0
+        self.is_reusable = False
+        self.last_used_ts = time.monotonic()
+
+    @property
+    def is_reused(self) -> bool:
+        return self.n_uses > 1
+
+    def is_alive(self) -> bool:
+        is_blocking = self.socket.getblocking()
+        try:
+            self.socket.setblocking(False)
+            # An idle keep-alive connection must have nothing to read.
+            # Empty bytes means the peer has closed it, and any data is unexpected.
+            self.socket.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            if self.socket.fileno() != -1:
+                self.socket.setblocking(is_blocking)
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+class _BaseUpstreamConnectionPool:
+    def __init__(
+        self,
+        forward_host: str,
+        forward_port: int,
+        pool_size: int,
+        idle_timeout_second: float,
+    ) -> None:
+        self._forward_host = forward_host
+        self._forward_port = forward_port
+        self._pool_size = pool_size
+        self._idle_timeout_second = idle_timeout_second
+        self._idle_connections: Deque[UpstreamConnection] = deque()
+        self._is_closed = False
+        self._metrics = Metrics()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def forward_address(self) -> str:
+        return f"{self._forward_host}:{self._forward_port}"
+
+    @property
+    def n_idle_connections(self) -> int:
+        return len(self._idle_connections)
+
+    def close(self) -> None:
+        self._is_closed = True
+        while self._idle_connections:
+            self._idle_connections.pop().close()
+
+    def _pop_healthy_idle_connection(self) -> Optional[UpstreamConnection]:
+        while self._idle_connections:
+            connection = self._idle_connections.pop()
+            idle_second = time.monotonic() - connection.last_used_ts
+            if idle_second >= self._idle_timeout_second:
+                self._logger.debug(
+                    "connection to %s has been idle for %.1fs. replace it",
+                    self.forward_address,
+                    idle_second,
+                )
+                connection.close()
+                continue
+            if not connection.is_alive():
+                self._logger.debug(
+                    "connection to %s is not alive. replace it", self.forward_address
+                )
+                connection.close()
+                continue
+            return connection
+        return None
+
+    def _push_idle_connection(self, connection: UpstreamConnection) -> None:
+        if self._is_closed or not connection.is_reusable:
+            connection.close()
+            return
+        connection.is_reusable = False
+        connection.last_used_ts = time.monotonic()
+        self._idle_connections.append(connection)
+        while (
+            self._idle_connections
+            and time.monotonic() - self._idle_connections[0].last_used_ts
+            >= self._idle_timeout_second
+        ):
+            self._idle_connections.popleft().close()
+
+
+class UpstreamConnectionPool(_BaseUpstreamConnectionPool):
+    def __init__(
+        self,
+        forward_host: str,
+        forward_port: int,
+        pool_size: int,
+        idle_timeout_second: float,
+    ) -> None:
+        super().__init__(forward_host, forward_port, pool_size, idle_timeout_second)
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(pool_size)
+
+    def acquire(self, fresh: bool = False) -> UpstreamConnection:
+        self._semaphore.acquire()
+        try:
+            with self._lock:
+                connection = None if fresh else self._pop_healthy_idle_connection()
+            if connection is None:
+                connection = self._connect()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        connection.n_uses += 1
+        return connection
+
+    def release(self, connection: UpstreamConnection) -> None:
+        with self._lock:
+            self._push_idle_connection(connection)
+        self._semaphore.release()
+
+    @contextmanager
+    def connection(self, fresh: bool = False) -> Iterator[UpstreamConnection]:
+        connection = self.acquire(fresh)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        with self._lock:
+            super().close()
+
+    def _connect(self) -> UpstreamConnection:
+        self._logger.debug("start to connect forward server %s", self.forward_address)
+        started = time.perf_counter()
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect((self._forward_host, self._forward_port))
+        except OSError:
+            sock.close()
+            raise
+        self._metrics.upstream_connect_second.observe_since(started)
+        return UpstreamConnection(sock)
+
+
+class AsyncUpstreamConnectionPool(_BaseUpstreamConnectionPool):
+    def __init__(
+        self,
+        forward_host: str,
+        forward_port: int,
+        pool_size: int,
+        idle_timeout_second: float,
+    ) -> None:
+        super().__init__(forward_host, forward_port, pool_size, idle_timeout_second)
+        self._semaphore = asyncio.Semaphore(pool_size)
+
+    async def acquire(self, fresh: bool = False) -> UpstreamConnection:
+        await self._semaphore.acquire()
+        try:
+            connection = None if fresh else self._pop_healthy_idle_connection()
+            if connection is None:
+                connection = await self._connect()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        connection.n_uses += 1
+        return connection
+
+    def release(self, connection: UpstreamConnection) -> None:
+        self._push_idle_connection(connection)
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def connection(
+        self, fresh: bool = False
+    ) -> AsyncIterator[UpstreamConnection]:
+        connection = await self.acquire(fresh)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    async def _connect(self) -> UpstreamConnection:
+        self._logger.debug("start to connect forward server %s", self.forward_address)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        sock = socket.socket()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (self._forward_host, self._forward_port))
+        except (OSError, asyncio.CancelledError):
+            sock.close()
+            raise
+        self._metrics.upstream_connect_second.observe_since(started)
+        return UpstreamConnection(sock)
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.counter_server import CounterServer
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._echo()
+
+    def do_POST(self):
+        self._echo()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _echo(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content = f"{self.command} {self.path} ".encode() + body
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class EchoServer(ThreadingHTTPServer):
+    daemon_threads = True
+    n_connections = 0
+
+    def process_request(self, request, client_address):
+        self.n_connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def upstream_server():
+    server = EchoServer(("127.0.0.1", 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def upstream_address(upstream_server):
+    return upstream_server.server_address
+
+
+@pytest.fixture
+def counter_server_address():
+    loop = asyncio.new_event_loop()
+    counter_server = CounterServer("127.0.0.1", "0", max_n_keys=100)
+    server = loop.run_until_complete(
+        asyncio.start_server(counter_server._handle, "127.0.0.1", 0)
+    )
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[:2]
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.wait(tasks))
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
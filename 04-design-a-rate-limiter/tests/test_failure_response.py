@@ -0,0 +1,121 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from src.core import Request
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms.sliding_window_log import SlidingWindowLogAlgorithm
+
+
+@pytest.fixture
+def rate_limit_algorithm():
+    rate_limit_algorithm = SlidingWindowLogAlgorithm(
+        window_second=1,
+        max_n_requests_per_window=1,
+        max_n_keys=100,
+        socket_buf_size=1024,
+        forward_host="127.0.0.1",
+        forward_port="0",
+        upstream_pool_size=1,
+        upstream_idle_timeout_second=1,
+        rule_metrics=RuleMetrics(),
+    )
+    yield rate_limit_algorithm
+    rate_limit_algorithm.teardown()
+
+
+def recv_until_eof(sock):
+    sock.settimeout(5)
+    data = b""
+    while received := sock.recv(65536):
+        data += received
+    return data
+
+
+def respond_with_failure(rate_limit_algorithm, request, is_async):
+    started = time.monotonic()
+    if is_async:
+        request.client_socket.setblocking(False)
+        asyncio.run(rate_limit_algorithm._respond_with_failure_async(request))
+    else:
+        rate_limit_algorithm._respond_with_failure(request)
+    return time.monotonic() - started
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+@pytest.mark.parametrize(
+    "request_data",
+    [
+        b"GET / HTTP/1.1\r\nHost: test\r\n\r\n",
+        b"POST / HTTP/1.1\r\nHost: test\r\nContent-Length: 4\r\n\r\nbody",
+    ],
+)
+def test_failure_response_does_not_wait_for_idle_client(
+    rate_limit_algorithm, request_data, is_async
+):
+    # given
+    client_socket, server_socket = socket.socketpair()
+    client_socket.sendall(request_data)
+    request = Request(server_socket, "127.0.0.1", "0")
+
+    try:
+        # when
+        elapsed_second = respond_with_failure(rate_limit_algorithm, request, is_async)
+
+        # then
+        assert elapsed_second < 0.05
+        assert recv_until_eof(client_socket).startswith(b"HTTP/1.1 429 ")
+    finally:
+        client_socket.close()
+        server_socket.close()
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+def test_failure_response_waits_for_unreceived_body_up_to_timeout(
+    rate_limit_algorithm, is_async
+):
+    # given
+    client_socket, server_socket = socket.socketpair()
+    client_socket.sendall(
+        b"POST / HTTP/1.1\r\nHost: test\r\nContent-Length: 1000000\r\n\r\nbody"
+    )
+    request = Request(server_socket, "127.0.0.1", "0")
+
+    try:
+        # when
+        elapsed_second = respond_with_failure(rate_limit_algorithm, request, is_async)
+
+        # then
+        assert elapsed_second < 0.5
+        assert recv_until_eof(client_socket).startswith(b"HTTP/1.1 429 ")
+    finally:
+        client_socket.close()
+        server_socket.close()
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+def test_failure_response_reads_body_sent_after_it(rate_limit_algorithm, is_async):
+    # given
+    client_socket, server_socket = socket.socketpair()
+    body = b"x" * 32768
+    client_socket.sendall(
+        b"POST / HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n" % len(body)
+    )
+    request = Request(server_socket, "127.0.0.1", "0")
+    sender = threading.Thread(target=client_socket.sendall, args=(body,))
+
+    try:
+        # when
+        sender.start()
+        respond_with_failure(rate_limit_algorithm, request, is_async)
+        sender.join(5)
+
+        # then
+        assert not sender.is_alive()
+        assert recv_until_eof(client_socket).startswith(b"HTTP/1.1 429 ")
+    finally:
+        client_socket.close()
+        server_socket.close()
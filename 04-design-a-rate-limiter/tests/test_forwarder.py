@@ -0,0 +1,147 @@
+import asyncio
+import re
+import socket
+
+import pytest
+
+from src.core import Request
+from src.forwarder import Forwarder
+
+PIPELINED_REQUESTS = [
+    b"GET /first HTTP/1.1\r\nHost: test\r\n\r\n"
+    b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n",
+    b"POST /first HTTP/1.1\r\nHost: test\r\nContent-Length: 4\r\n\r\nbody"
+    b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n",
+]
+
+
+def create_forwarder(upstream_address, socket_buf_size=65536):
+    return Forwarder(
+        forward_host=upstream_address[0],
+        forward_port=upstream_address[1],
+        socket_buf_size=socket_buf_size,
+        upstream_pool_size=1,
+        upstream_idle_timeout_second=30,
+    )
+
+
+def recv_response_bodies(sock, n_responses):
+    sock.settimeout(5)
+    data = b""
+    bodies = []
+    while len(bodies) < n_responses:
+        match = re.match(
+            rb"HTTP/1\.1 200 .*?Content-Length: (\d+)\r\n.*?\r\n\r\n", data, re.S
+        )
+        if match and len(data) >= match.end() + int(match.group(1)):
+            end = match.end() + int(match.group(1))
+            bodies.append(data[match.end() : end])
+            data = data[end:]
+            continue
+        received = sock.recv(65536)
+        assert received, "connection was closed before the responses"
+        data += received
+    return bodies
+
+
+def forward_twice(forwarder, request, is_async):
+    # Returns what is left in request.received after each request.
+    if not is_async:
+        request.client_socket.settimeout(5)
+        results = []
+        for _ in range(2):
+            forwarder.forward(request, b"")
+            results.append((request.keep_alive, request.received))
+        return results
+
+    async def forward_twice_async():
+        results = []
+        for _ in range(2):
+            await forwarder.forward_async(request, b"")
+            results.append((request.keep_alive, request.received))
+        return results
+
+    request.client_socket.setblocking(False)
+    return asyncio.run(asyncio.wait_for(forward_twice_async(), 5))
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+@pytest.mark.parametrize("pipelined_request", PIPELINED_REQUESTS)
+def test_forward_keeps_pipelined_request_for_the_next_one(
+    upstream_address, pipelined_request, is_async
+):
+    # given
+    forwarder = create_forwarder(upstream_address)
+    client_socket, server_socket = socket.socketpair()
+    request = Request(server_socket, "127.0.0.1", "0", keep_alive_enabled=True)
+    client_socket.sendall(pipelined_request)
+
+    try:
+        # when
+        results = forward_twice(forwarder, request, is_async)
+
+        # then
+        (keep_alive, received), (_, next_received) = results
+        assert keep_alive
+        assert received == b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n"
+        assert next_received == b""
+        bodies = recv_response_bodies(client_socket, 2)
+        assert bodies[0].startswith(pipelined_request.split(b" HTTP", 1)[0])
+        assert bodies[1] == b"GET /second "
+    finally:
+        forwarder.close()
+        client_socket.close()
+        server_socket.close()
+
+
+def test_forward_reuses_upstream_connection(upstream_server):
+    # given
+    forwarder = create_forwarder(upstream_server.server_address)
+    paths = [b"/first", b"/second", b"/third"]
+
+    try:
+        for path in paths:
+            client_socket, server_socket = socket.socketpair()
+            request = Request(server_socket, "127.0.0.1", "0")
+            client_socket.sendall(b"GET %s HTTP/1.1\r\nHost: test\r\n\r\n" % path)
+
+            # when
+            forwarder.forward(request, b"")
+
+            # then
+            assert recv_response_bodies(client_socket, 1) == [b"GET %s " % path]
+            client_socket.close()
+            server_socket.close()
+        assert upstream_server.n_connections == 1
+    finally:
+        forwarder.close()
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+def test_forward_streams_bodies_larger_than_the_buffer(upstream_address, is_async):
+    # given
+    # Both the request and the echoed response are larger than the buffer,
+    # so they are relayed after their heads.
+    forwarder = create_forwarder(upstream_address, socket_buf_size=1024)
+    client_socket, server_socket = socket.socketpair()
+    request = Request(server_socket, "127.0.0.1", "0", keep_alive_enabled=True)
+    body = bytes(range(256)) * 12
+    client_socket.sendall(
+        b"POST /first HTTP/1.1\r\nHost: test\r\nContent-Length: %d\r\n\r\n%s"
+        b"GET /second HTTP/1.1\r\nHost: test\r\n\r\n" % (len(body), body)
+    )
+
+    try:
+        # when
+        results = forward_twice(forwarder, request, is_async)
+
+        # then
+        assert [keep_alive for keep_alive, _ in results] == [True, True]
+        assert recv_response_bodies(client_socket, 2) == [
+            b"POST /first " + body,
+            b"GET /second ",
+        ]
+    finally:
+        forwarder.close()
+        client_socket.close()
+        server_socket.close()
@@ -0,0 +1,139 @@
+import time
+
+import yaml
+
+from src.config_manager import ConfigManager
+from src.rate_limit_algorithms.sliding_window_counter import SlidingWindowCounterStore
+from src.rate_limit_algorithms.sliding_window_log import SlidingWindowLogStore
+from src.rate_limit_algorithms.storages.local import LocalStorage
+
+
+def wait_until(predicate, timeout_second=3):
+    deadline = time.monotonic() + timeout_second
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_local_storage_takes_over_token_buckets_and_counters():
+    # given
+    old_storage = LocalStorage(max_n_keys=100)
+    old_storage.refill_and_take("a", 2, 0.001, now=0)
+    old_storage.incr_with_expiry((("b", 3),), 60, now=0)
+    new_storage = LocalStorage(max_n_keys=100)
+
+    # when
+    new_storage.take_over(old_storage)
+
+    # then
+    assert new_storage.refill_and_take("a", 2, 0.001, now=0) == (True, 0)
+    assert new_storage.incr_with_expiry((("b", 1),), 60, now=0) == [4]
+    assert old_storage.n_token_buckets == old_storage.n_counters == 0
+
+
+def test_sliding_window_log_store_resizes_taken_over_logs():
+    # given
+    now = time.monotonic()
+    old_store = SlidingWindowLogStore(
+        window_second=100, max_n_requests_per_window=3, max_n_keys=100
+    )
+    for _ in range(3):
+        old_store.try_acquire(old_store.get("1.1.1.1"), now=now)
+    larger_store = SlidingWindowLogStore(
+        window_second=100, max_n_requests_per_window=5, max_n_keys=100
+    )
+
+    # when
+    larger_store.take_over(old_store)
+    sliding_window_log = larger_store.get("1.1.1.1")
+    results = [larger_store.try_acquire(sliding_window_log, now=now) for _ in range(3)]
+
+    # then
+    assert results == [True, True, False]
+
+
+def test_sliding_window_log_store_takes_over_logs_of_the_same_size():
+    # given
+    now = time.monotonic()
+    old_store = SlidingWindowLogStore(
+        window_second=100, max_n_requests_per_window=2, max_n_keys=100
+    )
+    old_store.try_acquire(old_store.get("1.1.1.1"), now=now)
+    new_store = SlidingWindowLogStore(
+        window_second=100, max_n_requests_per_window=2, max_n_keys=100
+    )
+
+    # when
+    new_store.take_over(old_store)
+    sliding_window_log = new_store.get("1.1.1.1")
+    results = [new_store.try_acquire(sliding_window_log, now=now) for _ in range(2)]
+
+    # then
+    assert results == [True, False]
+
+
+def test_sliding_window_counter_store_converts_counters_to_the_new_window():
+    # given
+    old_store = SlidingWindowCounterStore(
+        window_second=100, max_n_requests_per_window=5, max_n_keys=100
+    )
+    sliding_window_counter = old_store.get("1.1.1.1")
+    for _ in range(4):
+        old_store.try_acquire(sliding_window_counter, now=time.monotonic())
+    new_store = SlidingWindowCounterStore(
+        window_second=50, max_n_requests_per_window=5, max_n_keys=100
+    )
+
+    # when
+    new_store.take_over(old_store)
+    sliding_window_counter = new_store.get("1.1.1.1")
+    results = [
+        new_store.try_acquire(sliding_window_counter, now=time.monotonic())
+        for _ in range(2)
+    ]
+
+    # then
+    assert results == [True, False]
+
+
+def test_config_manager_reloads_changed_config(tmp_path):
+    # given
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.dump({"rate_limit_algorithm": "token bucket"}))
+    config_manager = ConfigManager(str(config_path))
+    config_manager.start()
+
+    try:
+        # when
+        # The file is watched once the thread runs, so it is changed after that.
+        time.sleep(0.2)
+        config_path.write_text(yaml.dump({"rate_limit_algorithm": "leaky bucket"}))
+
+        # then
+        assert wait_until(lambda: config_manager.is_config_changed)
+        assert config_manager.get_config().rate_limit_algorithm == "leaky bucket"
+        assert not config_manager.is_config_changed
+    finally:
+        config_manager.stop()
+        config_manager.join()
+
+
+def test_config_manager_keeps_current_config_when_new_one_is_invalid(tmp_path):
+    # given
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.dump({"rate_limit_algorithm": "token bucket"}))
+    config_manager = ConfigManager(str(config_path))
+    config_manager.start()
+
+    try:
+        # when
+        time.sleep(0.2)
+        config_path.write_text(yaml.dump({"rate_limit_algorithm": "unknown"}))
+        time.sleep(0.3)
+
+        # then
+        assert not config_manager.is_config_changed
+        assert config_manager.get_config().rate_limit_algorithm == "token bucket"
+    finally:
+        config_manager.stop()
+        config_manager.join()
@@ -0,0 +1,135 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from src.core import Request
+from src.rate_limit_algorithms.leaky_bucket import _RequestProcessor, _RequestQueues
+
+
+@pytest.fixture
+def create_request():
+    requests = []
+
+    def create(client_ip):
+        requests.append(Request(socket.socket(), client_ip, "0"))
+        return requests[-1]
+
+    yield create
+    for request in requests:
+        request.client_socket.close()
+
+
+def create_request_queues(request_queue_size=3):
+    return _RequestQueues(
+        periodic_second=1,
+        n_request_to_be_processed_per_periodic_second=2,
+        request_queue_size=request_queue_size,
+    )
+
+
+def test_put_refuses_requests_over_the_queue_size(create_request):
+    # given
+    request_queues = create_request_queues()
+
+    # when
+    is_puts = [
+        request_queues.put((create_request("1.1.1.1"), None), now=0) for _ in range(4)
+    ]
+    is_other_put = request_queues.put((create_request("2.2.2.2"), None), now=0)
+
+    # then
+    assert is_puts == [True, True, True, False]
+    assert is_other_put
+    assert request_queues.qsize("1.1.1.1") == 3
+    assert request_queues.n_queued_requests == 4
+
+
+def test_pop_due_drains_each_queue_at_its_own_deadline(create_request):
+    # given
+    request_queues = create_request_queues()
+    for _ in range(3):
+        request_queues.put((create_request("1.1.1.1"), None), now=0)
+    request_queues.put((create_request("2.2.2.2"), None), now=0.5)
+
+    # when
+    due_at_0 = request_queues.pop_due(now=0)
+    due_at_0_9 = request_queues.pop_due(now=0.9)
+    due_at_1 = request_queues.pop_due(now=1)
+
+    # then
+    assert [request.client_ip for (request, _), _ in due_at_0] == ["1.1.1.1"] * 2
+    assert [n_remaining for _, n_remaining in due_at_0] == [1, 2]
+    assert [request.client_ip for (request, _), _ in due_at_0_9] == ["2.2.2.2"]
+    assert [request.client_ip for (request, _), _ in due_at_1] == ["1.1.1.1"]
+    assert request_queues.n_queued_requests == 0
+    assert request_queues.next_drain_deadline == 1.9
+
+
+def test_idle_queue_is_removed_at_its_next_deadline(create_request):
+    # given
+    request_queues = create_request_queues()
+    request_queues.put((create_request("1.1.1.1"), None), now=0)
+    request_queues.pop_due(now=0)
+
+    # when
+    request_queues.pop_due(now=1)
+
+    # then
+    assert request_queues.n_client_ips == 0
+    assert request_queues.next_drain_deadline is None
+
+
+def test_take_over_moves_queued_requests(create_request):
+    # given
+    old_request_queues = create_request_queues()
+    old_request_queues.put((create_request("1.1.1.1"), None), now=0)
+    new_request_queues = create_request_queues(request_queue_size=1)
+
+    # when
+    new_request_queues.take_over(old_request_queues)
+
+    # then
+    assert new_request_queues.n_queued_requests == 1
+    assert not new_request_queues.put((create_request("1.1.1.1"), None), now=0)
+    assert old_request_queues.n_client_ips == 0
+    assert old_request_queues.pop_due(now=0) == []
+
+
+def test_one_scheduler_thread_drains_queues_of_many_clients(create_request):
+    # given
+    forwarded_client_ips = []
+    lock = threading.Lock()
+
+    def forward_request(request, n_remaining):
+        with lock:
+            forwarded_client_ips.append(request.client_ip)
+
+    request_processor = _RequestProcessor(
+        create_request_queues(), n_workers=2, forward_request=forward_request
+    )
+    n_threads = threading.active_count()
+    client_ips = [f"10.0.0.{i}" for i in range(50)]
+    for client_ip in client_ips:
+        for _ in range(3):
+            assert request_processor.put(create_request(client_ip))
+
+    try:
+        # when
+        request_processor.start()
+
+        # then
+        deadline = time.monotonic() + 0.5
+        while len(forwarded_client_ips) < 100 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(forwarded_client_ips) == sorted(client_ips * 2)
+        # The scheduler and the 2 workers, rather than a thread per client.
+        assert threading.active_count() <= n_threads + 3
+
+        deadline = time.monotonic() + 2
+        while len(forwarded_client_ips) < 150 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(forwarded_client_ips) == sorted(client_ips * 3)
+    finally:
+        request_processor.stop()
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from src.limiter import TokenBucketLimiter
+
+
+def test_allow_of_a_batch_is_the_same_as_allowing_keys_one_by_one():
+    # given
+    random_ = random.Random(0)
+    batches = [
+        [random_.choice("abcde") for _ in range(random_.randrange(1, 20))]
+        for _ in range(20)
+    ]
+    batch_limiter = TokenBucketLimiter(3, 2, max_n_keys=100, initial_capacity=2)
+    one_by_one_limiter = TokenBucketLimiter(3, 2, max_n_keys=100, initial_capacity=2)
+
+    for i, batch in enumerate(batches):
+        # when
+        allowed = batch_limiter.allow(batch, now=i * 0.3)
+
+        # then
+        assert allowed == [
+            one_by_one_limiter.allow([key], now=i * 0.3)[0] for key in batch
+        ]
+
+
+def test_allow_refills_tokens_over_time():
+    # given
+    limiter = TokenBucketLimiter(2, 4, max_n_keys=100)
+    limiter.allow(["a", "a"], now=0)
+
+    # when
+    allowed_at_0_1 = limiter.allow(["a"], now=0.1)
+    allowed_at_0_6 = limiter.allow(["a", "a", "a"], now=0.6)
+
+    # then
+    assert allowed_at_0_1 == [False]
+    assert allowed_at_0_6 == [True, True, False]
+    assert limiter.get_current_n_tokens(["a", "b"], now=0.6) == [0, 2]
+
+
+def test_allow_evicts_least_recently_used_keys_over_max_n_keys():
+    # given
+    limiter = TokenBucketLimiter(1, 0.001, max_n_keys=4, initial_capacity=1)
+    for i, key in enumerate("abcd"):
+        limiter.allow([key], now=i)
+    limiter.allow(["a"], now=4)
+
+    # when
+    allowed = limiter.allow(["e", "a"], now=5)
+
+    # then
+    assert allowed == [True, False]
+    assert limiter.n_keys == 4
+    assert limiter.allow(["b"], now=6) == [True]
+
+
+def test_allow_refuses_a_batch_with_more_keys_than_max_n_keys():
+    # given
+    limiter = TokenBucketLimiter(1, 1, max_n_keys=2)
+
+    # then
+    with pytest.raises(ValueError):
+        limiter.allow(["a", "b", "c"], now=0)
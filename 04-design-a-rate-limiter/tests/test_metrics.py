@@ -0,0 +1,98 @@
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from src.admin_server import AdminServer
+from src.metrics import Histogram, Metrics, RuleMetrics
+
+
+def test_histogram_renders_cumulative_buckets():
+    # given
+    histogram = Histogram(bucket_bounds=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value)
+
+    # when
+    lines = histogram.render("latency_seconds", 'rule="a"')
+
+    # then
+    assert lines == [
+        'latency_seconds_bucket{rule="a",le="0.1"} 2',
+        'latency_seconds_bucket{rule="a",le="1.0"} 3',
+        'latency_seconds_bucket{rule="a",le="+Inf"} 4',
+        'latency_seconds_sum{rule="a"} 2.65',
+        'latency_seconds_count{rule="a"} 4',
+    ]
+
+
+def test_observe_decision_counts_allowed_and_throttled_requests():
+    # given
+    rule_metrics = RuleMetrics()
+
+    # when
+    for is_allowed in [True, True, False]:
+        rule_metrics.observe_decision(is_allowed, time.perf_counter())
+
+    # then
+    assert rule_metrics.n_allowed_requests == 2
+    assert rule_metrics.n_throttled_requests == 1
+    assert rule_metrics.decision_second.count == 3
+
+
+def test_metrics_render_rules_with_labels():
+    # given
+    rule_metrics = Metrics().get_rule_metrics("test_render")
+    rule_metrics.observe_decision(True, time.perf_counter())
+    rule_metrics.get_n_keys = lambda: 7
+    rule_metrics.get_n_queued_requests = lambda: 3
+
+    # when
+    lines = Metrics().render('worker="1"').decode().splitlines()
+
+    # then
+    labels = 'worker="1",rule="test_render"'
+    assert f'rate_limiter_requests_total{{{labels},result="allowed"}} 1' in lines
+    assert f'rate_limiter_requests_total{{{labels},result="throttled"}} 0' in lines
+    assert f"rate_limiter_decision_seconds_count{{{labels}}} 1" in lines
+    assert f"rate_limiter_active_keys{{{labels}}} 7" in lines
+    assert f"rate_limiter_queued_requests{{{labels}}} 3" in lines
+    assert any(
+        line.startswith('rate_limiter_upstream_connect_seconds_count{worker="1"} ')
+        for line in lines
+    )
+
+
+@pytest.fixture
+def admin_url():
+    admin_server = AdminServer("127.0.0.1", 0, labels='worker="1"')
+    admin_server.start()
+    host, port = admin_server._http_server.server_address[:2]
+    yield f"http://{host}:{port}"
+    admin_server.stop()
+    admin_server.join()
+
+
+def test_admin_server_serves_metrics(admin_url):
+    # given
+    Metrics().get_rule_metrics("test_admin_server")
+
+    # when
+    with urllib.request.urlopen(f"{admin_url}/metrics?format=text", timeout=5) as r:
+        status, content_type, body = r.status, r.headers["Content-Type"], r.read()
+
+    # then
+    assert status == 200
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert b'worker="1",rule="test_admin_server",result="allowed"' in body
+
+
+def test_admin_server_does_not_serve_other_paths(admin_url):
+    # when
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(f"{admin_url}/other", timeout=5)
+
+    # then
+    assert e.value.code == 404
+    e.value.close()
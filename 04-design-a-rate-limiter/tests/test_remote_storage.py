@@ -0,0 +1,192 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from src.counter_server import CounterServer
+from src.rate_limit_algorithms.storages import StorageError, StorageProtocolError
+from src.rate_limit_algorithms.storages.remote import (
+    RemoteStorage,
+    decode_incr_with_expiry,
+    decode_key,
+    decode_refill_and_take,
+    encode_incr_with_expiry,
+    encode_key,
+    encode_refill_and_take,
+)
+
+KEYS = ["client", "a b", "a\tb", "line\nbreak", "100%", "ü", ""]
+
+
+@pytest.mark.parametrize("key", KEYS)
+def test_encoded_key_is_one_argument_and_decoded_back(key):
+    # when
+    encoded_key = encode_key(key)
+
+    # then
+    assert encoded_key.split() in ([encoded_key], [])
+    assert b"\n" not in encoded_key
+    assert decode_key(encoded_key) == key
+
+
+def test_refill_and_take_round_trips_through_counter_server():
+    # given
+    counter_server = CounterServer("127.0.0.1", "0", max_n_keys=100)
+
+    for key in KEYS:
+        # when
+        results = [
+            decode_refill_and_take(
+                counter_server._execute(
+                    encode_refill_and_take(key, 2, 0.001).rstrip(b"\n")
+                )
+            )
+            for _ in range(3)
+        ]
+
+        # then
+        assert [is_taken for is_taken, _ in results] == [True, True, False]
+    assert counter_server._storage.n_token_buckets == len(KEYS)
+
+
+def test_incr_with_expiry_keeps_keys_with_spaces_apart():
+    # given
+    counter_server = CounterServer("127.0.0.1", "0", max_n_keys=100)
+    keys_and_amounts = [("a", 1), ("a b", 2), ("b", 3), ("a b", 4)]
+
+    # when
+    values = decode_incr_with_expiry(
+        counter_server._execute(
+            encode_incr_with_expiry(keys_and_amounts, 60).rstrip(b"\n")
+        )
+    )
+
+    # then
+    assert values == [1, 2, 3, 6]
+    assert counter_server._storage.n_counters == 3
+
+
+def test_error_response_raises_storage_protocol_error():
+    # given
+    counter_server = CounterServer("127.0.0.1", "0", max_n_keys=100)
+
+    # when
+    response = counter_server._execute(b"RT a b c")
+
+    # then
+    with pytest.raises(StorageProtocolError):
+        decode_refill_and_take(response)
+
+
+@pytest.mark.parametrize("response", [b"1\n", b"1 many\n", b"ERR unknown\n"])
+def test_malformed_response_raises_storage_protocol_error(response):
+    # then
+    with pytest.raises(StorageProtocolError):
+        decode_refill_and_take(response)
+
+
+def test_closed_connection_is_not_a_protocol_error():
+    # then
+    with pytest.raises(StorageError) as e:
+        decode_incr_with_expiry(b"")
+    assert not isinstance(e.value, StorageProtocolError)
+
+
+def test_remote_storage_limits_keys_with_spaces(counter_server_address):
+    # given
+    storage = RemoteStorage(*counter_server_address, timeout_second=1)
+
+    try:
+        # when
+        results = [storage.refill_and_take("a b", 1, 0.001) for _ in range(2)]
+        other_results = [storage.refill_and_take("a", 1, 0.001) for _ in range(2)]
+
+        # then
+        assert [is_taken for is_taken, _ in results] == [True, False]
+        assert [is_taken for is_taken, _ in other_results] == [True, False]
+        assert storage.incr_with_expiry([("a b", 1), ("a\nb", 1)], 60) == [1, 1]
+    finally:
+        storage.close()
+
+
+@pytest.fixture
+def reply_once():
+    # Serves one connection, which gets the given reply to its first command.
+    listening_socket = socket.create_server(("127.0.0.1", 0))
+    threads = []
+
+    def serve(reply):
+        def handle():
+            connection, _ = listening_socket.accept()
+            with connection:
+                connection.makefile("rb").readline()
+                connection.sendall(reply)
+
+        threads.append(threading.Thread(target=handle, daemon=True))
+        threads[-1].start()
+        return listening_socket.getsockname()[:2]
+
+    yield serve
+    for thread in threads:
+        thread.join(1)
+    listening_socket.close()
+
+
+@pytest.mark.parametrize(
+    "reply, error_type",
+    [(b"", StorageError), (b"garbage\n", StorageProtocolError)],
+)
+def test_remote_storage_closes_connection_after_unusable_response(
+    reply_once, reply, error_type
+):
+    # given
+    storage = RemoteStorage(*reply_once(reply), timeout_second=1)
+
+    try:
+        # when
+        with pytest.raises(error_type):
+            storage.refill_and_take("a", 1, 0.001)
+
+        # then
+        assert storage._socket is None
+    finally:
+        storage.close()
+
+
+def test_remote_storage_keeps_connection_after_error_response(counter_server_address):
+    # given
+    storage = RemoteStorage(*counter_server_address, timeout_second=1)
+
+    try:
+        # when
+        with pytest.raises(StorageProtocolError):
+            storage._execute(b"RT a b c\n", decode_refill_and_take)
+
+        # then
+        assert storage._socket is not None
+        assert storage.incr_with_expiry([("a", 1)], 60) == [1]
+    finally:
+        storage.close()
+
+
+@pytest.mark.parametrize(
+    "reply, error_type",
+    [(b"", StorageError), (b"garbage\n", StorageProtocolError)],
+)
+def test_async_remote_storage_closes_connection_after_unusable_response(
+    reply_once, reply, error_type
+):
+    # given
+    storage = RemoteStorage(*reply_once(reply), timeout_second=1)
+
+    async def refill_and_take():
+        with pytest.raises(error_type):
+            await storage.refill_and_take_async("a", 1, 0.001)
+        return storage._writer
+
+    # when
+    writer = asyncio.run(refill_and_take())
+
+    # then
+    assert writer is None
@@ -0,0 +1,98 @@
+from src.config import Config
+from src.rate_limit_algorithms.rule_engine import RuleIndex
+
+API_KEY_HEADER = "X-Api-Key"
+
+
+def test_longest_path_prefix_wins():
+    # given
+    rule_index = RuleIndex(
+        [
+            Config.Rule(name="root"),
+            Config.Rule(name="api", path_prefix="/api"),
+            Config.Rule(name="users", path_prefix="/api/users"),
+        ],
+        API_KEY_HEADER,
+    )
+
+    # when
+    matched_names = [
+        rule_index.match(b"GET", path, {}, "1.2.3.4")[0].name
+        for path in [b"/", b"/api", b"/api/items", b"/api/users/1?q=1", b"/apis"]
+    ]
+
+    # then
+    assert matched_names == ["root", "api", "api", "users", "root"]
+
+
+def test_rules_of_the_same_prefix_are_tried_in_order():
+    # given
+    rule_index = RuleIndex(
+        [
+            Config.Rule(name="post", path_prefix="/api", method="post"),
+            Config.Rule(name="beta", path_prefix="/api", headers={"X-Beta": "1"}),
+            Config.Rule(name="api", path_prefix="/api"),
+        ],
+        API_KEY_HEADER,
+    )
+
+    # when
+    post_rule, _ = rule_index.match(b"POST", b"/api", {b"x-beta": b"1"}, "1.2.3.4")
+    beta_rule, _ = rule_index.match(b"GET", b"/api", {b"x-beta": b"1"}, "1.2.3.4")
+    api_rule, _ = rule_index.match(b"GET", b"/api", {b"x-beta": b"2"}, "1.2.3.4")
+
+    # then
+    assert [post_rule.name, beta_rule.name, api_rule.name] == ["post", "beta", "api"]
+    assert rule_index.needs_headers
+
+
+def test_unmatched_rule_falls_back_to_a_shorter_prefix():
+    # given
+    rule_index = RuleIndex(
+        [
+            Config.Rule(name="api", path_prefix="/api"),
+            Config.Rule(name="admin", path_prefix="/api/admin", api_key="secret"),
+        ],
+        API_KEY_HEADER,
+    )
+
+    # when
+    rule, _ = rule_index.match(b"GET", b"/api/admin", {b"x-api-key": b"x"}, "1.2.3.4")
+
+    # then
+    assert rule.name == "api"
+
+
+def test_no_rule_matches():
+    # given
+    rule_index = RuleIndex(
+        [Config.Rule(name="api", path_prefix="/api", method="GET")], API_KEY_HEADER
+    )
+
+    # then
+    assert rule_index.match(b"GET", b"/", {}, "1.2.3.4") is None
+    assert rule_index.match(b"POST", b"/api", {}, "1.2.3.4") is None
+    assert not rule_index.needs_headers
+
+
+def test_rate_limit_key_depends_on_limit_by():
+    # given
+    rule_index = RuleIndex(
+        [
+            Config.Rule(name="by-api-key", path_prefix="/a", limit_by="api_key"),
+            Config.Rule(name="by-rule", path_prefix="/b", limit_by="rule"),
+            Config.Rule(name="by-client-ip", path_prefix="/c"),
+        ],
+        API_KEY_HEADER,
+    )
+    headers = {b"x-api-key": b"a key"}
+
+    # when
+    rate_limit_keys = [
+        rule_index.match(b"GET", path, headers, "1.2.3.4")[1]
+        for path in [b"/a", b"/b", b"/c"]
+    ]
+
+    # then
+    assert rate_limit_keys == ["by-api-key:a key", "by-rule", "by-client-ip:1.2.3.4"]
+    assert rule_index.match(b"GET", b"/a", {}, "1.2.3.4") is None
@@ -0,0 +1,50 @@
+import multiprocessing
+
+from src.rate_limit_algorithms.storages.shared_memory import (
+    SharedMemoryStorage,
+    SharedMemoryTable,
+)
+
+
+def take_tokens(shared_memory_table, n_takes, results):
+    storage = SharedMemoryStorage(shared_memory_table)
+    results.put(
+        sum(storage.refill_and_take("1.1.1.1", 20, 0.001)[0] for _ in range(n_takes))
+    )
+
+
+def test_forked_workers_share_token_buckets():
+    # given
+    shared_memory_table = SharedMemoryTable(capacity=100)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [
+        context.Process(target=take_tokens, args=(shared_memory_table, 10, results))
+        for _ in range(4)
+    ]
+
+    # when
+    for worker in workers:
+        worker.start()
+    n_taken_tokens = sum(results.get(timeout=5) for _ in workers)
+    for worker in workers:
+        worker.join()
+
+    # then
+    assert n_taken_tokens == 20
+    assert not SharedMemoryStorage(shared_memory_table).refill_and_take(
+        "1.1.1.1", 20, 0.001
+    )[0]
+
+
+def test_rollback_of_missing_counter_is_not_written():
+    # given
+    storage = SharedMemoryStorage(SharedMemoryTable(capacity=100))
+
+    # when
+    rolled_back_values = storage.incr_with_expiry((("a", -1),), 10)
+    values = storage.incr_with_expiry((("a", 1), ("a", -1), ("a", -1)), 10)
+
+    # then
+    assert rolled_back_values == [0]
+    assert values == [1, 0, 0]
@@ -0,0 +1,157 @@
+import time
+
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms.sliding_window_counter import (
+    SlidingWindowCounterAlgorithm,
+    SlidingWindowCounterStore,
+)
+from src.rate_limit_algorithms.sliding_window_log import SlidingWindowLogStore
+from src.rate_limit_algorithms.storages.local import LocalStorage
+
+
+def test_sliding_window_log_accepts_requests_as_old_ones_leave_the_window():
+    # given
+    store = SlidingWindowLogStore(
+        window_second=1, max_n_requests_per_window=2, max_n_keys=100
+    )
+    sliding_window_log = store.get("1.1.1.1")
+
+    # when
+    results = [
+        store.try_acquire(sliding_window_log, now=now)
+        for now in [0, 0.5, 0.9, 1.0, 1.2, 1.5]
+    ]
+
+    # then
+    assert results == [True, True, False, True, False, True]
+
+
+def test_sliding_window_log_counts_remaining_requests():
+    # given
+    store = SlidingWindowLogStore(
+        window_second=1, max_n_requests_per_window=3, max_n_keys=100
+    )
+    sliding_window_log = store.get("1.1.1.1")
+    for now in [0, 0.5]:
+        store.try_acquire(sliding_window_log, now=now)
+
+    # when
+    n_remaining_requests = [
+        store.get_n_remaining_requests(sliding_window_log, now=now)
+        for now in [0.5, 1.0, 1.5]
+    ]
+
+    # then
+    assert n_remaining_requests == [1, 2, 3]
+
+
+def test_sliding_window_log_evicts_least_recently_used_logs_over_max_n_keys():
+    # given
+    store = SlidingWindowLogStore(
+        window_second=1, max_n_requests_per_window=1, max_n_keys=2
+    )
+    for client_ip in ["1.1.1.1", "2.2.2.2", "1.1.1.1", "3.3.3.3"]:
+        store.try_acquire(store.get(client_ip), now=0)
+
+    # when
+    is_acquired_by_kept = store.try_acquire(store.get("1.1.1.1"), now=0)
+    is_acquired_by_evicted = store.try_acquire(store.get("2.2.2.2"), now=0)
+
+    # then
+    assert is_acquired_by_evicted
+    assert not is_acquired_by_kept
+    assert len(store) == 2
+
+
+def test_sliding_window_counter_weights_the_previous_window():
+    # given
+    store = SlidingWindowCounterStore(
+        window_second=10, max_n_requests_per_window=10, max_n_keys=100
+    )
+    sliding_window_counter = store.get("1.1.1.1")
+    results = [store.try_acquire(sliding_window_counter, now=5) for _ in range(11)]
+
+    # when
+    # Half of the previous window still overlaps the sliding window at 15.
+    n_remaining_at_15 = store.get_n_remaining_requests(sliding_window_counter, now=15)
+    n_remaining_at_18 = store.get_n_remaining_requests(sliding_window_counter, now=18)
+    n_remaining_at_25 = store.get_n_remaining_requests(sliding_window_counter, now=25)
+
+    # then
+    assert results == [True] * 10 + [False]
+    assert n_remaining_at_15 == 5
+    assert n_remaining_at_18 == 8
+    assert n_remaining_at_25 == 10
+
+
+def test_sliding_window_counter_refuses_requests_over_the_estimate():
+    # given
+    store = SlidingWindowCounterStore(
+        window_second=10, max_n_requests_per_window=4, max_n_keys=100
+    )
+    sliding_window_counter = store.get("1.1.1.1")
+    for _ in range(4):
+        store.try_acquire(sliding_window_counter, now=9)
+
+    # when
+    results = [store.try_acquire(sliding_window_counter, now=15) for _ in range(3)]
+
+    # then
+    assert results == [True, True, False]
+
+
+def test_idle_sliding_window_counters_are_evicted_after_two_windows():
+    # given
+    store = SlidingWindowCounterStore(
+        window_second=1, max_n_requests_per_window=1, max_n_keys=100
+    )
+    store.try_acquire(store.get("1.1.1.1"), now=0)
+    store.try_acquire(store.get("2.2.2.2"), now=1)
+
+    # when
+    store.try_acquire(store.get("3.3.3.3"), now=2.5)
+
+    # then
+    assert len(store) == 2
+
+
+def test_sliding_window_counter_rolls_back_refused_requests_in_storage():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+    sliding_window_counter_algorithm = SlidingWindowCounterAlgorithm(
+        window_second=1000,
+        max_n_requests_per_window=2,
+        max_n_keys=100,
+        socket_buf_size=1024,
+        forward_host="127.0.0.1",
+        forward_port="0",
+        upstream_pool_size=1,
+        upstream_idle_timeout_second=1,
+        rule_metrics=RuleMetrics(),
+        storage=storage,
+    )
+
+    try:
+        # when
+        results = [
+            sliding_window_counter_algorithm._try_acquire("1.1.1.1") for _ in range(4)
+        ]
+
+        # then
+        assert [is_acquired for is_acquired, _ in results] == [
+            True,
+            True,
+            False,
+            False,
+        ]
+        (previous_key, _), (
+            current_key,
+            _,
+        ) = sliding_window_counter_algorithm._get_keys_and_amounts(
+            "1.1.1.1", time.time()
+        )
+        assert storage.incr_with_expiry(
+            ((previous_key, 0), (current_key, 0)), 2000
+        ) == [0, 2]
+    finally:
+        sliding_window_counter_algorithm.teardown()
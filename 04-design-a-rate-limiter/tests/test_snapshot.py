@@ -0,0 +1,114 @@
+import time
+
+import pytest
+
+from src.rate_limit_algorithms.storages.local import LocalStorage
+from src.rate_limit_algorithms.storages.shared_memory import (
+    SharedMemoryStorage,
+    SharedMemoryTable,
+)
+from src.rate_limit_algorithms.storages.snapshot import (
+    Snapshot,
+    hash_key,
+    write_snapshot,
+)
+
+
+def test_local_storage_restores_token_buckets_and_counters(tmp_path):
+    # given
+    path = str(tmp_path / "snapshot")
+    now = time.monotonic()
+    old_storage = LocalStorage(max_n_keys=100)
+    for _ in range(2):
+        old_storage.refill_and_take("a", 2, 0.001, now=now)
+    old_storage.incr_with_expiry((("b", 3),), 60, now=now)
+    old_storage.save_snapshot(path)
+    new_storage = LocalStorage(max_n_keys=100)
+
+    # when
+    new_storage.load_snapshot(path)
+
+    # then
+    assert new_storage.refill_and_take("a", 2, 0.001, now=now) == (False, 0)
+    assert new_storage.incr_with_expiry((("b", 1),), 60, now=now) == [4]
+    assert new_storage.refill_and_take("c", 2, 0.001, now=now) == (True, 1)
+
+
+def test_records_not_taken_out_are_saved_again(tmp_path):
+    # given
+    path = str(tmp_path / "snapshot")
+    now = time.monotonic()
+    first_storage = LocalStorage(max_n_keys=100)
+    first_storage.incr_with_expiry((("a", 1), ("b", 2)), 60, now=now)
+    first_storage.save_snapshot(path)
+    second_storage = LocalStorage(max_n_keys=100)
+    second_storage.load_snapshot(path)
+    second_storage.incr_with_expiry((("a", 1),), 60, now=now)
+    second_storage.save_snapshot(path)
+    third_storage = LocalStorage(max_n_keys=100)
+
+    # when
+    third_storage.load_snapshot(path)
+
+    # then
+    assert third_storage.incr_with_expiry((("a", 0), ("b", 0)), 60, now=now) == [2, 2]
+
+
+def test_snapshot_pops_each_record_once_until_it_expires(tmp_path):
+    # given
+    path = str(tmp_path / "snapshot")
+    now = time.monotonic()
+    write_snapshot(
+        path,
+        [
+            (hash_key("a"), 1.0, now, now + 60),
+            (hash_key("b"), 2.0, now, now + 1),
+        ],
+    )
+    snapshot = Snapshot.open(path)
+
+    try:
+        # when
+        first_a = snapshot.pop(hash_key("a"), now)
+        second_a = snapshot.pop(hash_key("a"), now)
+        expired_b = snapshot.pop(hash_key("b"), now + 2)
+        missing_c = snapshot.pop(hash_key("c"), now)
+
+        # then
+        assert first_a[0] == 1.0
+        assert first_a[2] == pytest.approx(now + 60)
+        assert second_a is None
+        assert expired_b is None
+        assert missing_c is None
+    finally:
+        snapshot.close()
+
+
+@pytest.mark.parametrize("data", [b"", b"RLSNAP01", b"not a snapshot at all"])
+def test_invalid_snapshot_is_ignored(tmp_path, data):
+    # given
+    path = tmp_path / "snapshot"
+    path.write_bytes(data)
+
+    # then
+    assert Snapshot.open(str(path)) is None
+    assert Snapshot.open(str(tmp_path / "missing")) is None
+
+
+def test_shared_memory_table_restores_token_buckets(tmp_path):
+    # given
+    path = str(tmp_path / "snapshot")
+    old_table = SharedMemoryTable(capacity=100)
+    old_storage = SharedMemoryStorage(old_table)
+    for _ in range(2):
+        old_storage.refill_and_take("a", 2, 0.001)
+    old_table.save_snapshot(path)
+    new_table = SharedMemoryTable(capacity=100)
+
+    # when
+    new_table.load_snapshot(path)
+
+    # then
+    new_storage = SharedMemoryStorage(new_table)
+    assert not new_storage.refill_and_take("a", 2, 0.001)[0]
+    assert new_storage.refill_and_take("b", 2, 0.001)[0]
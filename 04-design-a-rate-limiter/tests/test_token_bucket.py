@@ -0,0 +1,71 @@
+from src.rate_limit_algorithms.storages.local import LocalStorage
+
+
+def test_new_token_bucket_is_full():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+
+    # when
+    results = [storage.refill_and_take("a", 3, 1, now=0) for _ in range(4)]
+
+    # then
+    assert results == [(True, 2), (True, 1), (True, 0), (False, 0)]
+
+
+def test_token_bucket_is_refilled_continuously():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+    for _ in range(2):
+        storage.refill_and_take("a", 2, 4, now=0)
+
+    # when
+    is_taken_at_0_1, _ = storage.refill_and_take("a", 2, 4, now=0.1)
+    is_taken_at_0_25, n_tokens_at_0_25 = storage.refill_and_take("a", 2, 4, now=0.25)
+
+    # then
+    assert not is_taken_at_0_1
+    assert is_taken_at_0_25
+    assert n_tokens_at_0_25 == 0
+
+
+def test_token_bucket_is_not_refilled_over_its_size():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+    storage.refill_and_take("a", 2, 1, now=0)
+
+    # when
+    _, current_n_tokens = storage.refill_and_take("a", 2, 1, now=100)
+
+    # then
+    assert current_n_tokens == 1
+
+
+def test_idle_token_buckets_are_evicted():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+    storage.refill_and_take("a", 2, 1, now=0)
+    storage.refill_and_take("b", 2, 1, now=1)
+
+    # when
+    # A bucket idle for size / rate seconds is full again, so it is not kept.
+    storage.refill_and_take("c", 2, 1, now=2.5)
+
+    # then
+    assert storage.n_token_buckets == 2
+    assert storage.refill_and_take("a", 2, 1, now=2.5) == (True, 1)
+
+
+def test_least_recently_used_token_buckets_are_evicted_over_max_n_keys():
+    # given
+    storage = LocalStorage(max_n_keys=2)
+    for key in ["a", "b"]:
+        storage.refill_and_take(key, 2, 0.001, now=0)
+    storage.refill_and_take("a", 2, 0.001, now=0)
+
+    # when
+    storage.refill_and_take("c", 2, 0.001, now=0)
+
+    # then
+    assert storage.n_token_buckets == 2
+    assert storage.refill_and_take("a", 2, 0.001, now=0) == (False, 0)
+    assert storage.refill_and_take("b", 2, 0.001, now=0) == (True, 1)
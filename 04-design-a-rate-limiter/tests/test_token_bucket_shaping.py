@@ -0,0 +1,112 @@
+import socket
+import time
+
+import pytest
+
+from src.core import Request
+from src.metrics import RuleMetrics
+from src.rate_limit_algorithms.storages.local import LocalStorage
+from src.rate_limit_algorithms.token_bucket import (
+    TokenBucketAlgorithm,
+    _DelayedRequests,
+)
+
+
+def test_refill_and_take_borrows_tokens_up_to_the_limit():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+
+    # when
+    results = [
+        storage.refill_and_take("a", 1, 10, n_borrowable_tokens=2, now=0)
+        for _ in range(4)
+    ]
+
+    # then
+    assert results == [(True, 0), (True, -1), (True, -2), (False, -2)]
+
+
+def test_borrowed_tokens_are_paid_back_by_refills():
+    # given
+    storage = LocalStorage(max_n_keys=100)
+    for _ in range(3):
+        storage.refill_and_take("a", 1, 10, n_borrowable_tokens=2, now=0)
+
+    # when
+    is_taken_at_0_1, n_tokens_at_0_1 = storage.refill_and_take(
+        "a", 1, 10, n_borrowable_tokens=2, now=0.1
+    )
+    is_taken_at_0_5, n_tokens_at_0_5 = storage.refill_and_take(
+        "a", 1, 10, n_borrowable_tokens=2, now=0.5
+    )
+
+    # then
+    assert is_taken_at_0_1
+    assert n_tokens_at_0_1 == pytest.approx(-2)
+    assert is_taken_at_0_5
+    assert n_tokens_at_0_5 == pytest.approx(0)
+
+
+def test_delayed_requests_are_released_in_deadline_order():
+    # given
+    delayed_requests = _DelayedRequests()
+    for name, release_ts in [("c", 2), ("a", 1), ("b", 1), ("d", 3)]:
+        delayed_requests.put((name, None), release_ts)
+
+    # when
+    due_at_2 = delayed_requests.pop_due(now=2)
+
+    # then
+    assert [name for name, _ in due_at_2] == ["a", "b", "c"]
+    assert delayed_requests.next_release_deadline == 3
+    assert len(delayed_requests) == 1
+
+
+def test_token_bucket_delays_requests_which_borrow_tokens(upstream_address):
+    # given
+    token_bucket_algorithm = TokenBucketAlgorithm(
+        periodic_second=1,
+        n_tokens_to_be_added_per_periodic_second=10,
+        token_bucket_size=1,
+        max_delay_second=0.2,
+        n_workers=2,
+        storage=LocalStorage(max_n_keys=100),
+        socket_buf_size=65536,
+        forward_host=upstream_address[0],
+        forward_port=upstream_address[1],
+        upstream_pool_size=1,
+        upstream_idle_timeout_second=30,
+        rule_metrics=RuleMetrics(),
+    )
+    token_bucket_algorithm.setup()
+    socket_pairs = [socket.socketpair() for _ in range(4)]
+
+    try:
+        # when
+        started = time.monotonic()
+        for client_socket, server_socket in socket_pairs:
+            client_socket.sendall(b"GET / HTTP/1.1\r\nHost: test\r\n\r\n")
+            token_bucket_algorithm.handle(Request(server_socket, "127.0.0.1", "0"))
+        handled_second = time.monotonic() - started
+        responses = []
+        for client_socket, _ in socket_pairs:
+            client_socket.settimeout(5)
+            responses.append(
+                (client_socket.recv(65536).split(b"\r\n", 1)[0], time.monotonic())
+            )
+
+        # then
+        assert handled_second < 0.05
+        assert [status_line for status_line, _ in responses] == [
+            b"HTTP/1.1 200 OK",
+            b"HTTP/1.1 200 OK",
+            b"HTTP/1.1 200 OK",
+            b"HTTP/1.1 429 Too many requests",
+        ]
+        assert responses[1][1] - started >= 0.09
+        assert responses[2][1] - started >= 0.19
+    finally:
+        token_bucket_algorithm.teardown()
+        for client_socket, server_socket in socket_pairs:
+            client_socket.close()
+            server_socket.close()
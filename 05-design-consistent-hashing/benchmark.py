@@ -0,0 +1,339 @@
+import argparse
+import gc
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from types import ModuleType
+from typing import Callable, Dict, List, Optional
+
+from consistent_hash import (
+    ConsistentHash,
+    JumpHash,
+    MaglevHash,
+    Node,
+    Placement,
+    RendezvousHash,
+)
+
+ENGINES = ("ring", "store", "jump", "rendezvous", "maglev")
+ENGINES_WITH_VNODES = ("ring", "store")
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+STORE_CONSISTENT_HASH_PATH = os.path.join(
+    PROJECT_DIR,
+    os.pardir,
+    "06-design-a-key-value-store",
+    "src",
+    "core",
+    "consistent_hash.py",
+)
+
+logger = logging.getLogger("benchmark")
+
+
+def load_store_module() -> Optional[ModuleType]:
+    # The ring of the key-value store, which has the batch lookup.
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "store_consistent_hash", STORE_CONSISTENT_HASH_PATH
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    except (OSError, ImportError) as e:
+        sys.modules.pop("store_consistent_hash", None)
+        logger.warning(f"can not load {STORE_CONSISTENT_HASH_PATH}: {e}")
+        return None
+    return module
+
+
+def create_placement(
+    engine: str,
+    n_nodes: int,
+    n_vnodes: Optional[int],
+    store_module: Optional[ModuleType],
+    n_replicas: int,
+) -> Placement:
+    node_ids = [f"node-{i}" for i in range(n_nodes)]
+    if engine == "ring":
+        return ConsistentHash([Node(id=id_) for id_ in node_ids], n_vnodes)
+    if engine == "store":
+        return store_module.ConsistentHash(
+            [store_module.Node(id=id_) for id_ in node_ids],
+            n_vnodes,
+            n_replicas=n_replicas,
+        )
+    nodes = [Node(id=id_) for id_ in node_ids]
+    if engine == "jump":
+        return JumpHash(nodes)
+    if engine == "rendezvous":
+        return RendezvousHash(nodes)
+    if engine == "maglev":
+        return MaglevHash(nodes)
+    raise ValueError(f"unknown engine {engine}")
+
+
+def create_node(engine: str, id_: str, store_module: Optional[ModuleType]):
+    return store_module.Node(id=id_) if engine == "store" else Node(id=id_)
+
+
+def measure_second(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def get_memory_byte(create: Callable[[], Placement]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        placement = create()
+        placement.get_nodes_of_key("", 1)
+        if hasattr(placement, "get_nodes_of_keys"):
+            placement.get_nodes_of_keys([""], 1)
+        memory_byte, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return memory_byte
+
+
+def get_node_ids_of_keys(placement: Placement, keys: List[str]) -> List[str]:
+    return [placement.get_node_of_key(key).id for key in keys]
+
+
+def run_scenario(
+    engine: str,
+    n_nodes: int,
+    n_vnodes: Optional[int],
+    keys: List[str],
+    args: argparse.Namespace,
+    store_module: Optional[ModuleType],
+) -> Dict[str, object]:
+    def create() -> Placement:
+        return create_placement(
+            engine, n_nodes, n_vnodes, store_module, args.n_replicas
+        )
+
+    placement = None
+
+    def build() -> None:
+        nonlocal placement
+        placement = create()
+        # Tables built lazily on the first lookups are part of the build.
+        placement.get_nodes_of_key("", args.n_replicas)
+        if hasattr(placement, "get_nodes_of_keys"):
+            placement.get_nodes_of_keys([""], args.n_replicas)
+
+    build_second = measure_second(build)
+    lookup_keys = keys[: args.n_lookups]
+    lookup_second = measure_second(
+        lambda: [placement.get_node_of_key(key) for key in lookup_keys]
+    )
+    replica_lookup_second = measure_second(
+        lambda: [
+            placement.get_nodes_of_key(key, args.n_replicas) for key in lookup_keys
+        ]
+    )
+    batch_lookup_second = None
+    if hasattr(placement, "get_nodes_of_keys"):
+        batch_lookup_second = measure_second(
+            lambda: placement.get_nodes_of_keys(lookup_keys, args.n_replicas)
+        )
+
+    node_ids = get_node_ids_of_keys(placement, keys)
+    loads = [Counter(node_ids)[node.id] for node in placement.nodes]
+    mean_load = statistics.mean(loads)
+
+    # Nodes are added and removed in reverse order, so that jump hash can remove them.
+    new_nodes = [
+        create_node(engine, f"new-node-{i}", store_module)
+        for i in range(args.n_membership_changes)
+    ]
+    add_node_seconds = []
+    for node in new_nodes:
+        add_node_seconds.append(measure_second(lambda: placement.add_node(node)))
+    remove_node_seconds = []
+    for node in reversed(new_nodes):
+        remove_node_seconds.append(measure_second(lambda: placement.remove_node(node)))
+
+    placement.add_node(create_node(engine, "new-node", store_module))
+    new_node_ids = get_node_ids_of_keys(placement, keys)
+    n_moved_keys = sum(
+        node_id != new_node_id for node_id, new_node_id in zip(node_ids, new_node_ids)
+    )
+    placement = None
+
+    memory_byte = get_memory_byte(create)
+    return {
+        "engine": engine,
+        "n_nodes": n_nodes,
+        "n_vnodes_per_node": n_vnodes,
+        "n_keys": len(keys),
+        "build_ms": build_second * 1000,
+        "lookups_per_second": len(lookup_keys) / lookup_second,
+        "replica_lookups_per_second": len(lookup_keys) / replica_lookup_second,
+        "batch_lookups_per_second": (
+            len(lookup_keys) / batch_lookup_second if batch_lookup_second else None
+        ),
+        "add_node_ms": statistics.mean(add_node_seconds) * 1000,
+        "remove_node_ms": statistics.mean(remove_node_seconds) * 1000,
+        "memory_mb": memory_byte / (1 << 20),
+        "memory_byte_per_vnode": (
+            memory_byte / (n_nodes * n_vnodes) if n_vnodes else None
+        ),
+        # Standard deviation of keys per node relative to the mean.
+        "load_cv": statistics.pstdev(loads) / mean_load,
+        # What a perfectly uniform placement shows from sampling len(keys) keys alone.
+        "sampling_load_cv": math.sqrt((n_nodes - 1) / len(keys)),
+        "max_load_ratio": max(loads) / mean_load,
+        "moved_key_fraction": n_moved_keys / len(keys),
+        # What adding a node to n nodes has to move at least.
+        "ideal_moved_key_fraction": 1 / (n_nodes + 1),
+    }
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result: Dict[str, object]) -> None:
+    batch_lookups_per_second = result["batch_lookups_per_second"]
+    print(
+        f"{result['engine']:<10} nodes={result['n_nodes']:<5} "
+        f"vnodes={result['n_vnodes_per_node'] or '-':<5} "
+        f"build={result['build_ms']:.1f}ms "
+        f"lookup={result['lookups_per_second']:.0f}/s "
+        f"replicas={result['replica_lookups_per_second']:.0f}/s "
+        f"batch={f'{batch_lookups_per_second:.0f}/s' if batch_lookups_per_second else '-'} "
+        f"add={result['add_node_ms']:.2f}ms remove={result['remove_node_ms']:.2f}ms "
+        f"mem={result['memory_mb']:.1f}MB "
+        f"cv={result['load_cv']:.3f} (sampling {result['sampling_load_cv']:.3f}) max={result['max_load_ratio']:.2f} "
+        f"moved={result['moved_key_fraction']:.4f} "
+        f"(ideal {result['ideal_moved_key_fraction']:.4f})",
+        flush=True,
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    store_module = load_store_module() if "store" in args.engines else None
+    engines = [engine for engine in args.engines if engine != "store" or store_module]
+    keys = [f"user-{i}@example.com" for i in range(args.n_keys)]
+    results = []
+    for engine, n_nodes, n_vnodes in itertools.product(
+        engines, args.n_nodes, args.n_vnodes
+    ):
+        if engine not in ENGINES_WITH_VNODES:
+            # The number of vnodes does not apply, so it is run once per number of nodes.
+            if n_vnodes != args.n_vnodes[0]:
+                continue
+            n_vnodes = None
+        result = run_scenario(engine, n_nodes, n_vnodes, keys, args, store_module)
+        print_result(result)
+        results.append(result)
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "git_commit": get_git_commit(),
+                "python_version": platform.python_version(),
+                "platform": platform.platform(),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"results have been written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-e",
+        "--engines",
+        metavar="",
+        help="placement engines to benchmark. store is the ring of 06-design-a-key-value-store",
+        nargs="+",
+        choices=ENGINES,
+        default=["ring", "store", "jump", "maglev"],
+    )
+    parser.add_argument(
+        "-n",
+        "--n-nodes",
+        metavar="",
+        help="numbers of nodes to benchmark",
+        nargs="+",
+        type=int,
+        default=[3, 10, 100, 1000],
+    )
+    parser.add_argument(
+        "-v",
+        "--n-vnodes",
+        metavar="",
+        help="numbers of vnodes per node to benchmark (ring and store only)",
+        nargs="+",
+        type=int,
+        default=[10, 100, 1000],
+    )
+    parser.add_argument(
+        "-k",
+        "--n-keys",
+        metavar="",
+        help="number of keys to measure the distribution and the movement with",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "-l",
+        "--n-lookups",
+        metavar="",
+        help="number of keys to measure the lookup throughput with",
+        type=int,
+        default=20000,
+    )
+    parser.add_argument(
+        "-r",
+        "--n-replicas",
+        metavar="",
+        help="number of nodes of a key in replica and batch lookups",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-c",
+        "--n-membership-changes",
+        metavar="",
+        help="number of nodes added and removed to measure membership changes",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="",
+        help="file path to write the results (.json)",
+        default="benchmark_results.json",
+    )
+    logging.basicConfig(
+        format="%(asctime)s,%(msecs)03d %(levelname)-8s %(name)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        level=logging.INFO,
+    )
+    main(parser.parse_args())
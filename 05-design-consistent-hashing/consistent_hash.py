@@ -1,78 +1,467 @@
 from __future__ import annotations
 
+import abc
+import bisect
 import hashlib
-import itertools
-from dataclasses import dataclass
-from typing import List
+import heapq
+import math
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Set
 
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
 
-def _get_hash(key: str) -> int:
-    return int(hashlib.new("sha1", key.encode("utf-8")).hexdigest(), 16)
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HashFunction = Callable[[str], int]
+
+_UINT64_LIMIT = 1 << 64
+_UINT64_MASK = _UINT64_LIMIT - 1
+
+
+def sha1_hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest(), "big")
+
+
+def blake2b_hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+def xxh3_hash(key: str) -> int:
+    if xxhash is None:
+        raise ImportError("xxh3_hash requires xxhash. Please install it")
+    return xxhash.xxh3_64_intdigest(key.encode("utf-8"))
+
+
+def murmur3_hash(key: str) -> int:
+    if mmh3 is None:
+        raise ImportError("murmur3_hash requires mmh3. Please install it")
+    return mmh3.hash64(key, signed=False)[0]
 
 
 @dataclass
 class Node:
     id: str
+    # The number of vnodes of a node is proportional to its weight, and so is its share of keys.
+    weight: float = 1
 
-
-@dataclass
-class _VNode:
-    id: int
-    node: _Node
+    def __post_init__(self) -> None:
+        if self.weight <= 0:
+            raise ValueError(f"weight of {self.id} must be positive")
 
 
-@dataclass
+@dataclass(eq=False)
 class _Node:
     id: str
     n_vnodes: int
+    node: Node
+    vnode_hashes: List[int] = field(repr=False)
+    assigned_keys: Set[str] = field(default_factory=set, repr=False)
 
     @classmethod
-    def from_node(cls, node: Node, n_vnodes: int) -> _Node:
-        return cls(id=node.id, n_vnodes=n_vnodes)
+    def from_node(
+        cls, node: Node, n_vnodes_per_node: int, hash_function: HashFunction
+    ) -> _Node:
+        n_vnodes = max(1, round(n_vnodes_per_node * node.weight))
+        return cls(
+            id=node.id,
+            n_vnodes=n_vnodes,
+            node=node,
+            vnode_hashes=[hash_function(f"{node.id}.{i}") for i in range(n_vnodes)],
+        )
 
     def to_node(self) -> Node:
-        return Node(id=self.id)
-
-    @property
-    def vnodes(self) -> List[_VNode]:
-        return [
-            _VNode(id=_get_hash(f"{self.id}.{i}"), node=self)
-            for i in range(self.n_vnodes)
-        ]
+        return self.node
 
 
 class EmptyNodeError(Exception):
     pass
 
 
-class ConsistentHash:
-    def __init__(self, nodes: List[Node], n_vnodes_per_node: int = 200) -> None:
-        self.nodes = nodes
+class Placement(abc.ABC):
+    @property
+    @abc.abstractmethod
+    def nodes(self) -> List[Node]:
+        pass
+
+    @abc.abstractmethod
+    def get_node_of_key(self, key: str) -> Node:
+        pass
+
+    @abc.abstractmethod
+    def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
+        pass
+
+    @abc.abstractmethod
+    def add_node(self, node: Node) -> None:
+        pass
+
+    @abc.abstractmethod
+    def remove_node(self, node: Node) -> None:
+        pass
+
+
+class ConsistentHash(Placement):
+    def __init__(
+        self,
+        nodes: List[Node],
+        n_vnodes_per_node: int = 200,
+        hash_function: HashFunction = blake2b_hash,
+        bounded_load_epsilon: Optional[float] = None,
+    ) -> None:
         self.n_virtual_nodes_per_node = n_vnodes_per_node
+        self.bounded_load_epsilon = bounded_load_epsilon
+        # 64 bit hashes fit in a machine word, which makes them cheaper to compare than SHA-1.
+        self._hash_function = hash_function
+
+        self._nodes: Dict[str, _Node] = {}
+        for node in nodes:
+            self._nodes.setdefault(
+                node.id, _Node.from_node(node, n_vnodes_per_node, hash_function)
+            )
+        # The ring is kept as parallel arrays sorted by hash, so that a key is looked up
+        # with a binary search.
+        self._vnode_hashes: List[int] = []
+        self._vnode_nodes: List[_Node] = []
+        self._build_ring()
+        self._total_weight = self._sum_weights()
+        self._key_to_assigned_node: Dict[str, _Node] = {}
+
+    @property
+    def nodes(self) -> List[Node]:
+        return [_node.to_node() for _node in self._nodes.values()]
+
+    @property
+    def loads(self) -> Dict[str, int]:
+        return {_node.id: len(_node.assigned_keys) for _node in self._nodes.values()}
+
+    def get_node_of_key(self, key: str) -> Node:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        index = bisect.bisect_left(self._vnode_hashes, self._hash_function(key))
+        if index == len(self._vnode_hashes):
+            index = 0
+        return self._vnode_nodes[index].to_node()
+
+    def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        _nodes: List[_Node] = []
+        for _node in self._iter_vnode_nodes_from(key):
+            if _node not in _nodes:
+                _nodes.append(_node)
+                if len(_nodes) == min(n_nodes, len(self._nodes)):
+                    break
+        return [_node.to_node() for _node in _nodes]
+
+    def assign_key(self, key: str) -> Node:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        _node = self._key_to_assigned_node.get(key)
+        if _node is None:
+            _node = self._get_node_with_capacity(key)
+            _node.assigned_keys.add(key)
+            self._key_to_assigned_node[key] = _node
+        return _node.to_node()
+
+    def release_key(self, key: str) -> None:
+        _node = self._key_to_assigned_node.pop(key, None)
+        if _node is not None:
+            _node.assigned_keys.discard(key)
+
+    def add_node(self, node: Node) -> None:
+        if node.id in self._nodes:
+            return
+        node_ = _Node.from_node(
+            node, self.n_virtual_nodes_per_node, self._hash_function
+        )
+        self._nodes[node.id] = node_
+        self._insert_vnodes(node_)
+        self._total_weight = self._sum_weights()
+
+    def remove_node(self, node: Node) -> None:
+        if node.id not in self._nodes:
+            raise ValueError(f"{node} is not in the nodes")
+        node_ = self._nodes.pop(node.id)
+        self._delete_vnodes(node_)
+        self._total_weight = self._sum_weights()
+        # Keys of the node are assigned again when they are asked for next time.
+        for key in node_.assigned_keys:
+            del self._key_to_assigned_node[key]
 
-        self._nodes = [_Node.from_node(node, n_vnodes_per_node) for node in nodes]
-        self._sorted_vnodes = self._get_sorted_vnodes()
+    def _build_ring(self) -> None:
+        vnodes = sorted(
+            (
+                (hash_, _node)
+                for _node in self._nodes.values()
+                for hash_ in _node.vnode_hashes
+            ),
+            key=lambda vnode: vnode[0],
+        )
+        self._vnode_hashes = [hash_ for hash_, _ in vnodes]
+        self._vnode_nodes = [_node for _, _node in vnodes]
+
+    def _insert_vnodes(self, node: _Node) -> None:
+        # Only the vnodes of the node are placed, so a membership change does not
+        # rehash and sort the whole ring. The lists are rebuilt in one merge pass,
+        # copying the runs between the new vnodes as slices.
+        hashes = sorted(node.vnode_hashes)
+        indexes = [bisect.bisect_right(self._vnode_hashes, hash_) for hash_ in hashes]
+        vnode_hashes: List[int] = []
+        vnode_nodes: List[_Node] = []
+        start = 0
+        for index, hash_ in zip(indexes, hashes):
+            vnode_hashes += self._vnode_hashes[start:index]
+            vnode_hashes.append(hash_)
+            vnode_nodes += self._vnode_nodes[start:index]
+            vnode_nodes.append(node)
+            start = index
+        vnode_hashes += self._vnode_hashes[start:]
+        vnode_nodes += self._vnode_nodes[start:]
+        self._vnode_hashes = vnode_hashes
+        self._vnode_nodes = vnode_nodes
+
+    def _delete_vnodes(self, node: _Node) -> None:
+        indexes = []
+        for hash_ in set(node.vnode_hashes):
+            index = bisect.bisect_left(self._vnode_hashes, hash_)
+            while (
+                index < len(self._vnode_hashes) and self._vnode_hashes[index] == hash_
+            ):
+                if self._vnode_nodes[index] is node:
+                    indexes.append(index)
+                index += 1
+        vnode_hashes: List[int] = []
+        vnode_nodes: List[_Node] = []
+        start = 0
+        for index in sorted(indexes):
+            vnode_hashes += self._vnode_hashes[start:index]
+            vnode_nodes += self._vnode_nodes[start:index]
+            start = index + 1
+        vnode_hashes += self._vnode_hashes[start:]
+        vnode_nodes += self._vnode_nodes[start:]
+        self._vnode_hashes = vnode_hashes
+        self._vnode_nodes = vnode_nodes
+
+    def _sum_weights(self) -> float:
+        return sum(_node.node.weight for _node in self._nodes.values())
+
+    def _iter_vnode_nodes_from(self, key: str) -> Iterator[_Node]:
+        start = bisect.bisect_left(self._vnode_hashes, self._hash_function(key))
+        # Indexed from the start, since islice would step through the list from its head.
+        n_vnodes = len(self._vnode_nodes)
+        for i in range(n_vnodes):
+            yield self._vnode_nodes[(start + i) % n_vnodes]
+
+    def _get_node_with_capacity(self, key: str) -> _Node:
+        vnode_nodes = self._iter_vnode_nodes_from(key)
+        if self.bounded_load_epsilon is None:
+            return next(vnode_nodes)
+        # Consistent hashing with bounded loads. A node takes a key only while its load
+        # is under (1 + epsilon) times its share of the average load, counting the key.
+        # The capacities sum up to more than the load, so some node always has room.
+        total_load = len(self._key_to_assigned_node) + 1
+        for _node in vnode_nodes:
+            capacity = math.ceil(
+                (1 + self.bounded_load_epsilon)
+                * total_load
+                * _node.node.weight
+                / self._total_weight
+            )
+            if len(_node.assigned_keys) < capacity:
+                return _node
+        raise AssertionError("unreachable")
+
+
+def _jump_hash(key_hash: int, n_buckets: int) -> int:
+    # Jump consistent hash (Lamping and Veach), with its 64 bit linear congruential generator.
+    key_hash &= _UINT64_MASK
+    bucket, next_bucket = -1, 0
+    while next_bucket < n_buckets:
+        bucket = next_bucket
+        key_hash = (key_hash * 2862933555777941757 + 1) & _UINT64_MASK
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((key_hash >> 33) + 1)))
+    return bucket
+
+
+def _mix_hash(hash_: int) -> int:
+    # The finalizer of SplitMix64, which spreads a small change of the input over all bits.
+    hash_ &= _UINT64_MASK
+    hash_ = ((hash_ ^ (hash_ >> 30)) * 0xBF58476D1CE4E5B9) & _UINT64_MASK
+    hash_ = ((hash_ ^ (hash_ >> 27)) * 0x94D049BB133111EB) & _UINT64_MASK
+    return hash_ ^ (hash_ >> 31)
+
+
+class JumpHash(Placement):
+    def __init__(
+        self, nodes: List[Node], hash_function: HashFunction = blake2b_hash
+    ) -> None:
+        self._hash_function = hash_function
+        # Nodes are the numbered buckets of jump hash, so their order matters.
+        self._nodes: List[Node] = []
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[Node]:
+        return list(self._nodes)
 
     def get_node_of_key(self, key: str) -> Node:
-        if not self.nodes:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        return self._nodes[_jump_hash(self._hash_function(key), len(self._nodes))]
+
+    def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
+        if not self._nodes:
             raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
-        hash_ = _get_hash(key)
-        for vnode in self._sorted_vnodes:
-            if vnode.id >= hash_:
-                return vnode.node.to_node()
-        return self._sorted_vnodes[0].node.to_node()
+        bucket = _jump_hash(self._hash_function(key), len(self._nodes))
+        return [
+            self._nodes[(bucket + i) % len(self._nodes)]
+            for i in range(min(n_nodes, len(self._nodes)))
+        ]
 
     def add_node(self, node: Node) -> None:
-        self._nodes.append(_Node.from_node(node, self.n_virtual_nodes_per_node))
-        self._sorted_vnodes = self._get_sorted_vnodes()
+        if any(node_.id == node.id for node_ in self._nodes):
+            return
+        self._nodes.append(node)
 
     def remove_node(self, node: Node) -> None:
-        node_ = _Node.from_node(node, self.n_virtual_nodes_per_node)
-        self._nodes.remove(node_)
-        self._sorted_vnodes = self._get_sorted_vnodes()
-
-    def _get_sorted_vnodes(self) -> List[_VNode]:
-        return sorted(
-            list(itertools.chain(*[node.vnodes for node in self._nodes])),
-            key=lambda vnode: vnode.id,
+        # Only the last bucket can be removed without moving the keys of other buckets.
+        if not self._nodes or self._nodes[-1].id != node.id:
+            raise ValueError(f"{node} is not the last node. Jump hash removes only it")
+        self._nodes.pop()
+
+
+class RendezvousHash(Placement):
+    def __init__(
+        self, nodes: List[Node], hash_function: HashFunction = blake2b_hash
+    ) -> None:
+        self._hash_function = hash_function
+        self._node_id_to_seed: Dict[str, int] = {}
+        self._nodes: Dict[str, Node] = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[Node]:
+        return list(self._nodes.values())
+
+    def get_node_of_key(self, key: str) -> Node:
+        return self.get_nodes_of_key(key, 1)[0]
+
+    def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        key_hash = self._hash_function(key)
+        # Highest random weight. The key is hashed once, and mixed with the seed of each node.
+        # Weights are applied as in weighted rendezvous hashing (-weight / ln(score)).
+        return heapq.nlargest(
+            n_nodes,
+            self._nodes.values(),
+            key=lambda node: -node.weight
+            / math.log(
+                (_mix_hash(self._node_id_to_seed[node.id] ^ key_hash) + 0.5)
+                / _UINT64_LIMIT
+            ),
         )
+
+    def add_node(self, node: Node) -> None:
+        if node.id in self._nodes:
+            return
+        self._nodes[node.id] = node
+        self._node_id_to_seed[node.id] = self._hash_function(node.id)
+
+    def remove_node(self, node: Node) -> None:
+        if node.id not in self._nodes:
+            raise ValueError(f"{node} is not in the nodes")
+        del self._nodes[node.id]
+        del self._node_id_to_seed[node.id]
+
+
+class MaglevHash(Placement):
+    def __init__(
+        self,
+        nodes: List[Node],
+        table_size: int = 65537,
+        hash_function: HashFunction = blake2b_hash,
+    ) -> None:
+        # The size must be a prime, so that every skip visits every slot,
+        # and much larger than the number of nodes for an even division.
+        self.table_size = table_size
+        self._hash_function = hash_function
+        self._nodes: Dict[str, Node] = {}
+        for node in nodes:
+            self._nodes.setdefault(node.id, node)
+        self._table: List[Node] = []
+        self._build_table()
+
+    @property
+    def nodes(self) -> List[Node]:
+        return list(self._nodes.values())
+
+    def get_node_of_key(self, key: str) -> Node:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        return self._table[self._hash_function(key) % self.table_size]
+
+    def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
+        if not self._nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        start = self._hash_function(key) % self.table_size
+        nodes: List[Node] = []
+        for i in range(self.table_size):
+            node = self._table[(start + i) % self.table_size]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == min(n_nodes, len(self._nodes)):
+                    break
+        return nodes
+
+    def add_node(self, node: Node) -> None:
+        if node.id in self._nodes:
+            return
+        self._nodes[node.id] = node
+        self._build_table()
+
+    def remove_node(self, node: Node) -> None:
+        if node.id not in self._nodes:
+            raise ValueError(f"{node} is not in the nodes")
+        del self._nodes[node.id]
+        self._build_table()
+
+    def _build_table(self) -> None:
+        nodes = list(self._nodes.values())
+        if not nodes:
+            self._table = []
+            return
+        # Each node fills the slots in the order of its own permutation of the table,
+        # taking turns with the others, until every slot is filled.
+        offsets = [
+            self._hash_function(f"{node.id}.offset") % self.table_size for node in nodes
+        ]
+        skips = [
+            self._hash_function(f"{node.id}.skip") % (self.table_size - 1) + 1
+            for node in nodes
+        ]
+        next_indexes = [0] * len(nodes)
+        table: List[Optional[Node]] = [None] * self.table_size
+        n_filled = 0
+        while True:
+            for i, node in enumerate(nodes):
+                slot = (offsets[i] + next_indexes[i] * skips[i]) % self.table_size
+                while table[slot] is not None:
+                    next_indexes[i] += 1
+                    slot = (offsets[i] + next_indexes[i] * skips[i]) % self.table_size
+                table[slot] = node
+                next_indexes[i] += 1
+                n_filled += 1
+                if n_filled == self.table_size:
+                    self._table = table
+                    return
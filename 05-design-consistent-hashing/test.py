@@ -1,7 +1,18 @@
 from collections import Counter
 from statistics import mean
 
-from consistent_hash import ConsistentHash, Node
+import pytest
+from consistent_hash import (
+    ConsistentHash,
+    JumpHash,
+    MaglevHash,
+    Node,
+    RendezvousHash,
+    blake2b_hash,
+    murmur3_hash,
+    sha1_hash,
+    xxh3_hash,
+)
 from faker import Faker
 
 
@@ -91,3 +102,155 @@ def test_consistent_hash_do_after_add_a_node_successfully():
     upper_bound = expected_diff + int(expected_diff * error_rate)
     expected_values = list(range(lower_bound, upper_bound))
     assert int(mean(n_diffs)) in expected_values
+
+
+@pytest.mark.parametrize(
+    "hash_function", [blake2b_hash, sha1_hash, xxh3_hash, murmur3_hash]
+)
+def test_get_node_of_key_returns_the_node_of_the_next_vnode_on_the_ring(
+    hash_function,
+):
+    # given
+    try:
+        hash_function("")
+    except ImportError as e:
+        pytest.skip(str(e))
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    n_vnodes_per_node = 10
+    consistent_hash = ConsistentHash(
+        nodes=nodes, n_vnodes_per_node=n_vnodes_per_node, hash_function=hash_function
+    )
+    vnodes = sorted(
+        (hash_function(f"{node.id}.{i}"), node.id)
+        for node in nodes
+        for i in range(n_vnodes_per_node)
+    )
+    faker = Faker()
+
+    n_data = 300
+    for _ in range(n_data):
+        # when
+        key = faker.email()
+        node = consistent_hash.get_node_of_key(key)
+
+        # then
+        hash_ = hash_function(key)
+        expected_node_id = next(
+            (node_id for vnode_hash, node_id in vnodes if vnode_hash >= hash_),
+            vnodes[0][1],
+        )
+        assert node.id == expected_node_id
+        assert node is consistent_hash.get_node_of_key(key)
+
+
+def test_get_node_of_key_after_nodes_are_added_and_removed_is_same_as_new_one():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(nodes=nodes[:3])
+    faker = Faker()
+    keys = [faker.email() for _ in range(300)]
+
+    # when
+    consistent_hash.add_node(nodes[3])
+    consistent_hash.add_node(nodes[4])
+    consistent_hash.remove_node(nodes[0])
+
+    # then
+    new_consistent_hash = ConsistentHash(nodes=nodes[1:])
+    for key in keys:
+        assert (
+            consistent_hash.get_node_of_key(key).id
+            == new_consistent_hash.get_node_of_key(key).id
+        )
+
+
+def test_get_node_of_key_divides_the_keys_by_the_weights_of_nodes():
+    # given
+    nodes = [Node(id="1"), Node(id="2"), Node(id="3", weight=2)]
+    consistent_hash = ConsistentHash(nodes=nodes)
+
+    # when
+    n_data = 4000
+    counter = Counter(
+        consistent_hash.get_node_of_key(f"key-{i}").id for i in range(n_data)
+    )
+
+    # then
+    assert counter["3"] > counter["1"] * 1.5
+    assert counter["3"] > counter["2"] * 1.5
+
+
+def test_assign_key_keeps_the_loads_of_nodes_under_the_bound():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    bounded_load_epsilon = 0.1
+    consistent_hash = ConsistentHash(
+        nodes=nodes, n_vnodes_per_node=10, bounded_load_epsilon=bounded_load_epsilon
+    )
+    faker = Faker()
+
+    # when
+    n_data = 1000
+    keys = [faker.unique.email() for _ in range(n_data)]
+    key_to_node = {key: consistent_hash.assign_key(key) for key in keys}
+
+    # then
+    max_load = (1 + bounded_load_epsilon) * n_data / len(nodes)
+    assert sum(consistent_hash.loads.values()) == n_data
+    assert max(consistent_hash.loads.values()) <= max_load + 1
+    for key in keys:
+        assert consistent_hash.assign_key(key) == key_to_node[key]
+
+    # when
+    consistent_hash.release_key(keys[0])
+
+    # then
+    assert sum(consistent_hash.loads.values()) == n_data - 1
+
+
+@pytest.mark.parametrize(
+    "placement_class", [ConsistentHash, JumpHash, RendezvousHash, MaglevHash]
+)
+def test_get_nodes_of_key_returns_distinct_nodes_starting_from_the_node_of_key(
+    placement_class,
+):
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    placement = placement_class(nodes)
+
+    for i in range(100):
+        # when
+        key = f"key-{i}"
+        replicas = placement.get_nodes_of_key(key, n_nodes=3)
+
+        # then
+        assert len({node.id for node in replicas}) == 3
+        assert replicas[0] == placement.get_node_of_key(key)
+    assert len(placement.get_nodes_of_key("key", n_nodes=10)) == len(nodes)
+
+
+@pytest.mark.parametrize(
+    "placement_class", [ConsistentHash, JumpHash, RendezvousHash, MaglevHash]
+)
+def test_add_node_moves_keys_mostly_to_the_new_node(placement_class):
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 5)]
+    placement = placement_class(nodes)
+    keys = [f"key-{i}" for i in range(2000)]
+    initial_key_to_node = {key: placement.get_node_of_key(key) for key in keys}
+
+    # when
+    placement.add_node(Node(id="5"))
+
+    # then
+    moved_keys = [
+        key
+        for key in keys
+        if placement.get_node_of_key(key) != initial_key_to_node[key]
+    ]
+    # Maglev moves a few keys between the other nodes as well.
+    n_keys_moved_to_others = sum(
+        placement.get_node_of_key(key).id != "5" for key in moved_keys
+    )
+    assert n_keys_moved_to_others <= len(moved_keys) * 0.05
+    assert len(keys) / 5 * 0.7 < len(moved_keys) < len(keys) / 5 * 1.3
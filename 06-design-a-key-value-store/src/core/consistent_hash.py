@@ -1,95 +1,397 @@
 from __future__ import annotations
 
+import bisect
 import hashlib
 import itertools
-from dataclasses import dataclass
-from typing import List
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, NamedTuple, Optional
 
+import numpy as np
 
-def _get_hash(key: str) -> int:
-    return int(hashlib.new("sha1", key.encode("utf-8")).hexdigest(), 16)
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HashFunction = Callable[[str], int]
+
+_HASH_LIMIT_OF_UINT64 = 1 << 64
+
+
+def sha1_hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest(), "big")
+
+
+def blake2b_hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+def xxh3_hash(key: str) -> int:
+    if xxhash is None:
+        raise ImportError("xxh3_hash requires xxhash. Please install it")
+    return xxhash.xxh3_64_intdigest(key.encode("utf-8"))
+
+
+def murmur3_hash(key: str) -> int:
+    if mmh3 is None:
+        raise ImportError("murmur3_hash requires mmh3. Please install it")
+    return mmh3.hash64(key, signed=False)[0]
 
 
 @dataclass
 class Node:
     id: str
+    # The number of vnodes of a node is proportional to its weight, and so is its share of keys.
+    weight: float = 1
 
+    def __post_init__(self) -> None:
+        if self.weight <= 0:
+            raise ValueError(f"weight of {self.id} must be positive")
 
-@dataclass
-class _VNode:
-    id: int
-    node: _Node
 
-
-@dataclass
+@dataclass(eq=False)
 class _Node:
     id: str
     n_vnodes: int
+    node: Node
+    vnode_hashes: List[int] = field(repr=False)
 
     @classmethod
-    def from_node(cls, node: Node, n_vnodes: int) -> _Node:
-        return cls(id=node.id, n_vnodes=n_vnodes)
+    def from_node(
+        cls, node: Node, n_vnodes_per_node: int, hash_function: HashFunction
+    ) -> _Node:
+        n_vnodes = max(1, round(n_vnodes_per_node * node.weight))
+        return cls(
+            id=node.id,
+            n_vnodes=n_vnodes,
+            node=node,
+            vnode_hashes=[hash_function(f"{node.id}.{i}") for i in range(n_vnodes)],
+        )
 
     def to_node(self) -> Node:
-        return Node(id=self.id)
-
-    @property
-    def vnodes(self) -> List[_VNode]:
-        return [
-            _VNode(id=_get_hash(f"{self.id}.{i}"), node=self)
-            for i in range(self.n_vnodes)
-        ]
+        return self.node
 
 
 class EmptyNodeError(Exception):
     pass
 
 
+class MovedRange(NamedTuple):
+    # Keys whose hash is in (start_hash, end_hash]. The range wraps around the top of
+    # the hash space if start_hash >= end_hash.
+    start_hash: int
+    end_hash: int
+    old_nodes: List[Node]
+    new_nodes: List[Node]
+
+
+@dataclass(eq=False)
+class _Ring:
+    nodes: Dict[str, _Node]
+    # The ring is kept as parallel arrays sorted by hash, so that a key is looked up
+    # with a binary search.
+    vnode_hashes: List[int]
+    vnode_nodes: List[_Node]
+    # Derived from the ring before it is swapped in, so that lookups only read them.
+    # vnode_hash_array is None if the hashes do not fit in 64 bits.
+    vnode_hash_array: Optional[np.ndarray] = field(default=None, repr=False)
+    preference_lists: Optional[List[List[_Node]]] = field(default=None, repr=False)
+    preference_table: Optional[np.ndarray] = field(default=None, repr=False)
+
+
 class ConsistentHash:
-    def __init__(self, nodes: List[Node], n_vnodes_per_node: int = 200) -> None:
+    def __init__(
+        self,
+        nodes: List[Node],
+        n_vnodes_per_node: int = 200,
+        hash_function: HashFunction = blake2b_hash,
+        n_replicas: int = 3,
+    ) -> None:
         self.n_virtual_nodes_per_node = n_vnodes_per_node
+        # Nodes of up to this many replicas of a key are precomputed for each vnode.
+        self.n_replicas = n_replicas
+        # 64 bit hashes fit in a machine word, which makes them cheaper to compare than SHA-1.
+        self._hash_function = hash_function
 
-        self._nodes = [_Node.from_node(node, n_vnodes_per_node) for node in nodes]
-        self._sorted_vnodes = self._get_sorted_vnodes()
+        _nodes: Dict[str, _Node] = {}
+        for node in nodes:
+            _nodes.setdefault(
+                node.id, _Node.from_node(node, n_vnodes_per_node, hash_function)
+            )
+        # Handlers run in a thread pool, so a ring is never changed once built.
+        # A membership change builds a new ring and swaps it in, and a lookup reads
+        # self._ring once so that it sees either ring but never half of a change.
+        self._ring = self._build_ring(_nodes)
+        self._lock = threading.Lock()
 
     @property
     def nodes(self) -> List[Node]:
-        return [_node.to_node() for _node in self._nodes]
+        return [_node.to_node() for _node in self._ring.nodes.values()]
 
     def get_node_of_key(self, key: str) -> Node:
-        if not self.nodes:
+        ring = self._ring
+        if not ring.nodes:
             raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
-        hash_ = _get_hash(key)
-        for vnode in self._sorted_vnodes:
-            if vnode.id >= hash_:
-                return vnode.node.to_node()
-        return self._sorted_vnodes[0].node.to_node()
+        return ring.vnode_nodes[self._search_vnode(ring, key)].to_node()
 
     def get_nodes_of_key(self, key: str, n_nodes: int) -> List[Node]:
-        if not self.nodes:
+        ring = self._ring
+        if not ring.nodes:
             raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
-        hash_ = _get_hash(key)
-
-        _nodes = []
-        for vnode in self._sorted_vnodes:
-            if vnode.id >= hash_ and vnode.node not in _nodes:
-                _nodes.append(vnode.node)
-                if len(_nodes) == min(n_nodes, len(self.nodes)):
-                    break
+        start = self._search_vnode(ring, key)
+        if n_nodes <= self.n_replicas:
+            _nodes = ring.preference_lists[start][:n_nodes]
+        else:
+            _nodes = self._get_nodes_from(ring, start, n_nodes)
         return [_node.to_node() for _node in _nodes]
 
+    def get_nodes_of_keys(self, keys: List[str], n_nodes: int) -> Dict[str, List[int]]:
+        ring = self._ring
+        if not ring.nodes:
+            raise EmptyNodeError("There are no nodes. Please add nodes at least 1")
+        if not keys:
+            return {}
+        starts = self._search_vnodes(ring, [self._hash_function(key) for key in keys])
+        _nodes = list(ring.nodes.values())
+        if n_nodes <= self.n_replicas:
+            node_indexes_of_keys = ring.preference_table[starts, :n_nodes]
+        else:
+            # Nodes of a key depend only on where the key lands on the ring,
+            # so they are found once per vnode rather than once per key.
+            unique_starts, inverse = np.unique(starts, return_inverse=True)
+            node_indexes = {_node: i for i, _node in enumerate(_nodes)}
+            node_indexes_of_starts = np.array(
+                [
+                    [
+                        node_indexes[_node]
+                        for _node in self._get_nodes_from(ring, start, n_nodes)
+                    ]
+                    for start in unique_starts.tolist()
+                ],
+                dtype=np.intp,
+            )
+            node_indexes_of_keys = node_indexes_of_starts[inverse.ravel()]
+
+        key_indexes = np.repeat(np.arange(len(keys)), node_indexes_of_keys.shape[1])
+        node_indexes_of_keys = node_indexes_of_keys.ravel()
+        order = np.argsort(node_indexes_of_keys, kind="stable")
+        assigned_node_indexes, group_starts = np.unique(
+            node_indexes_of_keys[order], return_index=True
+        )
+        return {
+            _nodes[node_index].id: group.tolist()
+            for node_index, group in zip(
+                assigned_node_indexes.tolist(),
+                np.split(key_indexes[order], group_starts[1:]),
+            )
+        }
+
+    def copy(self) -> ConsistentHash:
+        consistent_hash = ConsistentHash(
+            nodes=[],
+            n_vnodes_per_node=self.n_virtual_nodes_per_node,
+            hash_function=self._hash_function,
+            n_replicas=self.n_replicas,
+        )
+        consistent_hash._ring = self._ring
+        return consistent_hash
+
+    def get_moved_ranges(
+        self, new_consistent_hash: ConsistentHash, n_nodes: int
+    ) -> List[MovedRange]:
+        if new_consistent_hash._hash_function is not self._hash_function:
+            raise ValueError("Rings of different hash functions can not be compared")
+        old_ring = self._ring
+        new_ring = new_consistent_hash._ring
+        # Owners change only at vnodes of either ring, so the ranges between
+        # the vnodes of both rings are compared.
+        boundary_hashes = sorted(
+            set(old_ring.vnode_hashes) | set(new_ring.vnode_hashes)
+        )
+        moved_ranges: List[MovedRange] = []
+        start_hash = boundary_hashes[-1] if boundary_hashes else 0
+        for end_hash in boundary_hashes:
+            old_nodes = self._get_nodes_of_hash(old_ring, end_hash, n_nodes)
+            new_nodes = new_consistent_hash._get_nodes_of_hash(
+                new_ring, end_hash, n_nodes
+            )
+            if {_node.id for _node in old_nodes} != {_node.id for _node in new_nodes}:
+                old_nodes = [_node.to_node() for _node in old_nodes]
+                new_nodes = [_node.to_node() for _node in new_nodes]
+                if (
+                    moved_ranges
+                    and moved_ranges[-1].end_hash == start_hash
+                    and moved_ranges[-1].old_nodes == old_nodes
+                    and moved_ranges[-1].new_nodes == new_nodes
+                ):
+                    moved_ranges[-1] = moved_ranges[-1]._replace(end_hash=end_hash)
+                else:
+                    moved_ranges.append(
+                        MovedRange(start_hash, end_hash, old_nodes, new_nodes)
+                    )
+            start_hash = end_hash
+        return moved_ranges
+
     def add_node(self, node: Node) -> None:
-        node_ = _Node.from_node(node, self.n_virtual_nodes_per_node)
-        self._nodes.append(node_)
-        self._sorted_vnodes = self._get_sorted_vnodes()
+        with self._lock:
+            ring = self._ring
+            if node.id in ring.nodes:
+                return
+            node_ = _Node.from_node(
+                node, self.n_virtual_nodes_per_node, self._hash_function
+            )
+            self._ring = self._insert_vnodes(ring, node_)
 
     def remove_node(self, node: Node) -> None:
-        node_ = _Node.from_node(node, self.n_virtual_nodes_per_node)
-        self._nodes.remove(node_)
-        self._sorted_vnodes = self._get_sorted_vnodes()
-
-    def _get_sorted_vnodes(self) -> List[_VNode]:
-        return sorted(
-            list(itertools.chain(*[node.vnodes for node in self._nodes])),
-            key=lambda vnode: vnode.id,
+        with self._lock:
+            ring = self._ring
+            if node.id not in ring.nodes:
+                raise ValueError(f"{node} is not in the nodes")
+            self._ring = self._delete_vnodes(ring, ring.nodes[node.id])
+
+    def _build_ring(self, nodes: Dict[str, _Node]) -> _Ring:
+        vnodes = sorted(
+            (
+                (hash_, _node)
+                for _node in nodes.values()
+                for hash_ in _node.vnode_hashes
+            ),
+            key=lambda vnode: vnode[0],
+        )
+        return self._create_ring(
+            nodes,
+            [hash_ for hash_, _ in vnodes],
+            [_node for _, _node in vnodes],
         )
+
+    def _insert_vnodes(self, ring: _Ring, node: _Node) -> _Ring:
+        # Only the vnodes of the node are placed, so a membership change does not
+        # rehash and sort the whole ring. The new lists are built in one merge pass,
+        # copying the runs of the current ones between the new vnodes as slices,
+        # since lookups may be reading the current ones.
+        hashes = sorted(node.vnode_hashes)
+        indexes = [bisect.bisect_right(ring.vnode_hashes, hash_) for hash_ in hashes]
+        vnode_hashes: List[int] = []
+        vnode_nodes: List[_Node] = []
+        start = 0
+        for index, hash_ in zip(indexes, hashes):
+            vnode_hashes += ring.vnode_hashes[start:index]
+            vnode_hashes.append(hash_)
+            vnode_nodes += ring.vnode_nodes[start:index]
+            vnode_nodes.append(node)
+            start = index
+        vnode_hashes += ring.vnode_hashes[start:]
+        vnode_nodes += ring.vnode_nodes[start:]
+        return self._create_ring(
+            {**ring.nodes, node.id: node}, vnode_hashes, vnode_nodes
+        )
+
+    def _delete_vnodes(self, ring: _Ring, node: _Node) -> _Ring:
+        indexes = []
+        for hash_ in set(node.vnode_hashes):
+            index = bisect.bisect_left(ring.vnode_hashes, hash_)
+            while index < len(ring.vnode_hashes) and ring.vnode_hashes[index] == hash_:
+                if ring.vnode_nodes[index] is node:
+                    indexes.append(index)
+                index += 1
+        # The runs between the deleted vnodes are copied as slices in one pass.
+        vnode_hashes: List[int] = []
+        vnode_nodes: List[_Node] = []
+        start = 0
+        for index in sorted(indexes):
+            vnode_hashes += ring.vnode_hashes[start:index]
+            vnode_nodes += ring.vnode_nodes[start:index]
+            start = index + 1
+        vnode_hashes += ring.vnode_hashes[start:]
+        vnode_nodes += ring.vnode_nodes[start:]
+        nodes = dict(ring.nodes)
+        del nodes[node.id]
+        return self._create_ring(nodes, vnode_hashes, vnode_nodes)
+
+    def _create_ring(
+        self,
+        nodes: Dict[str, _Node],
+        vnode_hashes: List[int],
+        vnode_nodes: List[_Node],
+    ) -> _Ring:
+        ring = _Ring(nodes=nodes, vnode_hashes=vnode_hashes, vnode_nodes=vnode_nodes)
+        if vnode_hashes and vnode_hashes[-1] < _HASH_LIMIT_OF_UINT64:
+            ring.vnode_hash_array = np.array(vnode_hashes, dtype=np.uint64)
+        ring.preference_table = self._build_preference_table(ring)
+        # The same nodes as the table, for lookups of a single key.
+        node_array = np.empty(len(nodes), dtype=object)
+        node_array[:] = list(nodes.values())
+        ring.preference_lists = node_array[ring.preference_table].tolist()
+        return ring
+
+    def _build_preference_table(self, ring: _Ring) -> np.ndarray:
+        # Distinct nodes from a vnode are the node of the vnode followed by the distinct
+        # nodes from the next vnode, so they are built backwards in one sweep.
+        # The ring wraps around, so the sweep starts from the nodes of the first vnode.
+        n_nodes = min(self.n_replicas, len(ring.nodes))
+        node_indexes = {_node: i for i, _node in enumerate(ring.nodes.values())}
+        vnode_node_indexes = [node_indexes[_node] for _node in ring.vnode_nodes]
+        rows: List[List[int]] = [[]] * len(vnode_node_indexes)
+        next_row = [
+            node_indexes[_node] for _node in self._get_nodes_from(ring, 0, n_nodes)
+        ]
+        for index in range(len(vnode_node_indexes) - 1, -1, -1):
+            node_index = vnode_node_indexes[index]
+            row = [node_index]
+            for next_node_index in next_row:
+                if len(row) == n_nodes:
+                    break
+                if next_node_index != node_index:
+                    row.append(next_node_index)
+            rows[index] = next_row = row
+        return np.fromiter(
+            itertools.chain.from_iterable(rows),
+            dtype=np.intp,
+            count=len(rows) * n_nodes,
+        ).reshape(len(rows), n_nodes)
+
+    def _get_nodes_from(self, ring: _Ring, start: int, n_nodes: int) -> List[_Node]:
+        _nodes: List[_Node] = []
+        n_vnodes = len(ring.vnode_nodes)
+        for i in range(n_vnodes):
+            _node = ring.vnode_nodes[(start + i) % n_vnodes]
+            if _node not in _nodes:
+                _nodes.append(_node)
+                if len(_nodes) == min(n_nodes, len(ring.nodes)):
+                    break
+        return _nodes
+
+    def _get_nodes_of_hash(self, ring: _Ring, hash_: int, n_nodes: int) -> List[_Node]:
+        if not ring.nodes:
+            return []
+        index = bisect.bisect_left(ring.vnode_hashes, hash_)
+        start = index if index < len(ring.vnode_hashes) else 0
+        if n_nodes <= self.n_replicas:
+            return ring.preference_lists[start][:n_nodes]
+        return self._get_nodes_from(ring, start, n_nodes)
+
+    def _search_vnode(self, ring: _Ring, key: str) -> int:
+        index = bisect.bisect_left(ring.vnode_hashes, self._hash_function(key))
+        # Keys after the last vnode belong to the first one.
+        return index if index < len(ring.vnode_hashes) else 0
+
+    def _search_vnodes(self, ring: _Ring, hashes: List[int]) -> np.ndarray:
+        if ring.vnode_hash_array is None or max(hashes) >= _HASH_LIMIT_OF_UINT64:
+            # Hashes wider than 64 bits, such as SHA-1, are compared as Python ints.
+            indexes = np.searchsorted(
+                np.array(ring.vnode_hashes, dtype=object),
+                np.array(hashes, dtype=object),
+            )
+        else:
+            indexes = np.searchsorted(
+                ring.vnode_hash_array, np.array(hashes, dtype=np.uint64)
+            )
+        return indexes % len(ring.vnode_hashes)
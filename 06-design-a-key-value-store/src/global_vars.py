@@ -5,4 +5,6 @@ from src.core.consistent_hash import ConsistentHash, Node
 items = {}
 peer_urls = set()
 config = Config()
-consistent_hash = ConsistentHash(nodes=[Node(id=config.http_url)])
+consistent_hash = ConsistentHash(
+    nodes=[Node(id=config.http_url)], n_replicas=config.n_copy
+)
@@ -0,0 +1,214 @@
+import threading
+
+from src.core.consistent_hash import ConsistentHash, Node, blake2b_hash
+
+
+def test_get_node_of_key_is_one_of_the_nodes():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 4)]
+    consistent_hash = ConsistentHash(nodes=nodes)
+
+    for i in range(100):
+        # when
+        node = consistent_hash.get_node_of_key(f"key-{i}")
+
+        # then
+        assert node in nodes
+
+
+def test_get_nodes_of_key_returns_distinct_nodes_starting_from_the_node_of_key():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(nodes=nodes)
+
+    for i in range(100):
+        # when
+        key = f"key-{i}"
+        replicas = consistent_hash.get_nodes_of_key(key, n_nodes=3)
+
+        # then
+        assert len({node.id for node in replicas}) == len(replicas)
+        if replicas:
+            assert replicas[0] == consistent_hash.get_node_of_key(key)
+
+
+def test_add_node_ignores_the_node_already_added():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 4)]
+    consistent_hash = ConsistentHash(nodes=nodes)
+    key_to_node = {
+        f"key-{i}": consistent_hash.get_node_of_key(f"key-{i}") for i in range(100)
+    }
+
+    # when
+    consistent_hash.add_node(Node(id="1"))
+    consistent_hash.remove_node(Node(id="2"))
+    consistent_hash.add_node(Node(id="2"))
+
+    # then
+    assert consistent_hash.nodes == [Node(id="1"), Node(id="3"), Node(id="2")]
+    for key, node in key_to_node.items():
+        assert consistent_hash.get_node_of_key(key) == node
+
+
+def test_add_and_remove_node_place_vnodes_as_a_new_ring_does():
+    # given
+    # Colliding hashes check that vnodes of the same hash keep the order of nodes.
+    def colliding_hash(key):
+        return blake2b_hash(key) % 50
+
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(
+        nodes=nodes[:3], n_vnodes_per_node=20, hash_function=colliding_hash
+    )
+
+    # when
+    consistent_hash.add_node(nodes[3])
+    consistent_hash.remove_node(nodes[1])
+    consistent_hash.add_node(nodes[4])
+
+    # then
+    new_consistent_hash = ConsistentHash(
+        nodes=[nodes[0], nodes[2], nodes[3], nodes[4]],
+        n_vnodes_per_node=20,
+        hash_function=colliding_hash,
+    )
+    assert consistent_hash._ring.vnode_hashes == new_consistent_hash._ring.vnode_hashes
+    assert [_node.id for _node in consistent_hash._ring.vnode_nodes] == [
+        _node.id for _node in new_consistent_hash._ring.vnode_nodes
+    ]
+
+
+def test_preference_lists_are_built_with_the_ring_before_lookups():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(nodes=nodes, n_vnodes_per_node=20)
+
+    # when
+    consistent_hash.add_node(Node(id="6"))
+    consistent_hash.remove_node(Node(id="1"))
+
+    # then
+    ring = consistent_hash._ring
+    _nodes = list(ring.nodes.values())
+    for start in range(len(ring.vnode_nodes)):
+        expected_nodes = consistent_hash._get_nodes_from(ring, start, 3)
+        assert ring.preference_lists[start] == expected_nodes
+        assert [_nodes[i] for i in ring.preference_table[start]] == expected_nodes
+
+
+def test_get_nodes_of_keys_groups_keys_by_the_nodes_of_each_key():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(nodes=nodes, n_vnodes_per_node=20)
+    keys = [f"key-{i}" for i in range(1000)]
+
+    # when
+    node_id_to_key_indexes = consistent_hash.get_nodes_of_keys(keys, n_nodes=3)
+
+    # then
+    expected_node_id_to_key_indexes = {}
+    for key_index, key in enumerate(keys):
+        for node in consistent_hash.get_nodes_of_key(key, n_nodes=3):
+            expected_node_id_to_key_indexes.setdefault(node.id, []).append(key_index)
+    assert node_id_to_key_indexes == expected_node_id_to_key_indexes
+
+
+def test_get_node_of_key_divides_the_keys_by_the_weights_of_nodes():
+    # given
+    nodes = [Node(id="1"), Node(id="2", weight=3)]
+    consistent_hash = ConsistentHash(nodes=nodes)
+
+    # when
+    node_ids = [consistent_hash.get_node_of_key(f"key-{i}").id for i in range(2000)]
+
+    # then
+    assert node_ids.count("2") > node_ids.count("1") * 2
+
+
+def test_get_nodes_of_key_wraps_around_the_ring():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    consistent_hash = ConsistentHash(
+        nodes=nodes,
+        hash_function=lambda key: int(key) if key.isdigit() else blake2b_hash(key),
+    )
+    key_after_the_last_vnode = str((1 << 64) - 1)
+
+    # when
+    replicas = consistent_hash.get_nodes_of_key(key_after_the_last_vnode, n_nodes=3)
+
+    # then
+    assert len({node.id for node in replicas}) == 3
+    assert replicas[0] == consistent_hash.get_node_of_key("0")
+    assert replicas == consistent_hash.get_nodes_of_key("0", n_nodes=3)
+
+
+def test_get_moved_ranges_covers_the_keys_whose_nodes_are_changed():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 6)]
+    old_consistent_hash = ConsistentHash(nodes=nodes, n_vnodes_per_node=20)
+    new_consistent_hash = old_consistent_hash.copy()
+    new_consistent_hash.add_node(Node(id="6"))
+    new_consistent_hash.remove_node(Node(id="1"))
+
+    # when
+    moved_ranges = old_consistent_hash.get_moved_ranges(new_consistent_hash, n_nodes=3)
+
+    # then
+    def is_in_range(hash_, moved_range):
+        if moved_range.start_hash < moved_range.end_hash:
+            return moved_range.start_hash < hash_ <= moved_range.end_hash
+        return hash_ > moved_range.start_hash or hash_ <= moved_range.end_hash
+
+    for i in range(2000):
+        key = f"key-{i}"
+        old_nodes = old_consistent_hash.get_nodes_of_key(key, n_nodes=3)
+        new_nodes = new_consistent_hash.get_nodes_of_key(key, n_nodes=3)
+        matched_ranges = [
+            moved_range
+            for moved_range in moved_ranges
+            if is_in_range(blake2b_hash(key), moved_range)
+        ]
+        if {node.id for node in old_nodes} == {node.id for node in new_nodes}:
+            assert not matched_ranges
+        else:
+            assert len(matched_ranges) == 1
+            assert matched_ranges[0].old_nodes == old_nodes
+            assert matched_ranges[0].new_nodes == new_nodes
+    assert len(old_consistent_hash.nodes) == len(nodes)
+
+
+def test_lookups_from_other_threads_see_a_whole_ring_while_nodes_change():
+    # given
+    nodes = [Node(id=str(i)) for i in range(1, 51)]
+    consistent_hash = ConsistentHash(nodes=nodes, n_vnodes_per_node=20)
+    errors = []
+    is_stopped = threading.Event()
+
+    def look_up():
+        i = 0
+        while not is_stopped.is_set():
+            i += 1
+            try:
+                replicas = consistent_hash.get_nodes_of_key(f"key-{i}", n_nodes=5)
+                assert len({node.id for node in replicas}) == 5
+                consistent_hash.get_nodes_of_keys([f"key-{i}"], n_nodes=3)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=look_up) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    # when
+    for _ in range(100):
+        consistent_hash.add_node(Node(id="51"))
+        consistent_hash.remove_node(Node(id="51"))
+    is_stopped.set()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert not errors
+    assert consistent_hash.nodes == nodes